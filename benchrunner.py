@@ -0,0 +1,254 @@
+from __future__ import print_function
+import datetime
+import os
+import sys
+import coloredlogs, logging
+import azure.storage.blob as azureblob
+import azure.batch.batch_service_client as batch
+import azure.batch.batch_auth as batchauth
+import azure.batch.models as batchmodels
+import multi_task_helpers
+import configparser
+from azure.storage.blob import BlobPermissions
+
+
+logger = logging.getLogger(__name__)
+
+# Enable log output only for my logger
+coloredlogs.install(level='DEBUG', logger=logger)
+
+
+sys.path.append('.')
+import common.helpers  # noqa
+import common.imb  # noqa
+import common.interconnect  # noqa
+
+
+# Set these environment variables
+# export _BATCH_ACCOUNT_KEY=abd123==
+# etc
+_BATCH_ACCOUNT_KEY = os.environ['_BATCH_ACCOUNT_KEY']
+_BATCH_ACCOUNT_NAME = os.environ['_BATCH_ACCOUNT_NAME']
+_BATCH_ACCOUNT_URL = os.environ['_BATCH_ACCOUNT_URL']
+
+_STORAGE_ACCOUNT_NAME = os.environ['_STORAGE_ACCOUNT_NAME']
+_STORAGE_ACCOUNT_KEY = os.environ['_STORAGE_ACCOUNT_KEY']
+
+# Path to the benchmark job
+JOB_PATH = './jobs/benchmark'
+
+config = configparser.ConfigParser()
+config.read(JOB_PATH + '/config.ini')
+
+
+_APP_NAME = 'imb'
+_OS_NAME = config['node']['CFG_OS_NAME']
+_NODE_OS_PUBLISHER = config['node']['CFG_OS_PUBLISHER']
+_NODE_OS_OFFER = config['node']['CFG_OS_OFFER']
+_NODE_OS_SKU = config['node']['CFG_OS_SKU']
+_REFRESH_IMAGE_CACHE = config.getboolean(
+    'node', 'CFG_REFRESH_IMAGE_CACHE', fallback=False)
+_POOL_INTERNODE = config.getboolean('pool', 'CFG_INTERNODE', fallback=True)
+# RDMA capable VM sizes run on the HPC image matching their interconnect
+_AUTO_IMAGE = config.getboolean('node', 'CFG_AUTO_IMAGE', fallback=True)
+_IB_PROBE_TIMEOUT = config.getint('node', 'CFG_IB_PROBE_SECONDS', fallback=120)
+
+
+def _split_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+# The sweep: every VM size runs every node count with every fabric
+_VM_SIZES = _split_list(config['benchmark']['CFG_VM_SIZES'])
+_NODE_COUNTS = [int(count) for count in
+                _split_list(config['benchmark']['CFG_NODE_COUNTS'])]
+_FABRICS = _split_list(config['benchmark']['CFG_FABRICS'])
+_IMB_BENCHMARKS = config.get(
+    'benchmark', 'CFG_IMB_BENCHMARKS', fallback='PingPong').split()
+_IMB_MSGLOG = config.get('benchmark', 'CFG_IMB_MSGLOG', fallback='0:22')
+_REGRESSION_TOLERANCE = config.getfloat(
+    'benchmark', 'CFG_REGRESSION_TOLERANCE', fallback=0.1)
+_BASELINE_RUNS = config.getint('benchmark', 'CFG_BASELINE_RUNS', fallback=5)
+MAX_RUNTIME = config.getint('benchmark', 'CFG_MAX_RUNTIME', fallback=30)
+
+# SAS URLs have to stay valid for the whole sweep, including pool allocation
+_SWEEP_TIMEOUT = len(_VM_SIZES) * (
+    30 + MAX_RUNTIME * len(_NODE_COUNTS) * len(_FABRICS))
+
+_RUN_ID = common.helpers.generate_unique_resource_name(_APP_NAME)
+_TASK_OUTPUT_FILE_PATH_ON_VM = '../std*.txt'
+
+
+def get_task_id(node_count, fabric):
+    """Returns the id of the task for a point of the sweep
+
+    :param int node_count: The number of nodes.
+    :param str fabric: The I_MPI_FABRICS setting.
+    :rtype: str
+    """
+    return 'imb_{}_{}'.format(
+        node_count, fabric.replace(':', '-').replace(',', '-'))
+
+
+def run_vm_size(batch_client, vm_size, input_files, common_files,
+                output_container_sas):
+    """Runs every node count and fabric of the sweep on one VM size.
+
+    A single pool sized for the largest node count is used, and the tasks
+    are run one after another so that they do not share the interconnect.
+    RDMA fabrics are skipped on VM sizes without RDMA, and a task whose
+    nodes never bring InfiniBand up fails instead of measuring tcp.
+
+    :param batch_client: The batch client to use.
+    :type batch_client: `batchserviceclient.BatchServiceClient`
+    :param str vm_size: The VM size to benchmark.
+    :param list input_files: The resource files of the application command.
+    :param list common_files: The resource files of the coordination command.
+    :param str output_container_sas: SAS URL of the output container.
+    :rtype: list
+    :return: The records parsed from every task.
+    """
+    pool_id = common.helpers.generate_unique_resource_name(
+        'pool_{}_{}'.format(_APP_NAME, vm_size))
+    job_id = 'job-{}'.format(pool_id)
+    interconnect = common.interconnect.get_interconnect(vm_size)
+    image = (_NODE_OS_PUBLISHER, _NODE_OS_OFFER, _NODE_OS_SKU)
+    if _AUTO_IMAGE and interconnect['image'] is not None:
+        image = interconnect['image']
+    fabrics = [fabric for fabric in _FABRICS
+               if interconnect['rdma'] or
+               not common.interconnect.is_rdma_fabric(fabric)]
+    if fabrics != _FABRICS:
+        logger.warning('{} has no RDMA interconnect, skipping {}'.format(
+            vm_size, ', '.join(sorted(set(_FABRICS) - set(fabrics)))))
+    records = []
+    try:
+        multi_task_helpers.create_pool_and_wait_for_vms(
+            batch_client, pool_id, image[0], image[1], image[2], vm_size,
+            max(_NODE_COUNTS),
+            enable_inter_node_communication=_POOL_INTERNODE,
+            elevation_level=batchmodels.ElevationLevel.admin,
+            refresh_image_cache=_REFRESH_IMAGE_CACHE)
+        common.helpers.create_job(batch_client, job_id, pool_id)
+
+        for node_count in _NODE_COUNTS:
+            for fabric in fabrics:
+                task_id = get_task_id(node_count, fabric)
+                application_cmdline = common.interconnect.get_fabric_commands(
+                    interconnect, fabric, _IB_PROBE_TIMEOUT) + [
+                    'bash application-cmd {} {} {} -msglog {}'.format(
+                        node_count, fabric, ' '.join(_IMB_BENCHMARKS),
+                        _IMB_MSGLOG)]
+                coordination_cmdline = [
+                    'bash $AZ_BATCH_TASK_SHARED_DIR/coordination-cmd']
+                multi_task_helpers.add_task(
+                    batch_client, job_id, task_id, node_count,
+                    common.helpers.wrap_commands_in_shell(
+                        _OS_NAME, application_cmdline),
+                    input_files, batchmodels.ElevationLevel.admin,
+                    _TASK_OUTPUT_FILE_PATH_ON_VM, output_container_sas,
+                    common.helpers.wrap_commands_in_shell(
+                        _OS_NAME, coordination_cmdline),
+                    common_files)
+                multi_task_helpers.wait_for_tasks_to_complete(
+                    batch_client, job_id,
+                    datetime.timedelta(minutes=MAX_RUNTIME))
+
+                stdout = common.helpers.read_task_file_as_string(
+                    batch_client, job_id, task_id, 'stdout.txt')
+                task_records = common.imb.make_run_records(
+                    _RUN_ID, vm_size, node_count, fabric, stdout)
+                if not task_records:
+                    logger.warning('No IMB results in the output of task '
+                                   '{}'.format(task_id))
+                records.extend(task_records)
+    finally:
+        logger.info('Deleting job and pool {}...'.format(pool_id))
+        try:
+            batch_client.job.delete(job_id)
+        except batchmodels.BatchErrorException:
+            pass
+        batch_client.pool.delete(pool_id)
+    return records
+
+
+if __name__ == '__main__':
+
+    start_time = datetime.datetime.now().replace(microsecond=0)
+    logger.info('Benchmark start: {}'.format(start_time))
+
+    blob_client = azureblob.BlockBlobService(
+        account_name=_STORAGE_ACCOUNT_NAME, account_key=_STORAGE_ACCOUNT_KEY)
+
+    input_container_name = common.helpers.generate_unique_resource_name(
+        'input-{}'.format(_APP_NAME))
+    output_container_name = common.helpers.generate_unique_resource_name(
+        'output-{}'.format(_APP_NAME))
+
+    output_container_sas = common.helpers.create_container_and_create_sas(
+        blob_client,
+        output_container_name,
+        BlobPermissions.WRITE,
+        expiry=None,
+        timeout=_SWEEP_TIMEOUT)
+    output_container_sas = 'https://{}.blob.core.windows.net/{}?{}'.format(
+        _STORAGE_ACCOUNT_NAME, output_container_name, output_container_sas)
+
+    # The application command runs in the task working directory of the
+    # primary, the coordination command lands in the task shared directory
+    # of every node
+    input_files = common.helpers.upload_files_to_container(
+        blob_client, input_container_name,
+        [os.path.realpath(JOB_PATH + '/application-cmd')],
+        timeout=_SWEEP_TIMEOUT)
+    common_files = common.helpers.upload_files_to_container(
+        blob_client, input_container_name,
+        [os.path.realpath(JOB_PATH + '/coordination-cmd')],
+        timeout=_SWEEP_TIMEOUT)
+
+    print('Sweep {}: VM sizes {}, node counts {}, fabrics {}'.format(
+        _RUN_ID, _VM_SIZES, _NODE_COUNTS, _FABRICS))
+    if common.helpers.query_yes_no('Proceed with batch pool creation?') == 'no':
+        raise SystemExit
+
+    credentials = batchauth.SharedKeyCredentials(_BATCH_ACCOUNT_NAME, _BATCH_ACCOUNT_KEY)
+    batch_client = batch.BatchServiceClient(credentials, _BATCH_ACCOUNT_URL)
+
+    history = common.imb.load_history()
+    records = []
+    for vm_size in _VM_SIZES:
+        vm_records = run_vm_size(
+            batch_client, vm_size, input_files, common_files,
+            output_container_sas)
+        # keep what was measured even if a later VM size fails
+        common.imb.append_history(vm_records)
+        records.extend(vm_records)
+
+    regressions = []
+    for record in records:
+        print(common.imb.format_record(record))
+        print()
+        for regression in common.imb.find_regressions(
+                record, history, tolerance=_REGRESSION_TOLERANCE,
+                baseline_runs=_BASELINE_RUNS):
+            regression.update(
+                (key, record[key])
+                for key in ('vm_size', 'node_count', 'fabric', 'processes'))
+            regressions.append(regression)
+
+    for regression in regressions:
+        logger.warning(
+            'Regression: {benchmark} on {node_count} x {vm_size} ({fabric}, '
+            '{processes} processes) at {bytes} bytes: {metric} {value:.2f} '
+            'vs baseline {baseline:.2f} ({change:.0%} worse)'.format(**regression))
+
+    end_time = datetime.datetime.now().replace(microsecond=0)
+    logger.info('Benchmark end: {}'.format(end_time))
+    logger.info('Elapsed time: {}'.format(end_time - start_time))
+    logger.info('{} record(s) added to {}'.format(
+        len(records), common.imb.get_history_path()))
+
+    blob_client.delete_container(input_container_name)
+
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,460 @@
+from __future__ import print_function
+import argparse
+import configparser
+import re
+
+import common.sweep
+
+
+_SAMPLE_INTERVAL = 30
+_SAMPLE_WINDOW_MINUTES = 5
+_MIN_EVALUATION_MINUTES = 5
+
+_AUTOSCALE_FORMULA = """\
+$samples = $ActiveTasks.GetSamplePercent(TimeInterval_Minute * {window});
+$active = max(0, $ActiveTasks.GetSample(1));
+$running = max(0, $RunningTasks.GetSample(1));
+$demand = ($active + $running) * {nodes_per_task};
+$recent = $samples < 70 ? $demand : (avg($ActiveTasks.GetSample(TimeInterval_Minute * {window})) + avg($RunningTasks.GetSample(TimeInterval_Minute * {window}))) * {nodes_per_task};
+$wanted = max($demand, min($TargetDedicatedNodes, $recent));
+$TargetDedicatedNodes = max({min_nodes}, min($wanted, {max_nodes}));
+$NodeDeallocationOption = taskcompletion;
+"""
+_FIXED_SIZE_FORMULA = """\
+$TargetDedicatedNodes = {dedicated_nodes};
+$TargetLowPriorityNodes = {low_priority_nodes};
+$NodeDeallocationOption = taskcompletion;
+"""
+_IDLE_TTL_FORMULA = """\
+$idle_samples = $ActiveTasks.GetSamplePercent(TimeInterval_Minute * {ttl});
+$idle = $idle_samples < 70 ? 0 : max(0, $ActiveTasks.GetSample(TimeInterval_Minute * {ttl})) + max(0, $RunningTasks.GetSample(TimeInterval_Minute * {ttl})) == 0;
+$TargetDedicatedNodes = $idle ? 0 : $TargetDedicatedNodes;
+$TargetLowPriorityNodes = $idle ? 0 : $TargetLowPriorityNodes;
+"""
+
+
+def build_autoscale_formula(min_nodes, max_nodes, nodes_per_task=1,
+                            window_minutes=_SAMPLE_WINDOW_MINUTES):
+    """Builds an autoscale formula sizing the pool for the task backlog.
+
+    Every active (queued) or running task asks for nodes_per_task nodes.
+    The pool grows to the current demand at once, but only shrinks to the
+    demand averaged over the window, so a draining backlog does not
+    release nodes too early. Nodes are only released once their task
+    completed.
+
+    :param int min_nodes: The minimum number of dedicated nodes.
+    :param int max_nodes: The maximum number of dedicated nodes.
+    :param int nodes_per_task: Nodes used by each task, ie the
+        number_of_instances of a multi-instance task.
+    :param int window_minutes: The smoothing window of scale-down.
+    :rtype: str
+    """
+    if not 0 <= min_nodes <= max_nodes:
+        raise ValueError('invalid autoscale range {}..{}'.format(
+            min_nodes, max_nodes))
+    return _AUTOSCALE_FORMULA.format(
+        min_nodes=min_nodes, max_nodes=max_nodes,
+        nodes_per_task=nodes_per_task, window=window_minutes)
+
+
+def build_fixed_size_formula(dedicated_nodes, low_priority_nodes=0):
+    """Builds a formula keeping the pool at a fixed size, as a base for
+    add_idle_ttl.
+
+    :param int dedicated_nodes: The number of dedicated nodes.
+    :param int low_priority_nodes: The number of low-priority nodes.
+    :rtype: str
+    """
+    return _FIXED_SIZE_FORMULA.format(
+        dedicated_nodes=int(dedicated_nodes),
+        low_priority_nodes=int(low_priority_nodes))
+
+
+def add_idle_ttl(formula, idle_ttl_minutes):
+    """Extends a formula so that the pool shrinks to no nodes once no task
+    was queued or running for the idle TTL. The pool itself is kept, the
+    first task queued on it again brings the targets of formula back.
+
+    :param str formula: The formula sizing the pool while it is in use.
+    :param int idle_ttl_minutes: How long the pool may stay idle.
+    :rtype: str
+    """
+    if idle_ttl_minutes <= 0:
+        raise ValueError('invalid idle TTL {}'.format(idle_ttl_minutes))
+    return formula + _IDLE_TTL_FORMULA.format(ttl=int(idle_ttl_minutes))
+
+
+class _Interval(object):
+    """A TimeInterval_* value, in seconds"""
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class _Metric(object):
+    """A sampled system metric such as $ActiveTasks"""
+    def __init__(self, samples, now):
+        self.samples = samples
+        self.now = now
+
+    def GetSample(self, which):
+        if isinstance(which, _Interval):
+            return [value for time, value in self.samples
+                    if time > self.now - which.seconds]
+        count = int(which)
+        return [value for _, value in self.samples[-count:]] if count else []
+
+    def GetSamplePercent(self, interval):
+        expected = max(1, interval.seconds // _SAMPLE_INTERVAL)
+        return min(100.0, 100.0 * len(self.GetSample(interval)) / expected)
+
+
+def _flatten(values):
+    flat = []
+    for value in values:
+        if isinstance(value, list):
+            flat.extend(value)
+        else:
+            flat.append(value)
+    return flat
+
+
+_FUNCTIONS = {
+    'max': lambda *args: max(_flatten(args)),
+    'min': lambda *args: min(_flatten(args)),
+    'avg': lambda *args: (sum(_flatten(args)) / len(_flatten(args))
+                          if _flatten(args) else 0.0),
+    'sum': lambda *args: sum(_flatten(args)),
+    'count': lambda *args: len(_flatten(args)),
+}
+_CONSTANTS = {
+    'TimeInterval_Second': _Interval(1),
+    'TimeInterval_Minute': _Interval(60),
+    'TimeInterval_Hour': _Interval(3600),
+}
+_TOKEN = re.compile(r'\s*(?:(\d+(?:\.\d*)?)|(\$\w+)|(\w+)|'
+                    r'(&&|\|\||[<>=!]=|[-+*/()?:;,.<>=!]))')
+
+
+def _tokenize(formula):
+    tokens = []
+    position = 0
+    formula = formula.rstrip()
+    while position < len(formula):
+        match = _TOKEN.match(formula, position)
+        if match is None:
+            raise ValueError('cannot parse formula at {!r}'.format(
+                formula[position:position + 20]))
+        number, variable, name, operator = match.groups()
+        if number is not None:
+            tokens.append(('number', float(number)))
+        elif variable is not None:
+            tokens.append(('variable', variable))
+        elif name is not None:
+            tokens.append(('name', name))
+        else:
+            tokens.append(('op', operator))
+        position = match.end()
+    return tokens
+
+
+class _Evaluator(object):
+    """Recursive descent evaluator for the subset of the Batch autoscale
+    formula language used by build_autoscale_formula: assignments, the
+    ternary operator, arithmetic, comparisons, &&/||, max/min/avg/sum/count
+    and GetSample/GetSamplePercent on the task metrics.
+    """
+    def __init__(self, formula, variables):
+        self.tokens = _tokenize(formula)
+        self.position = 0
+        self.variables = variables
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def _expect(self, value):
+        token = self._next()
+        if token != ('op', value):
+            raise ValueError('expected {!r}, found {!r}'.format(value, token))
+
+    def run(self):
+        while self._peek()[0] is not None:
+            kind, name = self._next()
+            if kind != 'variable':
+                raise ValueError('expected an assignment, found {!r}'.format(
+                    name))
+            self._expect('=')
+            self.variables[name] = self._expression()
+            if self._peek() == ('op', ';'):
+                self._next()
+        return self.variables
+
+    def _expression(self):
+        condition = self._binary(0)
+        if self._peek() == ('op', '?'):
+            self._next()
+            when_true = self._expression()
+            self._expect(':')
+            when_false = self._expression()
+            return when_true if condition else when_false
+        return condition
+
+    _PRECEDENCE = (
+        ('||',), ('&&',), ('==', '!=', '<', '<=', '>', '>='), ('+', '-'),
+        ('*', '/'))
+
+    def _binary(self, level):
+        if level == len(self._PRECEDENCE):
+            return self._unary()
+        left = self._binary(level + 1)
+        while (self._peek()[0] == 'op' and
+               self._peek()[1] in self._PRECEDENCE[level]):
+            operator = self._next()[1]
+            right = self._binary(level + 1)
+            left = self._apply(operator, left, right)
+        return left
+
+    @staticmethod
+    def _apply(operator, left, right):
+        if isinstance(left, _Interval) or isinstance(right, _Interval):
+            if operator == '*':
+                interval, factor = ((left, right) if isinstance(left, _Interval)
+                                    else (right, left))
+                return _Interval(interval.seconds * factor)
+            raise ValueError('unsupported interval operation {}'.format(
+                operator))
+        return {
+            '||': lambda: float(bool(left) or bool(right)),
+            '&&': lambda: float(bool(left) and bool(right)),
+            '==': lambda: float(left == right),
+            '!=': lambda: float(left != right),
+            '<': lambda: float(left < right),
+            '<=': lambda: float(left <= right),
+            '>': lambda: float(left > right),
+            '>=': lambda: float(left >= right),
+            '+': lambda: left + right,
+            '-': lambda: left - right,
+            '*': lambda: left * right,
+            '/': lambda: left / right,
+        }[operator]()
+
+    def _unary(self):
+        if self._peek() == ('op', '-'):
+            self._next()
+            return -self._unary()
+        if self._peek() == ('op', '!'):
+            self._next()
+            return float(not self._unary())
+        value = self._primary()
+        while self._peek() == ('op', '.'):
+            self._next()
+            method = self._next()[1]
+            value = getattr(value, method)(*self._arguments())
+        return value
+
+    def _arguments(self):
+        self._expect('(')
+        arguments = []
+        if self._peek() != ('op', ')'):
+            arguments.append(self._expression())
+            while self._peek() == ('op', ','):
+                self._next()
+                arguments.append(self._expression())
+        self._expect(')')
+        return arguments
+
+    def _primary(self):
+        kind, value = self._next()
+        if kind == 'number':
+            return value
+        if kind == 'variable':
+            if value not in self.variables:
+                raise ValueError('unknown variable {}'.format(value))
+            return self.variables[value]
+        if kind == 'name':
+            if value in _FUNCTIONS:
+                return _FUNCTIONS[value](*self._arguments())
+            return _CONSTANTS.get(value, value)
+        if (kind, value) == ('op', '('):
+            result = self._expression()
+            self._expect(')')
+            return result
+        raise ValueError('unexpected {!r}'.format(value))
+
+
+def evaluate_formula(formula, metrics, now, target_dedicated_nodes=0,
+                     current_dedicated_nodes=0, target_low_priority_nodes=0,
+                     current_low_priority_nodes=0):
+    """Evaluates an autoscale formula locally.
+
+    :param str formula: The autoscale formula.
+    :param dict metrics: metric name without $, eg 'ActiveTasks' -> list of
+        (time in seconds, value) samples, oldest first
+    :param float now: The current time in seconds.
+    :param int target_dedicated_nodes: The current target of the pool.
+    :param int current_dedicated_nodes: The nodes currently in the pool.
+    :param int target_low_priority_nodes: The current low-priority target.
+    :param int current_low_priority_nodes: The low-priority nodes currently
+        in the pool.
+    :rtype: dict
+    :return: Every variable after the evaluation, eg
+        result['$TargetDedicatedNodes']
+    """
+    variables = {
+        '$TargetDedicatedNodes': float(target_dedicated_nodes),
+        '$CurrentDedicatedNodes': float(current_dedicated_nodes),
+        '$TargetLowPriorityNodes': float(target_low_priority_nodes),
+        '$CurrentLowPriorityNodes': float(current_low_priority_nodes),
+        '$NodeDeallocationOption': 'requeue',
+    }
+    for name, samples in metrics.items():
+        variables['$' + name] = _Metric(samples, now)
+    return _Evaluator(formula, variables).run()
+
+
+def simulate(formula, tasks, evaluation_interval_minutes=5,
+             allocation_minutes=5, horizon_hours=48, initial_nodes=0):
+    """Simulates an autoscaling pool running a set of tasks.
+
+    Metrics are sampled every 30 seconds and the formula is evaluated every
+    evaluation interval. New nodes become usable allocation_minutes after
+    the target grows; surplus nodes are released once idle. Tasks start in
+    submission order as soon as enough nodes are idle.
+
+    :param str formula: The autoscale formula.
+    :param list tasks: (submit minute, duration minutes, nodes) per task
+    :param int evaluation_interval_minutes: The evaluation interval.
+    :param int allocation_minutes: Time for a new node to become usable.
+    :param int horizon_hours: The simulation stops after this time.
+    :param int initial_nodes: Nodes in the pool at the start.
+    :rtype: dict
+    :return: makespan_minutes, node_hours, mean_wait_minutes,
+        unfinished (task count) and timeline, a list of (minute, target,
+        nodes, active, running)
+    """
+    step = _SAMPLE_INTERVAL
+    queue = sorted((submit * 60.0, duration * 60.0, nodes, index)
+                   for index, (submit, duration, nodes) in enumerate(tasks))
+    waiting = []
+    running = []          # (end time, nodes)
+    idle_nodes = initial_nodes
+    busy_nodes = 0
+    allocating = []       # ready times
+    target = initial_nodes
+    metrics = {'ActiveTasks': [], 'RunningTasks': [], 'PendingTasks': []}
+    waits = []
+    timeline = []
+    node_seconds = 0.0
+    finished = 0
+    makespan = 0.0
+
+    now = 0.0
+    while now <= horizon_hours * 3600:
+        while queue and queue[0][0] <= now:
+            waiting.append(queue.pop(0))
+        for end, nodes in [entry for entry in running if entry[0] <= now]:
+            running.remove((end, nodes))
+            busy_nodes -= nodes
+            idle_nodes += nodes
+            finished += 1
+            makespan = end
+        ready = [time for time in allocating if time <= now]
+        allocating = [time for time in allocating if time > now]
+        idle_nodes += len(ready)
+
+        # release surplus nodes once idle
+        surplus = idle_nodes + busy_nodes + len(allocating) - int(target)
+        if surplus > 0:
+            cancelled = min(surplus, len(allocating))
+            allocating = allocating[:len(allocating) - cancelled]
+            idle_nodes -= min(surplus - cancelled, idle_nodes)
+
+        while waiting and waiting[0][2] <= idle_nodes:
+            submit, duration, nodes, _ = waiting.pop(0)
+            idle_nodes -= nodes
+            busy_nodes += nodes
+            running.append((now + duration, nodes))
+            waits.append(now - submit)
+
+        if now % step == 0:
+            metrics['ActiveTasks'].append((now, float(len(waiting))))
+            metrics['RunningTasks'].append((now, float(len(running))))
+            metrics['PendingTasks'].append(
+                (now, float(len(waiting) + len(running))))
+        if now % (evaluation_interval_minutes * 60) == 0:
+            result = evaluate_formula(
+                formula, metrics, now, target_dedicated_nodes=target,
+                current_dedicated_nodes=idle_nodes + busy_nodes)
+            target = max(0, int(result['$TargetDedicatedNodes']))
+            missing = (target - idle_nodes - busy_nodes - len(allocating))
+            allocating.extend([now + allocation_minutes * 60] *
+                              max(0, missing))
+            timeline.append((now / 60, target, idle_nodes + busy_nodes,
+                             len(waiting), len(running)))
+
+        node_seconds += (idle_nodes + busy_nodes) * step
+        if not queue and not waiting and not running and finished:
+            break
+        now += step
+
+    return {
+        'makespan_minutes': makespan / 60,
+        'node_hours': node_seconds / 3600,
+        'mean_wait_minutes': (sum(waits) / len(waits) / 60) if waits else 0,
+        'unfinished': len(tasks) - finished,
+        'timeline': timeline,
+    }
+
+
+def format_simulation(result):
+    """Formats a simulation result as a timeline table and a summary
+
+    :param dict result: The result of simulate.
+    :rtype: str
+    """
+    lines = ['{:>8} {:>7} {:>6} {:>7} {:>8}'.format(
+        'minute', 'target', 'nodes', 'queued', 'running')]
+    lines.extend('{:>8.0f} {:>7} {:>6} {:>7} {:>8}'.format(*entry)
+                 for entry in result['timeline'])
+    lines.append('makespan {:.0f} min, {:.1f} node hours, mean wait {:.1f} '
+                 'min, {} unfinished task(s)'.format(
+                     result['makespan_minutes'], result['node_hours'],
+                     result['mean_wait_minutes'], result['unfinished']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulate the autoscale formula of a job configuration')
+    parser.add_argument('config', help='path of the job config.ini')
+    parser.add_argument('--tasks', type=int, default=20,
+                        help='number of tasks submitted at the start')
+    parser.add_argument('--task-minutes', type=float, default=30,
+                        help='duration of each task')
+    parser.add_argument('--allocation-minutes', type=float, default=5,
+                        help='time for a new node to become usable')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    nodes_per_task = common.sweep.get_nodes_per_task(
+        config, common.sweep.expand_sweep(config))
+    interval = config.getint(
+        'pool', 'CFG_AUTOSCALE_INTERVAL_MINUTES',
+        fallback=_MIN_EVALUATION_MINUTES)
+    formula = build_autoscale_formula(
+        config.getint('pool', 'CFG_AUTOSCALE_MIN_NODES', fallback=0),
+        config.getint('pool', 'CFG_AUTOSCALE_MAX_NODES', fallback=8),
+        nodes_per_task)
+    print(formula)
+    print(format_simulation(simulate(
+        formula, [(0, args.task_minutes, nodes_per_task)] * args.tasks,
+        evaluation_interval_minutes=interval,
+        allocation_minutes=args.allocation_minutes)))
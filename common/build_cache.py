@@ -0,0 +1,138 @@
+from __future__ import print_function
+import hashlib
+import os
+
+import azure.batch.models as batchmodels
+import azure.storage.blob as azureblob
+
+import common.helpers
+
+
+_ARCHIVE_SUFFIX = '.tar.gz'
+# Name of the fetched or packed artifact on the nodes
+_ARTIFACT_FILE_NAME = 'hpc-dfo-build' + _ARCHIVE_SUFFIX
+# Set to 1 on the nodes when the artifact was unpacked, so the preparation
+# script can skip the build packages and the compile
+_PREBUILT_ENV_NAME = 'HPC_DFO_PREBUILT'
+
+
+def _iter_source_files(job_path, source_paths):
+    for source_path in source_paths:
+        path = os.path.join(job_path, source_path)
+        if os.path.isfile(path):
+            yield path
+            continue
+        if not os.path.isdir(path):
+            raise ValueError('build source {} does not exist'.format(path))
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                yield os.path.join(dirpath, filename)
+
+
+def get_build_key(job_path, source_paths, image, mpi_flavor,
+                  artifact_paths=()):
+    """Builds the cache key of a build: a digest of the sources, the OS
+    image and the MPI flavor.
+
+    :param str job_path: The job directory.
+    :param list source_paths: The files and directories, relative to
+        job_path, whose content the build depends on, including the
+        preparation script which installs the packages and compiles.
+    :param tuple image: (publisher, offer, sku) of the node OS image.
+    :param str mpi_flavor: The MPI implementation built against, eg mpich
+    :param list artifact_paths: The paths of the packed build outputs, part
+        of the key so changing them does not reuse an older artifact.
+    :rtype: str
+    :return: A key usable as a blob name, eg centos-7.6-mpich-0123abcd...
+    """
+    digest = hashlib.sha1()
+    for file_path in sorted(set(_iter_source_files(job_path, source_paths))):
+        digest.update('{}={}\n'.format(
+            os.path.relpath(file_path, job_path).replace(os.sep, '/'),
+            common.helpers.compute_file_hash(file_path)).encode('utf-8'))
+    digest.update('image={}\nmpi={}\nartifacts={}\n'.format(
+        '/'.join(image), mpi_flavor,
+        ','.join(artifact_paths)).encode('utf-8'))
+    _, offer, sku = image
+    prefix = '-'.join((offer, sku, mpi_flavor)).lower()
+    prefix = ''.join(c if c.isalnum() or c in '.-' else '-' for c in prefix)
+    return '{}-{}'.format(prefix, digest.hexdigest()[:16])
+
+
+class BuildCache(object):
+    """The cached build artifact of a job, looked up by get_build_key.
+
+    On a hit the artifact is fetched as a resource file and unpacked before
+    the preparation script runs, with HPC_DFO_PREBUILT=1 so that the script
+    skips the build packages and the compile. On a miss the nodes build as
+    usual and the primary packs the artifact paths and uploads them, so the
+    next run with the same key starts from the prebuilt binaries.
+    """
+    def __init__(self, blob_client, container_name, key, artifact_paths,
+                 timeout=120):
+        self.container_name = container_name
+        self.key = key
+        self.blob_name = key + _ARCHIVE_SUFFIX
+        self.artifact_paths = list(artifact_paths)
+        blob_client.create_container(container_name, fail_on_exist=False)
+        self.hit = blob_client.exists(container_name, self.blob_name)
+        if self.hit:
+            print('Build cache hit: [{}]{}'.format(
+                container_name, self.blob_name))
+            self.fetch_url = common.helpers.create_blob_sas_url(
+                blob_client, container_name, self.blob_name, timeout=timeout)
+            self.upload_url = None
+        else:
+            print('Build cache miss: [{}]{}, the nodes will build it'.format(
+                container_name, self.blob_name))
+            self.fetch_url = None
+            self.upload_url = blob_client.make_blob_url(
+                container_name, self.blob_name,
+                sas_token=common.helpers.create_sas_token(
+                    blob_client, container_name, self.blob_name,
+                    azureblob.BlobPermissions.CREATE |
+                    azureblob.BlobPermissions.WRITE, timeout=timeout))
+
+    def get_resource_files(self):
+        """Returns the resource files fetching the artifact on a hit
+
+        :rtype: list
+        :return: A list of `azure.batch.models.ResourceFile`, empty on a miss
+        """
+        if not self.hit:
+            return []
+        return [batchmodels.ResourceFile(
+            file_path=_ARTIFACT_FILE_NAME, http_url=self.fetch_url)]
+
+    def get_prepare_commands(self, directory=''):
+        """Builds the node commands to run before the preparation script
+
+        :param str directory: Where the resource files land on the node,
+            with a trailing slash, eg '$AZ_BATCH_TASK_SHARED_DIR/'
+        :rtype: list
+        """
+        if not self.hit:
+            return ['export {}=0'.format(_PREBUILT_ENV_NAME)]
+        return ['tar -xzf {}{}'.format(directory, _ARTIFACT_FILE_NAME),
+                'export {}=1'.format(_PREBUILT_ENV_NAME)]
+
+    def get_publish_commands(self):
+        """Builds the node commands to run after the preparation script in
+        the coordination command, which upload the freshly built artifact
+        from the primary only. The upload is conditional, so a concurrent
+        run which published the same key first is kept. A failed upload does
+        not fail the task.
+
+        :rtype: list
+        """
+        if self.hit:
+            return []
+        return [
+            'if [ "$AZ_BATCH_IS_CURRENT_NODE_MASTER" = true ]; then '
+            'tar -czf {archive} {paths} && '
+            'curl -sSf -X PUT -H "x-ms-blob-type: BlockBlob" '
+            '-H "If-None-Match: *" -T {archive} "{url}" || '
+            'echo "Build cache upload failed or already published"; fi'.format(
+                archive=_ARTIFACT_FILE_NAME,
+                paths=' '.join(self.artifact_paths), url=self.upload_url)]
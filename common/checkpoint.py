@@ -0,0 +1,167 @@
+from __future__ import print_function
+import azure.storage.blob as azureblob
+
+import common.helpers
+
+
+# Files the node commands keep in the task working directory
+_ARCHIVE_FILE_NAME = '.hpc-dfo-checkpoint.tar.gz'
+_LATEST_FILE_NAME = '.hpc-dfo-checkpoint-latest'
+_DIGEST_FILE_NAME = '.hpc-dfo-checkpoint-digest'
+_STOP_FILE_NAME = '.hpc-dfo-checkpoint-stop'
+# Blob naming the newest checkpoint of a task, written after the checkpoint
+_LATEST_BLOB_NAME = 'latest'
+# Set to 1 on the node when a checkpoint was restored, so the application
+# script can restart from it instead of starting cold
+_RESTART_ENV_NAME = 'HPC_DFO_RESTART'
+_PREFIX_ENV_NAME = 'HPC_DFO_CHECKPOINT_PREFIX'
+# Restart files modified more recently than this are still being written
+_SETTLE_SECONDS = 30
+
+
+class Checkpoint(object):
+    """Periodic checkpoints of the restart files of the tasks of a run.
+
+    While the application runs, a background loop on the primary node packs
+    the files matching the patterns every interval and uploads them to
+    <container>/<name>/<member>/checkpoint-<time>.tar.gz, then points the
+    <member>/latest blob at it and deletes the previous checkpoint. Nothing
+    is uploaded while the files are unchanged or still being written.
+    Before the application starts, the newest checkpoint is restored into
+    the working directory and HPC_DFO_RESTART is set to 1, so a task which
+    Batch requeues after losing its node, or retries after a failure,
+    resumes where the last checkpoint left off. A later run with the same
+    name resumes the same way.
+    """
+    def __init__(self, blob_client, container_name, name, file_patterns,
+                 interval_minutes=15, timeout=120):
+        """
+        :param blob_client: A blob service client.
+        :type blob_client: `azure.storage.blob.BlockBlobService`
+        :param str container_name: The container of the checkpoints.
+        :param str name: The virtual directory of the run's checkpoints.
+        :param list file_patterns: shell patterns of the restart files,
+            relative to the task working directory
+        :param int interval_minutes: time between two checkpoints
+        :param int timeout: validity of the SAS token in minutes, it has to
+            cover every retry of the tasks
+        """
+        if not file_patterns:
+            raise ValueError('checkpoints need the patterns of the restart '
+                             'files')
+        self.container_name = container_name
+        self.name = name
+        self.file_patterns = list(file_patterns)
+        self.interval_seconds = int(interval_minutes * 60)
+        sas_token = common.helpers.create_container_and_create_sas(
+            blob_client, container_name,
+            azureblob.ContainerPermissions.READ +
+            azureblob.ContainerPermissions.WRITE +
+            azureblob.ContainerPermissions.DELETE, timeout=timeout)
+        container_url = common.helpers.make_container_sas_url(
+            blob_client, container_name, sas_token)
+        self._base_url, self._sas_token = container_url.split('?', 1)
+
+    def _url(self, blob_name):
+        return '"{}/${}/{}?{}"'.format(
+            self._base_url, _PREFIX_ENV_NAME, blob_name, self._sas_token)
+
+    def _put(self, file_name, blob_name):
+        return ('curl -sSf -X PUT -H "x-ms-blob-type: BlockBlob" '
+                '-T {} {}'.format(file_name, self._url(blob_name)))
+
+    def get_restore_commands(self):
+        """Builds the node commands to run before the application command:
+        they define the checkpoint function and restore the newest
+        checkpoint, if any.
+
+        :rtype: list
+        """
+        patterns = ' '.join(self.file_patterns)
+        return [
+            'export {}={}/${{HPC_DFO_MEMBER:-task}}'.format(
+                _PREFIX_ENV_NAME, self.name),
+            # packs the settled restart files and uploads them when they
+            # changed since the last checkpoint, a failure is only reported
+            'hpc_dfo_checkpoint() {{ '
+            'files=$(ls -d {patterns} 2>/dev/null || true); '
+            '[ -n "$files" ] || return 0; '
+            'if [ -n "$(find $files -newermt "{settle} seconds ago" '
+            '2>/dev/null)" ]; then echo "Restart files still being written, '
+            'checkpoint skipped"; return 0; fi; '
+            'digest=$(ls -l --full-time $files | md5sum); '
+            '[ "$digest" != "$(cat {digest_file} 2>/dev/null)" ] || return 0; '
+            'previous=$(cat {latest_file} 2>/dev/null || true); '
+            'name=checkpoint-$(date +%s).tar.gz; '
+            'tar -czf {archive} $files && {put_archive} && '
+            'echo $name > {latest_file} && {put_latest} && '
+            'echo "$digest" > {digest_file} && '
+            'echo "Checkpoint $name uploaded" && '
+            '{{ [ -z "$previous" ] || [ "$previous" = "$name" ] || '
+            'curl -sSf -X DELETE {previous_url} || true; }} || '
+            'echo "Checkpoint upload failed"; }}'.format(
+                patterns=patterns, settle=_SETTLE_SECONDS,
+                digest_file=_DIGEST_FILE_NAME, latest_file=_LATEST_FILE_NAME,
+                archive=_ARCHIVE_FILE_NAME,
+                put_archive=self._put(_ARCHIVE_FILE_NAME, '$name'),
+                put_latest=self._put(_LATEST_FILE_NAME, _LATEST_BLOB_NAME),
+                previous_url=self._url('$previous')),
+            'if name=$(curl -sSf {latest}) && '
+            'curl -sSf -o {archive} {checkpoint} && tar -xzf {archive}; then '
+            'echo $name > {latest_file}; echo "Restored $name"; '
+            'export {restart}=1; else echo "No checkpoint to restore"; '
+            'export {restart}=0; fi'.format(
+                latest=self._url(_LATEST_BLOB_NAME),
+                archive=_ARCHIVE_FILE_NAME, checkpoint=self._url('$name'),
+                latest_file=_LATEST_FILE_NAME,
+                restart=_RESTART_ENV_NAME),
+        ]
+
+    def get_start_commands(self):
+        """Builds the node commands starting the checkpoint loop in the
+        background, to run right before the application command. The loop
+        stops when the task shell exits, or after get_stop_commands.
+
+        :rtype: list
+        """
+        return [
+            'rm -f {stop}'.format(stop=_STOP_FILE_NAME),
+            'trap "touch $AZ_BATCH_TASK_WORKING_DIR/{stop}" EXIT'.format(
+                stop=_STOP_FILE_NAME),
+            # braced so the commands can be joined with ;
+            '{{ (i=0; while [ ! -e {stop} ]; do sleep 1; i=$((i+1)); '
+            'if [ $i -ge {interval} ]; then i=0; hpc_dfo_checkpoint; fi; '
+            'done) & }}'.format(stop=_STOP_FILE_NAME,
+                             interval=self.interval_seconds),
+        ]
+
+    def get_stop_commands(self):
+        """Builds the node commands to run after the application command,
+        which end the checkpoint loop so the task shell can exit.
+
+        :rtype: list
+        """
+        return ['touch {}'.format(_STOP_FILE_NAME)]
+
+    def list_checkpoints(self, blob_client):
+        """Lists the checkpoint blobs of the run
+
+        :param blob_client: A blob service client.
+        :type blob_client: `azure.storage.blob.BlockBlobService`
+        :rtype: list
+        :return: The blob names.
+        """
+        return [blob.name for blob in blob_client.list_blobs(
+            self.container_name, prefix=self.name + '/')]
+
+    def delete(self, blob_client):
+        """Deletes every checkpoint of the run
+
+        :param blob_client: A blob service client.
+        :type blob_client: `azure.storage.blob.BlockBlobService`
+        """
+        blob_names = self.list_checkpoints(blob_client)
+        for blob_name in blob_names:
+            blob_client.delete_blob(self.container_name, blob_name)
+        print('Deleted {} checkpoint blob(s) of [{}]{}/'.format(
+            len(blob_names), self.container_name, self.name))
@@ -0,0 +1,148 @@
+from __future__ import print_function
+import argparse
+import configparser
+import os
+import subprocess
+
+import azure.batch.models as batchmodels
+
+import common.helpers
+
+
+_DEFAULT_BASE_IMAGE = 'centos:7'
+# Set inside images built here, so the preparation script knows the
+# toolchain is already installed
+_IMAGE_ENV_NAME = 'HPC_DFO_CONTAINER_IMAGE'
+# MPI jobs talk to the other nodes and share memory between local ranks
+_DEFAULT_RUN_OPTIONS = '--net=host --ipc=host'
+
+
+def get_registry(registry_server, user_name, password):
+    """Builds the credentials of a private container registry
+
+    :param str registry_server: The registry, eg myregistry.azurecr.io, or
+        an empty string for public images.
+    :param str user_name: The user name.
+    :param str password: The password.
+    :rtype: `azure.batch.models.ContainerRegistry`
+    :return: The registry, None if no registry_server is given.
+    """
+    if not registry_server:
+        return None
+    if not user_name or not password:
+        raise ValueError(
+            'credentials are required for registry {}'.format(
+                registry_server))
+    return batchmodels.ContainerRegistry(
+        registry_server=registry_server, user_name=user_name,
+        password=password)
+
+
+def get_container_configuration(image_names, registry=None):
+    """Builds the container configuration of a pool. The images are pulled
+    by every node when it joins the pool, before it becomes idle.
+
+    :param list image_names: The images to prefetch.
+    :param registry: The registry the images are pulled from.
+    :type registry: `azure.batch.models.ContainerRegistry`
+    :rtype: `azure.batch.models.ContainerConfiguration`
+    """
+    return batchmodels.ContainerConfiguration(
+        container_image_names=list(image_names),
+        container_registries=[registry] if registry is not None else None)
+
+
+def get_task_container_settings(image_name, run_options=_DEFAULT_RUN_OPTIONS,
+                                registry=None):
+    """Builds the settings running a task (or start task) inside an image
+
+    :param str image_name: The image, prefetched by the pool.
+    :param str run_options: Extra docker create options.
+    :param registry: The registry the image is pulled from.
+    :type registry: `azure.batch.models.ContainerRegistry`
+    :rtype: `azure.batch.models.TaskContainerSettings`
+    """
+    return batchmodels.TaskContainerSettings(
+        image_name=image_name, container_run_options=run_options,
+        registry=registry)
+
+
+def render_dockerfile(packages, base_image=_DEFAULT_BASE_IMAGE, path_dirs=()):
+    """Renders the Dockerfile of an image with the job dependencies
+    installed, from a yum based base image.
+
+    :param list packages: The yum packages the job needs.
+    :param str base_image: The image to start from.
+    :param list path_dirs: Directories added to PATH, eg the MPI binaries.
+    :rtype: str
+    """
+    lines = [
+        'FROM {}'.format(base_image),
+        'RUN yum -y install epel-release && \\',
+        '    yum -y install {} && \\'.format(' '.join(packages)),
+        '    yum clean all',
+    ]
+    if path_dirs:
+        lines.append('ENV PATH=$PATH:{}'.format(':'.join(path_dirs)))
+    lines.append('ENV {}=1'.format(_IMAGE_ENV_NAME))
+    return '\n'.join(lines) + '\n'
+
+
+def build_image(image_name, dockerfile, push=False):
+    """Builds an image with the local docker daemon, and optionally pushes it
+    to its registry (after docker login).
+
+    :param str image_name: The name and tag of the image.
+    :param str dockerfile: The Dockerfile content.
+    :param bool push: push the image once built
+    :rtype: str
+    :return: The path of the Dockerfile, kept under ~/.hpc-dfo/images.
+    """
+    build_dir = os.path.dirname(common.helpers.get_local_state_path(
+        'images', image_name.replace('/', '_').replace(':', '_'),
+        'Dockerfile'))
+    dockerfile_path = os.path.join(build_dir, 'Dockerfile')
+    with open(dockerfile_path, 'w') as f:
+        f.write(dockerfile)
+
+    print('Building image {} from {}...'.format(image_name, dockerfile_path))
+    subprocess.check_call(['docker', 'build', '-t', image_name, build_dir])
+    if push:
+        print('Pushing image {}...'.format(image_name))
+        subprocess.check_call(['docker', 'push', image_name])
+    return dockerfile_path
+
+
+def get_dockerfile(config, section='container'):
+    """Renders the Dockerfile of the image of a job configuration
+
+    :param config: The job configuration.
+    :type config: `configparser.ConfigParser`
+    :param str section: The section holding the container settings.
+    :rtype: str
+    """
+    return render_dockerfile(
+        config.get(section, 'CFG_PACKAGES').split(),
+        base_image=config.get(
+            section, 'CFG_BASE_IMAGE', fallback=_DEFAULT_BASE_IMAGE),
+        path_dirs=config.get(section, 'CFG_PATH', fallback='').split())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the container image of a job configuration')
+    parser.add_argument('config', help='path of the job config.ini')
+    parser.add_argument('--push', action='store_true',
+                        help='push the image to its registry once built')
+    parser.add_argument('--print', action='store_true',
+                        help='only print the Dockerfile')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    dockerfile = get_dockerfile(config)
+    if args.print:
+        print(dockerfile, end='')
+    else:
+        build_image(config.get('container', 'CFG_IMAGE'), dockerfile,
+                    push=args.push)
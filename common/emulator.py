@@ -0,0 +1,1618 @@
+from __future__ import print_function
+import datetime
+import glob
+import hashlib
+import hmac
+import os
+import random
+import re
+import shlex
+import shutil
+import signal
+import subprocess
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import azure.batch.models as batchmodels
+from azure.common import (
+    AzureConflictHttpError,
+    AzureHttpError,
+    AzureMissingResourceHttpError,
+)
+from azure.storage.blob.models import (
+    Blob,
+    BlobBlock,
+    BlobBlockList,
+    BlobProperties,
+    BlockListType,
+)
+
+import common.autoscale
+import common.helpers
+
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# Staged blocks and partial writes live next to the containers, container
+# names cannot start with a dot
+_BLOCKS_DIR_NAME = '.blocks'
+_TEMP_DIR_NAME = '.tmp'
+_NODE_AGENT_SKU_ID = 'batch.node.emulator'
+_NODE_IP_ADDRESS = '127.0.0.1'
+_NODE_HOST_NAME = 'localhost'
+_WILDCARDS = re.compile(r'[*?\[]')
+_FILTER_CLAUSE = re.compile(r"^\s*([\w/]+)\s+(eq|ne)\s+'([^']*)'\s*$")
+# Images every emulated node accepts, as (publisher, offer, sku)
+_VERIFIED_IMAGES = (
+    ('OpenLogic', 'CentOS', '7.6'),
+    ('OpenLogic', 'CentOS-HPC', '7.4'),
+    ('OpenLogic', 'CentOS-HPC', '7.6'),
+    ('microsoft-azure-batch', 'centos-container', '7-6'),
+    ('Canonical', 'UbuntuServer', '18.04-LTS'),
+)
+
+
+def _utcnow():
+    return datetime.datetime.utcnow()
+
+
+def _batch_error(code, message):
+    """Builds the exception the Batch service raises for an error code"""
+    error = batchmodels.BatchError(
+        code=code, message=batchmodels.ErrorMessage(value=message))
+    return batchmodels.BatchErrorException(
+        lambda resp_type, response: error, None)
+
+
+def _matches(odata_filter, properties):
+    """Evaluates the subset of OData filters the project uses, clauses of
+    the form <property> eq|ne '<value>' joined by 'and'.
+
+    :param str odata_filter: The filter, None matches everything.
+    :param dict properties: property path -> value of the item
+    :rtype: bool
+    """
+    if not odata_filter:
+        return True
+    for clause in odata_filter.split(' and '):
+        match = _FILTER_CLAUSE.match(clause)
+        if match is None or match.group(1) not in properties:
+            raise _batch_error(
+                'InvalidQueryParameterValue',
+                'unsupported filter {!r}'.format(odata_filter))
+        name, operator, value = match.groups()
+        if (str(properties[name]) == value) != (operator == 'eq'):
+            return False
+    return True
+
+
+def _get_filter(options):
+    return getattr(options, 'filter', None) if options is not None else None
+
+
+class EmulatedBlobService(object):
+    """A filesystem-backed stand-in for `azure.storage.blob.BlockBlobService`.
+
+    Containers are directories of root and blobs are files, so the run's
+    inputs and outputs can be inspected directly. SAS tokens are signed
+    with a local key, and the URLs made from them are file:// URLs with the
+    token as query; the emulated Batch service checks the signature, expiry
+    and permissions before reading or writing through them.
+    """
+    protocol = 'file'
+
+    def __init__(self, root, latency=0.0, failure_rate=0.0,
+                 random_state=None):
+        """
+        :param str root: The directory holding the containers.
+        :param float latency: seconds added to every call
+        :param float failure_rate: probability of a call failing with a
+            ServerBusy error
+        :param random_state: The random generator of the failures.
+        :type random_state: `random.Random`
+        """
+        self.root = os.path.abspath(root)
+        self.primary_endpoint = self.root
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random_state or random.Random()
+        self._key = hashlib.sha256(self.root.encode('utf-8')).digest()
+        self._lock = threading.Lock()
+        for name in (_BLOCKS_DIR_NAME, _TEMP_DIR_NAME):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            raise AzureHttpError('ServerBusy: emulated failure', 503)
+
+    def _container_path(self, container_name, must_exist=True):
+        if not container_name or container_name.startswith('.') or \
+                '/' in container_name:
+            raise AzureHttpError(
+                'InvalidResourceName: {}'.format(container_name), 400)
+        path = os.path.join(self.root, container_name)
+        if must_exist and not os.path.isdir(path):
+            raise AzureMissingResourceHttpError(
+                'ContainerNotFound: {}'.format(container_name), 404)
+        return path
+
+    def _blob_path(self, container_name, blob_name):
+        parts = [part for part in blob_name.split('/') if part]
+        if not parts or any(part in ('.', '..') for part in parts):
+            raise AzureHttpError(
+                'InvalidResourceName: {}'.format(blob_name), 400)
+        return os.path.join(self._container_path(container_name), *parts)
+
+    def _existing_blob_path(self, container_name, blob_name):
+        path = self._blob_path(container_name, blob_name)
+        if not os.path.isfile(path):
+            raise AzureMissingResourceHttpError(
+                'BlobNotFound: {}/{}'.format(container_name, blob_name), 404)
+        return path
+
+    def _blocks_path(self, container_name, blob_name):
+        return os.path.join(
+            self.root, _BLOCKS_DIR_NAME, container_name,
+            hashlib.sha1(blob_name.encode('utf-8')).hexdigest())
+
+    def _write(self, container_name, blob_name, write):
+        """Atomically replaces a blob with what write(file) writes."""
+        path = self._blob_path(container_name, blob_name)
+        temp_path = os.path.join(self.root, _TEMP_DIR_NAME, uuid.uuid4().hex)
+        with open(temp_path, 'wb') as f:
+            write(f)
+        parent = os.path.dirname(path)
+        with self._lock:
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+        os.replace(temp_path, path)
+        shutil.rmtree(self._blocks_path(container_name, blob_name),
+                      ignore_errors=True)
+
+    @staticmethod
+    def _properties(path):
+        stat = os.stat(path)
+        properties = BlobProperties()
+        properties.content_length = stat.st_size
+        properties.etag = '"0x{:X}{:X}"'.format(
+            int(stat.st_mtime * 1e9), stat.st_size)
+        properties.last_modified = datetime.datetime.utcfromtimestamp(
+            stat.st_mtime)
+        return properties
+
+    def create_container(self, container_name, fail_on_exist=False,
+                         **kwargs):
+        self._call()
+        path = self._container_path(container_name, must_exist=False)
+        with self._lock:
+            if os.path.isdir(path):
+                if fail_on_exist:
+                    raise AzureConflictHttpError(
+                        'ContainerAlreadyExists: {}'.format(container_name),
+                        409)
+                return False
+            os.makedirs(path)
+        return True
+
+    def delete_container(self, container_name, fail_not_exist=False,
+                         **kwargs):
+        self._call()
+        path = self._container_path(container_name, must_exist=False)
+        if not os.path.isdir(path):
+            if fail_not_exist:
+                raise AzureMissingResourceHttpError(
+                    'ContainerNotFound: {}'.format(container_name), 404)
+            return False
+        shutil.rmtree(path)
+        shutil.rmtree(os.path.join(self.root, _BLOCKS_DIR_NAME,
+                                   container_name), ignore_errors=True)
+        return True
+
+    def exists(self, container_name, blob_name=None, **kwargs):
+        self._call()
+        path = self._container_path(container_name, must_exist=False)
+        if blob_name is None:
+            return os.path.isdir(path)
+        return os.path.isdir(path) and os.path.isfile(
+            self._blob_path(container_name, blob_name))
+
+    def list_blobs(self, container_name, prefix=None, **kwargs):
+        self._call()
+        container_path = self._container_path(container_name)
+        blobs = []
+        for dirpath, _, filenames in os.walk(container_path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, container_path).replace(
+                    os.sep, '/')
+                if prefix and not name.startswith(prefix):
+                    continue
+                blobs.append(Blob(name=name, props=self._properties(path)))
+        return sorted(blobs, key=lambda blob: blob.name)
+
+    def get_blob_properties(self, container_name, blob_name, **kwargs):
+        self._call()
+        path = self._existing_blob_path(container_name, blob_name)
+        return Blob(name=blob_name, props=self._properties(path))
+
+    def create_blob_from_path(self, container_name, blob_name, file_path,
+                              **kwargs):
+        self._call()
+        with open(file_path, 'rb') as source:
+            self._write(container_name, blob_name,
+                        lambda f: shutil.copyfileobj(source, f))
+
+    def create_blob_from_bytes(self, container_name, blob_name, blob,
+                               **kwargs):
+        self._call()
+        self._write(container_name, blob_name, lambda f: f.write(blob))
+
+    def get_blob_to_path(self, container_name, blob_name, file_path,
+                         **kwargs):
+        self._call()
+        shutil.copyfile(
+            self._existing_blob_path(container_name, blob_name), file_path)
+        return self.get_blob_properties(container_name, blob_name)
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range=None,
+                          end_range=None, if_match=None, **kwargs):
+        self._call()
+        path = self._existing_blob_path(container_name, blob_name)
+        properties = self._properties(path)
+        if if_match is not None and if_match != properties.etag:
+            raise AzureHttpError('ConditionNotMet', 412)
+        with open(path, 'rb') as f:
+            if start_range is None:
+                content = f.read()
+            else:
+                f.seek(start_range)
+                content = f.read(
+                    -1 if end_range is None else end_range - start_range + 1)
+        return Blob(name=blob_name, content=content, props=properties)
+
+    def delete_blob(self, container_name, blob_name, **kwargs):
+        self._call()
+        os.remove(self._existing_blob_path(container_name, blob_name))
+
+    def put_block(self, container_name, blob_name, block, block_id,
+                  validate_content=False, **kwargs):
+        self._call()
+        self._container_path(container_name)
+        blocks_path = self._blocks_path(container_name, blob_name)
+        with self._lock:
+            if not os.path.isdir(blocks_path):
+                os.makedirs(blocks_path)
+        block_path = os.path.join(
+            blocks_path, block_id.encode('utf-8').hex())
+        with open(block_path + '.tmp', 'wb') as f:
+            f.write(block)
+        os.replace(block_path + '.tmp', block_path)
+
+    def get_block_list(self, container_name, blob_name,
+                       block_list_type=BlockListType.Committed, **kwargs):
+        self._call()
+        blocks_path = self._blocks_path(container_name, blob_name)
+        block_list = BlobBlockList()
+        if os.path.isdir(blocks_path):
+            for filename in sorted(os.listdir(blocks_path)):
+                if filename.endswith('.tmp'):
+                    continue
+                block = BlobBlock(id=bytes.fromhex(filename).decode('utf-8'))
+                block.size = os.path.getsize(
+                    os.path.join(blocks_path, filename))
+                block_list.uncommitted_blocks.append(block)
+        elif not self.exists(container_name, blob_name):
+            raise AzureMissingResourceHttpError(
+                'BlobNotFound: {}/{}'.format(container_name, blob_name), 404)
+        return block_list
+
+    def put_block_list(self, container_name, blob_name, block_list,
+                       **kwargs):
+        self._call()
+        blocks_path = self._blocks_path(container_name, blob_name)
+
+        def _concatenate(f):
+            for block in block_list:
+                block_path = os.path.join(
+                    blocks_path, block.id.encode('utf-8').hex())
+                if not os.path.isfile(block_path):
+                    raise AzureHttpError(
+                        'InvalidBlockList: {}'.format(block.id), 400)
+                with open(block_path, 'rb') as source:
+                    shutil.copyfileobj(source, f)
+        self._write(container_name, blob_name, _concatenate)
+
+    def _sign(self, container_name, blob_name, permission, expiry):
+        return hmac.new(self._key, '\n'.join(
+            (container_name, blob_name, permission, expiry)).encode('utf-8'),
+            hashlib.sha256).hexdigest()
+
+    def _generate_sas(self, container_name, blob_name, permission, expiry):
+        if isinstance(expiry, datetime.datetime):
+            expiry = expiry.strftime(_TIME_FORMAT)
+        permission = str(permission)
+        return 'se={}&sp={}&sr={}&sig={}'.format(
+            quote(expiry), permission, 'b' if blob_name else 'c',
+            self._sign(container_name, blob_name, permission, expiry))
+
+    def generate_blob_shared_access_signature(
+            self, container_name, blob_name, permission=None, expiry=None,
+            **kwargs):
+        return self._generate_sas(container_name, blob_name, permission,
+                                  expiry)
+
+    def generate_container_shared_access_signature(
+            self, container_name, permission=None, expiry=None, **kwargs):
+        return self._generate_sas(container_name, '', permission, expiry)
+
+    def make_blob_url(self, container_name, blob_name, protocol=None,
+                      sas_token=None, **kwargs):
+        url = 'file://{}/{}/{}'.format(
+            self.root, container_name, quote(blob_name))
+        return url + '?' + sas_token if sas_token else url
+
+    def resolve_url(self, url, permission):
+        """Checks a SAS URL made by this service.
+
+        :param str url: A blob or container URL with its SAS token.
+        :param str permission: The permission letter needed, eg 'r' or 'w'
+        :rtype: tuple
+        :return: (container name, blob name), the blob name is empty for a
+            container URL
+        :raises AzureHttpError: if the URL is not from this store, or the
+            signature, expiry or permission does not allow the access
+        """
+        parts = urlsplit(url)
+        path = unquote(parts.path)
+        if parts.scheme != 'file' or not path.startswith(self.root + '/'):
+            raise AzureHttpError(
+                'InvalidUri: {} is not in {}'.format(url, self.root), 400)
+        container_name, _, blob_name = path[len(self.root) + 1:].partition(
+            '/')
+        query = {key: values[0] for key, values in parse_qs(
+            parts.query).items()}
+        try:
+            signed_blob_name = blob_name if query['sr'] == 'b' else ''
+            expected = self._sign(container_name, signed_blob_name,
+                                  query['sp'], query['se'])
+            expiry = datetime.datetime.strptime(query['se'], _TIME_FORMAT)
+        except (KeyError, ValueError):
+            raise AzureHttpError('AuthenticationFailed: {}'.format(url), 403)
+        if not hmac.compare_digest(expected, query['sig']):
+            raise AzureHttpError('AuthenticationFailed: {}'.format(url), 403)
+        if expiry < _utcnow():
+            raise AzureHttpError('AuthenticationFailed: SAS expired', 403)
+        if permission not in query['sp']:
+            raise AzureHttpError(
+                'AuthorizationPermissionMismatch: {}'.format(url), 403)
+        return container_name, blob_name
+
+    def download_url(self, url, destination_path):
+        """Copies the blob, or every blob of the container, a SAS URL
+        points to into a local file or directory.
+
+        :param str url: A blob or container SAS URL with read permission.
+        :param str destination_path: The file for a blob URL, the directory
+            for a container URL.
+        """
+        container_name, blob_name = self.resolve_url(url, 'r')
+        if blob_name:
+            sources = [(blob_name, destination_path)]
+        else:
+            sources = [
+                (blob.name, os.path.join(destination_path,
+                                         *blob.name.split('/')))
+                for blob in self.list_blobs(container_name)]
+        for name, path in sources:
+            parent = os.path.dirname(path)
+            if parent and not os.path.isdir(parent):
+                os.makedirs(parent)
+            self.get_blob_to_path(container_name, name, path)
+
+    def upload_to_url(self, container_url, blob_name, file_path):
+        """Writes a local file to a container through a SAS URL
+
+        :param str container_url: A container SAS URL with write permission.
+        :param str blob_name: The name of the blob to write.
+        :param str file_path: The local file.
+        """
+        container_name, _ = self.resolve_url(container_url, 'w')
+        self.create_blob_from_path(container_name, blob_name, file_path)
+
+
+class _Node(object):
+    """An emulated compute node, a directory tree of the emulator"""
+    def __init__(self, node_id, pool, root_dir, ready_at, is_dedicated=True):
+        self.id = node_id
+        self.pool = pool
+        self.root_dir = root_dir
+        self.is_dedicated = is_dedicated
+        self.state = batchmodels.ComputeNodeState.creating
+        self.allocation_time = _utcnow()
+        self.ready_at = ready_at
+        self.start_task_info = None
+        self.start_task_process = None
+        self.running_tasks = []
+        self.total_tasks_run = 0
+        self.removing = False
+        # when a low-priority node gets preempted, None for never
+        self.preempt_at = None
+
+
+class _Pool(object):
+    def __init__(self, spec, now):
+        self.spec = spec
+        self.id = spec.id
+        self.state = batchmodels.PoolState.active
+        self.allocation_state = batchmodels.AllocationState.resizing
+        # the SDK serializes numbers given as strings, as the runners do
+        self.target_dedicated_nodes = int(spec.target_dedicated_nodes or 0)
+        self.target_low_priority_nodes = int(
+            spec.target_low_priority_nodes or 0)
+        self.metadata = list(spec.metadata or [])
+        self.creation_time = _utcnow()
+        self.nodes = {}
+        self.next_node_index = 0
+        self.deleted_at = None
+        self.samples = {'ActiveTasks': [], 'RunningTasks': []}
+        self.next_sample = now
+        self.next_evaluation = now
+
+
+class _Task(object):
+    def __init__(self, spec, job):
+        self.spec = spec
+        self.id = spec.id
+        self.job = job
+        self.state = batchmodels.TaskState.active
+        self.creation_time = _utcnow()
+        self.instances = int(
+            spec.multi_instance_settings.number_of_instances
+            if spec.multi_instance_settings is not None else 1)
+        self._reset()
+        self.requeue_count = 0
+        self.retry_count = 0
+        self.max_retries = (spec.constraints.max_task_retry_count or 0
+                            if spec.constraints is not None else 0)
+
+    def _reset(self):
+        self.start_time = None
+        self.end_time = None
+        self.exit_code = None
+        self.failure_info = None
+        self.nodes = []
+        self.subtasks = []
+        self.processes = []
+        # bumped on every requeue, so a runner thread of an earlier attempt
+        # can tell its results are stale
+        self.attempt = getattr(self, 'attempt', 0) + 1
+
+
+class _Job(object):
+    def __init__(self, spec):
+        self.spec = spec
+        self.id = spec.id
+        self.pool_id = spec.pool_info.pool_id
+        self.state = batchmodels.JobState.active
+        self.creation_time = _utcnow()
+        self.tasks = {}
+        self.task_order = []
+
+
+class _Configuration(object):
+    def __init__(self, batch_url):
+        self.batch_url = batch_url
+
+
+class _Operations(object):
+    """Base of the emulated operation groups (client.pool, client.task...)"""
+    def __init__(self, service):
+        self._service = service
+
+    def _call(self):
+        self._service.before_call()
+
+
+class _AccountOperations(_Operations):
+    def list_node_agent_skus(self, *args, **kwargs):
+        self._call()
+        return [batchmodels.NodeAgentSku(
+            id=_NODE_AGENT_SKU_ID, os_type=batchmodels.OSType.linux,
+            verified_image_references=[
+                batchmodels.ImageReference(
+                    publisher=publisher, offer=offer, sku=sku,
+                    version='latest')
+                for publisher, offer, sku in _VERIFIED_IMAGES])]
+
+
+class _PoolOperations(_Operations):
+    def add(self, pool, *args, **kwargs):
+        self._call()
+        self._service.add_pool(pool)
+
+    def get(self, pool_id, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            return self._service.describe_pool(self._service.get_pool(pool_id))
+
+    def exists(self, pool_id, *args, **kwargs):
+        self._call()
+        return pool_id in self._service.pools
+
+    def list(self, pool_list_options=None, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            pools = [self._service.describe_pool(pool)
+                     for pool in self._service.pools.values()]
+        return [pool for pool in pools if _matches(
+            _get_filter(pool_list_options), {'state': pool.state.value})]
+
+    def delete(self, pool_id, *args, **kwargs):
+        self._call()
+        self._service.delete_pool(pool_id)
+
+    def patch(self, pool_id, pool_patch_parameter, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            pool = self._service.get_pool(pool_id)
+            if pool_patch_parameter.metadata is not None:
+                pool.metadata = list(pool_patch_parameter.metadata)
+            if pool_patch_parameter.start_task is not None:
+                # only nodes which join or reboot later run the new one
+                pool.spec.start_task = pool_patch_parameter.start_task
+
+    def resize(self, pool_id, pool_resize_parameter, *args, **kwargs):
+        self._call()
+        self._service.resize_pool(
+            pool_id, int(pool_resize_parameter.target_dedicated_nodes or 0),
+            int(pool_resize_parameter.target_low_priority_nodes or 0))
+
+    def remove_nodes(self, pool_id, node_remove_parameter, *args, **kwargs):
+        self._call()
+        self._service.remove_nodes(pool_id, node_remove_parameter.node_list)
+
+
+class _ComputeNodeOperations(_Operations):
+    def list(self, pool_id, compute_node_list_options=None, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            pool = self._service.get_pool(pool_id)
+            nodes = [self._service.describe_node(node)
+                     for node in pool.nodes.values()]
+        return [node for node in nodes if _matches(
+            _get_filter(compute_node_list_options),
+            {'state': node.state.value})]
+
+    def get(self, pool_id, node_id, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            return self._service.describe_node(
+                self._service.get_node(pool_id, node_id))
+
+    def reboot(self, pool_id, node_id, *args, **kwargs):
+        self._call()
+        self._service.restart_node(pool_id, node_id, reimage=False)
+
+    def reimage(self, pool_id, node_id, *args, **kwargs):
+        self._call()
+        self._service.restart_node(pool_id, node_id, reimage=True)
+
+
+class _JobOperations(_Operations):
+    def add(self, job, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            if job.id in self._service.jobs:
+                raise _batch_error(
+                    'JobExists', 'The specified job already exists.')
+            self._service.jobs[job.id] = _Job(job)
+
+    def get(self, job_id, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            return self._service.describe_job(self._service.get_job(job_id))
+
+    def list(self, job_list_options=None, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            jobs = [self._service.describe_job(job)
+                    for job in self._service.jobs.values()]
+        return [job for job in jobs if _matches(
+            _get_filter(job_list_options), {'state': job.state.value})]
+
+    def delete(self, job_id, *args, **kwargs):
+        self._call()
+        self._service.delete_job(job_id)
+
+
+class _TaskOperations(_Operations):
+    def add(self, job_id, task, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            job = self._service.get_job(job_id)
+            if task.id in job.tasks:
+                raise _batch_error(
+                    'TaskExists', 'The specified task already exists.')
+            self._service.add_task(job, task)
+
+    def add_collection(self, job_id, value, *args, **kwargs):
+        self._call()
+        if len(value) > 100:
+            raise _batch_error(
+                'RequestBodyTooLarge',
+                'The request body is too large and exceeds the maximum '
+                'permissible limit.')
+        results = []
+        with self._service.lock:
+            job = self._service.get_job(job_id)
+            for task in value:
+                if self._service.roll(self._service.api_failure_rate):
+                    results.append(batchmodels.TaskAddResult(
+                        status=batchmodels.TaskAddStatus.server_error,
+                        task_id=task.id, error=batchmodels.BatchError(
+                            code='ServerBusy', message=batchmodels.
+                            ErrorMessage(value='emulated failure'))))
+                elif task.id in job.tasks:
+                    results.append(batchmodels.TaskAddResult(
+                        status=batchmodels.TaskAddStatus.client_error,
+                        task_id=task.id, error=batchmodels.BatchError(
+                            code='TaskExists', message=batchmodels.
+                            ErrorMessage(value='The specified task already '
+                                         'exists.'))))
+                else:
+                    self._service.add_task(job, task)
+                    results.append(batchmodels.TaskAddResult(
+                        status=batchmodels.TaskAddStatus.success,
+                        task_id=task.id))
+        return batchmodels.TaskAddCollectionResult(value=results)
+
+    def get(self, job_id, task_id, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            return self._service.describe_task(
+                self._service.get_task(job_id, task_id))
+
+    def list(self, job_id, task_list_options=None, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            job = self._service.get_job(job_id)
+            tasks = [self._service.describe_task(job.tasks[task_id])
+                     for task_id in job.task_order]
+        return [task for task in tasks if _matches(
+            _get_filter(task_list_options), {
+                'state': task.state.value,
+                'executionInfo/result':
+                    task.execution_info.result.value
+                    if task.execution_info is not None and
+                    task.execution_info.result is not None else ''})]
+
+    def list_subtasks(self, job_id, task_id, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            task = self._service.get_task(job_id, task_id)
+            return batchmodels.CloudTaskListSubtasksResult(value=[
+                batchmodels.SubtaskInformation(
+                    id=subtask['id'], state=subtask['state'],
+                    start_time=subtask['start_time'],
+                    end_time=subtask['end_time'],
+                    exit_code=subtask['exit_code'],
+                    node_info=batchmodels.ComputeNodeInformation(
+                        pool_id=task.job.pool_id,
+                        node_id=subtask['node_id']))
+                for subtask in task.subtasks])
+
+
+class _FileOperations(_Operations):
+    @staticmethod
+    def _stream(path):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                yield chunk
+
+    def get_from_task(self, job_id, task_id, file_path, *args, **kwargs):
+        self._call()
+        with self._service.lock:
+            task = self._service.get_task(job_id, task_id)
+            if not task.nodes:
+                raise _batch_error(
+                    'TaskNotScheduled', 'The task has not run on a node.')
+            path = os.path.join(
+                self._service.get_task_dir(task.nodes[0], task), file_path)
+        if not os.path.isfile(path):
+            raise _batch_error(
+                'FileNotFound', 'The specified file does not exist.')
+        return self._stream(path)
+
+    def get_from_compute_node(self, pool_id, node_id, file_path, *args,
+                              **kwargs):
+        self._call()
+        with self._service.lock:
+            path = os.path.join(
+                self._service.get_node(pool_id, node_id).root_dir, file_path)
+        if not os.path.isfile(path):
+            raise _batch_error(
+                'FileNotFound', 'The specified file does not exist.')
+        return self._stream(path)
+
+
+class EmulatedBatchService(object):
+    """A local stand-in for `azure.batch.BatchServiceClient`, implementing
+    the pool, node, job, task, subtask and file operations this project
+    uses with the same models and error codes.
+
+    Nodes are directories under root/nodes with the usual Batch layout
+    (startup/, shared/, workitems/<job>/job-1/<task>/wd), and start tasks,
+    coordination and application commands run there as local processes
+    with the AZ_BATCH_* variables set. All the nodes of a multi-instance
+    task are on localhost, so $AZ_BATCH_HOST_LIST lets mpirun start every
+    rank locally. Resource files and output files go through the SAS URLs
+    of an `EmulatedBlobService`. Container settings are ignored, commands
+    run on the host. Failed tasks are rerun up to their max_task_retry_count,
+    and the tasks of removed, rebooted, reimaged or preempted nodes are
+    requeued.
+
+    Node allocation and boot take allocation_delay and boot_delay seconds
+    (with up to jitter of random extra), and nodes, tasks and API calls can
+    be made to fail at the given rates. Low-priority nodes are preempted
+    after a random time averaging preemption_interval seconds, and come
+    back as fresh nodes after preemption_duration seconds. A scheduler
+    thread moves the state along, call close() to stop it and kill the
+    running processes.
+    """
+    def __init__(self, blob_service, root, allocation_delay=2.0,
+                 boot_delay=1.0, jitter=0.5, node_failure_rate=0.0,
+                 task_failure_rate=0.0, api_latency=0.0,
+                 api_failure_rate=0.0, autoscale_interval=5.0,
+                 preemption_interval=0.0, preemption_duration=10.0,
+                 random_state=None):
+        """
+        :param blob_service: The blob store of the resource and output
+            files.
+        :type blob_service: `EmulatedBlobService`
+        :param str root: The directory holding the node directories.
+        :param float allocation_delay: seconds before a new node starts
+        :param float boot_delay: seconds a node takes to boot, and reboot
+        :param float jitter: maximum random seconds added to both delays
+        :param float node_failure_rate: probability of a node booting into
+            the unusable state
+        :param float task_failure_rate: probability of a (sub)task failing
+            on its node before its command runs
+        :param float api_latency: seconds added to every call
+        :param float api_failure_rate: probability of a call failing with
+            ServerBusy; add_collection fails single entries instead
+        :param float autoscale_interval: seconds between evaluations of
+            autoscale formulas
+        :param float preemption_interval: mean seconds a low-priority node
+            runs before it is preempted, 0 for never
+        :param float preemption_duration: seconds a preempted node stays
+            preempted
+        :param random_state: The random generator of delays and failures.
+        :type random_state: `random.Random`
+        """
+        self.blob_service = blob_service
+        self.root = os.path.abspath(root)
+        self.allocation_delay = allocation_delay
+        self.boot_delay = boot_delay
+        self.jitter = jitter
+        self.node_failure_rate = node_failure_rate
+        self.task_failure_rate = task_failure_rate
+        self.api_latency = api_latency
+        self.api_failure_rate = api_failure_rate
+        self.autoscale_interval = autoscale_interval
+        self.preemption_interval = preemption_interval
+        self.preemption_duration = preemption_duration
+        self.random = random_state or random.Random()
+        self.config = _Configuration('emulator://' + self.root)
+
+        self.lock = threading.RLock()
+        self.pools = {}
+        self.jobs = {}
+
+        self.account = _AccountOperations(self)
+        self.pool = _PoolOperations(self)
+        self.compute_node = _ComputeNodeOperations(self)
+        self.job = _JobOperations(self)
+        self.task = _TaskOperations(self)
+        self.file = _FileOperations(self)
+
+        self._stopped = threading.Event()
+        self._scheduler = threading.Thread(
+            target=self._run_scheduler, name='batch-emulator')
+        self._scheduler.daemon = True
+        self._scheduler.start()
+
+    # -- helpers shared by the operation groups --------------------------
+
+    def roll(self, rate):
+        """Returns True with the given probability"""
+        return bool(rate) and self.random.random() < rate
+
+    def before_call(self):
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        if self.roll(self.api_failure_rate):
+            raise _batch_error(
+                'ServerBusy', 'The server is busy (emulated failure).')
+
+    def _delay(self, seconds):
+        return seconds + self.random.uniform(0, self.jitter)
+
+    def get_pool(self, pool_id):
+        pool = self.pools.get(pool_id)
+        if pool is None:
+            raise _batch_error(
+                'PoolNotFound', 'The specified pool does not exist.')
+        return pool
+
+    def get_node(self, pool_id, node_id):
+        node = self.get_pool(pool_id).nodes.get(node_id)
+        if node is None:
+            raise _batch_error(
+                'NodeNotFound', 'The specified node does not exist.')
+        return node
+
+    def get_job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise _batch_error(
+                'JobNotFound', 'The specified job does not exist.')
+        return job
+
+    def get_task(self, job_id, task_id):
+        task = self.get_job(job_id).tasks.get(task_id)
+        if task is None:
+            raise _batch_error(
+                'TaskNotFound', 'The specified task does not exist.')
+        return task
+
+    @staticmethod
+    def get_task_dir(node, task):
+        return os.path.join(node.root_dir, 'workitems', task.job.id,
+                            'job-1', task.id)
+
+    def describe_pool(self, pool):
+        spec = pool.spec
+        return batchmodels.CloudPool(
+            id=pool.id, state=pool.state,
+            allocation_state=pool.allocation_state,
+            creation_time=pool.creation_time, vm_size=spec.vm_size,
+            target_dedicated_nodes=pool.target_dedicated_nodes,
+            current_dedicated_nodes=self._count_nodes(pool, True),
+            target_low_priority_nodes=pool.target_low_priority_nodes,
+            current_low_priority_nodes=self._count_nodes(pool, False),
+            enable_auto_scale=spec.enable_auto_scale,
+            auto_scale_formula=spec.auto_scale_formula,
+            enable_inter_node_communication=(
+                spec.enable_inter_node_communication),
+            max_tasks_per_node=spec.max_tasks_per_node,
+            metadata=list(pool.metadata), resize_errors=None,
+            virtual_machine_configuration=(
+                spec.virtual_machine_configuration),
+            start_task=spec.start_task)
+
+    @staticmethod
+    def describe_node(node):
+        return batchmodels.ComputeNode(
+            id=node.id, state=node.state,
+            allocation_time=node.allocation_time,
+            ip_address=_NODE_IP_ADDRESS, vm_size=node.pool.spec.vm_size,
+            is_dedicated=node.is_dedicated,
+            running_tasks_count=len(node.running_tasks),
+            total_tasks_run=node.total_tasks_run,
+            start_task_info=node.start_task_info)
+
+    @staticmethod
+    def describe_job(job):
+        return batchmodels.CloudJob(
+            id=job.id, state=job.state, creation_time=job.creation_time,
+            pool_info=batchmodels.PoolInformation(pool_id=job.pool_id))
+
+    @staticmethod
+    def describe_task(task):
+        execution_info = None
+        if task.start_time is not None or task.failure_info is not None or \
+                task.requeue_count or task.retry_count:
+            result = None
+            if task.state == batchmodels.TaskState.completed:
+                result = (batchmodels.TaskExecutionResult.success
+                          if task.exit_code == 0 and task.failure_info is None
+                          else batchmodels.TaskExecutionResult.failure)
+            execution_info = batchmodels.TaskExecutionInformation(
+                start_time=task.start_time, end_time=task.end_time,
+                exit_code=task.exit_code, failure_info=task.failure_info,
+                retry_count=task.retry_count,
+                requeue_count=task.requeue_count, result=result)
+        return batchmodels.CloudTask(
+            id=task.id, state=task.state, creation_time=task.creation_time,
+            command_line=task.spec.command_line,
+            multi_instance_settings=task.spec.multi_instance_settings,
+            environment_settings=task.spec.environment_settings,
+            execution_info=execution_info,
+            node_info=batchmodels.ComputeNodeInformation(
+                pool_id=task.job.pool_id, node_id=task.nodes[0].id)
+            if task.nodes else None)
+
+    # -- pools and nodes -------------------------------------------------
+
+    def add_pool(self, spec):
+        with self.lock:
+            if spec.id in self.pools:
+                raise _batch_error(
+                    'PoolExists', 'The specified pool already exists.')
+            pool = _Pool(spec, time.time())
+            self.pools[spec.id] = pool
+            if spec.enable_auto_scale:
+                self._evaluate_autoscale(pool, time.time())
+            self._grow(pool)
+
+    @staticmethod
+    def _count_nodes(pool, is_dedicated):
+        return sum(1 for node in pool.nodes.values()
+                   if node.is_dedicated == is_dedicated)
+
+    @staticmethod
+    def _get_target(pool, is_dedicated):
+        return (pool.target_dedicated_nodes if is_dedicated else
+                pool.target_low_priority_nodes)
+
+    @staticmethod
+    def _needs_resize(pool):
+        return (len(pool.nodes) != pool.target_dedicated_nodes +
+                pool.target_low_priority_nodes)
+
+    def _grow(self, pool):
+        now = time.time()
+        for is_dedicated in (True, False):
+            while self._count_nodes(pool, is_dedicated) < \
+                    self._get_target(pool, is_dedicated):
+                node_id = 'tvm-emulated_{}-{:04d}'.format(
+                    pool.id, pool.next_node_index)
+                pool.next_node_index += 1
+                pool.nodes[node_id] = _Node(
+                    node_id, pool, os.path.join(self.root, 'nodes', pool.id,
+                                                node_id),
+                    now + self._delay(self.allocation_delay),
+                    is_dedicated=is_dedicated)
+        pool.allocation_state = batchmodels.AllocationState.resizing
+
+    def _shrink(self, pool):
+        """Releases the nodes above the targets, idle ones first; busy
+        nodes leave once their tasks complete."""
+        busy_rank = {batchmodels.ComputeNodeState.running: 1}
+        for is_dedicated in (True, False):
+            excess = (self._count_nodes(pool, is_dedicated) -
+                      self._get_target(pool, is_dedicated))
+            for node in sorted(pool.nodes.values(),
+                               key=lambda node: busy_rank.get(node.state, 0)):
+                if excess <= 0:
+                    break
+                if node.is_dedicated == is_dedicated and not node.removing:
+                    node.removing = True
+                    excess -= 1
+        for node in list(pool.nodes.values()):
+            if node.removing and not node.running_tasks:
+                self._remove_node(node)
+        pool.allocation_state = batchmodels.AllocationState.resizing
+
+    def _remove_node(self, node):
+        self._kill(node.start_task_process)
+        del node.pool.nodes[node.id]
+        shutil.rmtree(node.root_dir, ignore_errors=True)
+
+    def _check_resizable(self, pool):
+        """Raises the errors of the service for resizing a pool by hand"""
+        if pool.spec.enable_auto_scale:
+            raise _batch_error(
+                'AutoScalingEnabled', 'The specified operation is not '
+                'allowed on a pool with autoscale enabled.')
+        if pool.allocation_state != batchmodels.AllocationState.steady:
+            raise _batch_error(
+                'PoolNotSteady', 'The pool is not in a steady state.')
+
+    def resize_pool(self, pool_id, target_dedicated_nodes,
+                    target_low_priority_nodes=0):
+        with self.lock:
+            pool = self.get_pool(pool_id)
+            self._check_resizable(pool)
+            pool.target_dedicated_nodes = target_dedicated_nodes
+            pool.target_low_priority_nodes = target_low_priority_nodes
+            self._grow(pool)
+            self._shrink(pool)
+
+    def remove_nodes(self, pool_id, node_ids):
+        with self.lock:
+            pool = self.get_pool(pool_id)
+            self._check_resizable(pool)
+            nodes = [self.get_node(pool_id, node_id) for node_id in node_ids]
+            for node in nodes:
+                for task in list(node.running_tasks):
+                    self.requeue_task(task)
+                self._remove_node(node)
+            pool.target_dedicated_nodes = self._count_nodes(pool, True)
+            pool.target_low_priority_nodes = self._count_nodes(pool, False)
+            pool.allocation_state = batchmodels.AllocationState.resizing
+
+    def restart_node(self, pool_id, node_id, reimage):
+        with self.lock:
+            node = self.get_node(pool_id, node_id)
+            for task in list(node.running_tasks):
+                self.requeue_task(task)
+            self._kill(node.start_task_process)
+            if reimage:
+                shutil.rmtree(node.root_dir, ignore_errors=True)
+                node.state = batchmodels.ComputeNodeState.reimaging
+            else:
+                node.state = batchmodels.ComputeNodeState.rebooting
+            node.start_task_info = None
+            node.preempt_at = None
+            node.ready_at = time.time() + self._delay(self.boot_delay)
+
+    def preempt_node(self, node):
+        """Takes a low-priority node away, requeueing its tasks. It comes
+        back as a fresh node after preemption_duration."""
+        for task in list(node.running_tasks):
+            self.requeue_task(task)
+        self._kill(node.start_task_process)
+        shutil.rmtree(node.root_dir, ignore_errors=True)
+        node.state = batchmodels.ComputeNodeState.preempted
+        node.start_task_info = None
+        node.preempt_at = None
+        node.ready_at = time.time() + self._delay(self.preemption_duration)
+
+    def delete_pool(self, pool_id):
+        with self.lock:
+            pool = self.get_pool(pool_id)
+            if pool.state == batchmodels.PoolState.deleting:
+                return
+            pool.state = batchmodels.PoolState.deleting
+            pool.allocation_state = batchmodels.AllocationState.stopping
+            pool.deleted_at = time.time() + self._delay(0)
+            for node in pool.nodes.values():
+                for task in list(node.running_tasks):
+                    self.requeue_task(task)
+                self._kill(node.start_task_process)
+
+    def _boot(self, node):
+        """Finishes a (re)boot, running the start task if the pool has one"""
+        if self.roll(self.node_failure_rate):
+            node.state = batchmodels.ComputeNodeState.unusable
+            return
+        for name in ('startup', 'shared', 'workitems'):
+            path = os.path.join(node.root_dir, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        start_task = node.pool.spec.start_task
+        if not node.is_dedicated and self.preemption_interval:
+            node.preempt_at = time.time() + self.random.expovariate(
+                1.0 / self.preemption_interval)
+        if start_task is None:
+            node.state = batchmodels.ComputeNodeState.idle
+            return
+        node.state = (batchmodels.ComputeNodeState.waiting_for_start_task
+                      if start_task.wait_for_success else
+                      batchmodels.ComputeNodeState.idle)
+        node.start_task_info = batchmodels.StartTaskInformation(
+            state=batchmodels.StartTaskState.running, start_time=_utcnow(),
+            retry_count=0)
+        thread = threading.Thread(
+            target=self._run_start_task, args=(node, node.start_task_info))
+        thread.daemon = True
+        thread.start()
+
+    def _run_start_task(self, node, info):
+        start_task = node.pool.spec.start_task
+        startup_dir = os.path.join(node.root_dir, 'startup')
+        working_dir = os.path.join(startup_dir, 'wd')
+        environment = self._node_environment(node)
+        environment.update({
+            'AZ_BATCH_TASK_DIR': startup_dir,
+            'AZ_BATCH_TASK_WORKING_DIR': working_dir,
+        })
+        exit_code, failure_info = self._run_commands(
+            node, [start_task.command_line], working_dir, startup_dir,
+            start_task.resource_files, start_task.environment_settings,
+            environment, lambda process: setattr(
+                node, 'start_task_process', process))
+        with self.lock:
+            if node.start_task_info is not info:
+                return
+            info.state = batchmodels.StartTaskState.completed
+            info.end_time = _utcnow()
+            info.exit_code = exit_code
+            info.failure_info = failure_info
+            info.result = (batchmodels.TaskExecutionResult.success
+                           if exit_code == 0 else
+                           batchmodels.TaskExecutionResult.failure)
+            node.start_task_process = None
+            if node.state == batchmodels.ComputeNodeState.\
+                    waiting_for_start_task:
+                node.state = (batchmodels.ComputeNodeState.idle
+                              if exit_code == 0 else
+                              batchmodels.ComputeNodeState.start_task_failed)
+
+    def _node_environment(self, node):
+        environment = dict(os.environ)
+        environment.update({
+            'AZ_BATCH_POOL_ID': node.pool.id,
+            'AZ_BATCH_NODE_ID': node.id,
+            'AZ_BATCH_NODE_ROOT_DIR': node.root_dir,
+            'AZ_BATCH_NODE_SHARED_DIR': os.path.join(node.root_dir, 'shared'),
+            'AZ_BATCH_NODE_STARTUP_DIR': os.path.join(
+                node.root_dir, 'startup'),
+            'AZ_BATCH_NODE_IS_DEDICATED':
+                'true' if node.is_dedicated else 'false',
+        })
+        return environment
+
+    # -- autoscale -------------------------------------------------------
+
+    def _evaluate_autoscale(self, pool, now):
+        for name in pool.samples:
+            pool.samples[name] = pool.samples[name][-600:]
+        result = common.autoscale.evaluate_formula(
+            pool.spec.auto_scale_formula, pool.samples, now,
+            pool.target_dedicated_nodes, self._count_nodes(pool, True),
+            pool.target_low_priority_nodes, self._count_nodes(pool, False))
+        pool.target_dedicated_nodes = max(
+            0, int(result.get('$TargetDedicatedNodes', 0)))
+        pool.target_low_priority_nodes = max(
+            0, int(result.get('$TargetLowPriorityNodes', 0)))
+        pool.next_evaluation = now + self.autoscale_interval
+
+    def _sample(self, pool, now):
+        active = running = 0
+        for job in self.jobs.values():
+            if job.pool_id != pool.id:
+                continue
+            for task in job.tasks.values():
+                if task.state == batchmodels.TaskState.active:
+                    active += 1
+                elif task.state == batchmodels.TaskState.running:
+                    running += 1
+        pool.samples['ActiveTasks'].append((now, active))
+        pool.samples['RunningTasks'].append((now, running))
+        pool.next_sample = now + 1
+
+    # -- jobs and tasks --------------------------------------------------
+
+    def add_task(self, job, spec):
+        task = _Task(spec, job)
+        job.tasks[task.id] = task
+        job.task_order.append(task.id)
+
+    def delete_job(self, job_id):
+        with self.lock:
+            job = self.get_job(job_id)
+            for task in job.tasks.values():
+                if task.state == batchmodels.TaskState.running:
+                    self._release(task)
+            del self.jobs[job_id]
+
+    def requeue_task(self, task):
+        """Puts a running task back in the queue, eg when its node goes"""
+        self._release(task)
+        task._reset()
+        task.state = batchmodels.TaskState.active
+        task.requeue_count += 1
+
+    def _release(self, task):
+        for process in task.processes:
+            self._kill(process)
+        for node in task.nodes:
+            if task in node.running_tasks:
+                node.running_tasks.remove(task)
+            if (not node.running_tasks and node.state ==
+                    batchmodels.ComputeNodeState.running):
+                node.state = batchmodels.ComputeNodeState.idle
+
+    @staticmethod
+    def _kill(process):
+        if process is not None and process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _schedule(self, job, pool):
+        capacity = int(pool.spec.max_tasks_per_node or 1)
+        for task_id in job.task_order:
+            task = job.tasks[task_id]
+            if task.state != batchmodels.TaskState.active:
+                continue
+            usable = [node for node in pool.nodes.values()
+                      if not node.removing and node.state in (
+                          batchmodels.ComputeNodeState.idle,
+                          batchmodels.ComputeNodeState.running)]
+            if task.instances > 1:
+                # every instance needs a node of its own
+                free = [node for node in usable if not node.running_tasks]
+            else:
+                free = [node for node in usable
+                        if len(node.running_tasks) < capacity]
+            if len(free) < task.instances:
+                continue
+            task.nodes = free[:task.instances]
+            task.state = batchmodels.TaskState.running
+            task.start_time = _utcnow()
+            task.subtasks = [{
+                'id': index, 'node_id': node.id,
+                'state': batchmodels.SubtaskState.running,
+                'start_time': task.start_time, 'end_time': None,
+                'exit_code': None} for index, node in enumerate(task.nodes)]
+            for node in task.nodes:
+                node.running_tasks.append(task)
+                node.total_tasks_run += 1
+                node.state = batchmodels.ComputeNodeState.running
+            thread = threading.Thread(
+                target=self._run_task, args=(task, task.attempt))
+            thread.daemon = True
+            thread.start()
+
+    def _run_task(self, task, attempt):
+        try:
+            exit_code, failure_info = self._execute_task(task, attempt)
+        except Exception as err:
+            exit_code, failure_info = None, batchmodels.TaskFailureInformation(
+                category=batchmodels.ErrorCategory.server_error,
+                code='EmulatorError', message=repr(err))
+
+        with self.lock:
+            if task.attempt != attempt or task.job.id not in self.jobs:
+                return
+            self._release(task)
+            if (exit_code != 0 or failure_info is not None) and (
+                    task.max_retries == -1 or
+                    task.retry_count < task.max_retries):
+                # rerun, possibly on other nodes, as Batch does
+                task._reset()
+                task.state = batchmodels.TaskState.active
+                task.retry_count += 1
+                return
+            task.processes = []
+            task.state = batchmodels.TaskState.completed
+            task.end_time = _utcnow()
+            task.exit_code = exit_code
+            task.failure_info = failure_info
+            for subtask in task.subtasks:
+                subtask['state'] = batchmodels.SubtaskState.completed
+                subtask['end_time'] = task.end_time
+                subtask['exit_code'] = exit_code
+
+    def _execute_task(self, task, attempt):
+        """Runs a task on its nodes and uploads its output files.
+
+        :rtype: tuple
+        :return: (exit code, failure info)
+        """
+        spec = task.spec
+        multi_instance = spec.multi_instance_settings
+        nodes = list(task.nodes)
+        host_list = ','.join([_NODE_HOST_NAME] * len(nodes))
+
+        def _track(process):
+            with self.lock:
+                if task.attempt == attempt:
+                    task.processes.append(process)
+                else:
+                    self._kill(process)
+
+        def _environment(node, index):
+            task_dir = self.get_task_dir(node, task)
+            environment = self._node_environment(node)
+            environment.update({
+                'AZ_BATCH_JOB_ID': task.job.id,
+                'AZ_BATCH_TASK_ID': task.id,
+                'AZ_BATCH_TASK_DIR': task_dir,
+                'AZ_BATCH_TASK_WORKING_DIR': os.path.join(task_dir, 'wd'),
+            })
+            if multi_instance is not None:
+                environment.update({
+                    'AZ_BATCH_TASK_SHARED_DIR': task_dir,
+                    'AZ_BATCH_HOST_LIST': host_list,
+                    'AZ_BATCH_NODE_LIST': host_list.replace(',', ';'),
+                    'AZ_BATCH_MASTER_NODE': '{}:6000'.format(
+                        _NODE_IP_ADDRESS),
+                    'AZ_BATCH_IS_CURRENT_NODE_MASTER':
+                        'true' if index == 0 else 'false',
+                })
+            return environment
+
+        def _run_coordination(index):
+            node = nodes[index]
+            task_dir = self.get_task_dir(node, task)
+            return self._run_commands(
+                node, [multi_instance.coordination_command_line],
+                os.path.join(task_dir, 'wd'), task_dir,
+                multi_instance.common_resource_files,
+                spec.environment_settings, _environment(node, index), _track,
+                resource_dir=task_dir, output_prefix='coordination-')
+
+        results = []
+        if multi_instance is not None and \
+                multi_instance.coordination_command_line:
+            threads = []
+            results = [None] * len(nodes)
+
+            def _coordinate(index):
+                results[index] = _run_coordination(index)
+            for index in range(len(nodes)):
+                thread = threading.Thread(target=_coordinate, args=(index,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        elif multi_instance is not None:
+            for index, node in enumerate(nodes):
+                task_dir = self.get_task_dir(node, task)
+                results.append(self._fetch(
+                    multi_instance.common_resource_files, task_dir))
+
+        primary = nodes[0]
+        primary_dir = self.get_task_dir(primary, task)
+        working_dir = os.path.join(primary_dir, 'wd')
+        failed = [result for result in results
+                  if result is not None and result != (0, None)]
+        if failed:
+            exit_code, failure_info = failed[0]
+        else:
+            exit_code, failure_info = self._run_commands(
+                primary, [spec.command_line], working_dir, primary_dir,
+                spec.resource_files, spec.environment_settings,
+                _environment(primary, 0), _track)
+
+        self._upload_outputs(spec.output_files, working_dir, exit_code == 0)
+        return exit_code, failure_info
+
+    def _fetch(self, resource_files, directory):
+        """Downloads resource files into a directory.
+
+        :rtype: tuple
+        :return: (exit code, failure info), (0, None) on success
+        """
+        for resource_file in resource_files or []:
+            url = resource_file.http_url or resource_file.storage_container_url
+            try:
+                if resource_file.storage_container_url:
+                    self.blob_service.download_url(url, os.path.join(
+                        directory, resource_file.file_path or ''))
+                else:
+                    self.blob_service.download_url(url, os.path.join(
+                        directory, resource_file.file_path or
+                        os.path.basename(urlsplit(url).path)))
+            except (AzureHttpError, OSError) as err:
+                return None, batchmodels.TaskFailureInformation(
+                    category=batchmodels.ErrorCategory.user_error,
+                    code='ResourceFileDownloadError', message=str(err))
+        return 0, None
+
+    def _run_commands(self, node, command_lines, working_dir, task_dir,
+                      resource_files, environment_settings, environment,
+                      track, resource_dir=None, output_prefix=''):
+        """Runs command lines one after another on a node.
+
+        :rtype: tuple
+        :return: (exit code, failure info)
+        """
+        if not os.path.isdir(working_dir):
+            os.makedirs(working_dir)
+        result = self._fetch(resource_files, resource_dir or working_dir)
+        if result != (0, None):
+            return result
+        if self.roll(self.task_failure_rate):
+            return None, batchmodels.TaskFailureInformation(
+                category=batchmodels.ErrorCategory.server_error,
+                code='EmulatedFailure',
+                message='task failed on node {}'.format(node.id))
+        for setting in environment_settings or []:
+            environment[setting.name] = setting.value or ''
+        with open(os.path.join(task_dir, output_prefix + 'stdout.txt'),
+                  'ab') as stdout, \
+                open(os.path.join(task_dir, output_prefix + 'stderr.txt'),
+                     'ab') as stderr:
+            for command_line in command_lines:
+                try:
+                    process = subprocess.Popen(
+                        shlex.split(command_line), cwd=working_dir,
+                        env=environment, stdout=stdout, stderr=stderr,
+                        start_new_session=True)
+                except OSError as err:
+                    return None, batchmodels.TaskFailureInformation(
+                        category=batchmodels.ErrorCategory.user_error,
+                        code='CommandProgramNotFound', message=str(err))
+                track(process)
+                exit_code = process.wait()
+                if exit_code != 0:
+                    return exit_code, batchmodels.TaskFailureInformation(
+                        category=batchmodels.ErrorCategory.user_error,
+                        code='FailureExitCode',
+                        message='The task exited with exit code {}'.format(
+                            exit_code))
+        return 0, None
+
+    def _upload_outputs(self, output_files, working_dir, succeeded):
+        conditions = {
+            batchmodels.OutputFileUploadCondition.task_completion.value: True,
+            batchmodels.OutputFileUploadCondition.task_success.value:
+                succeeded,
+            batchmodels.OutputFileUploadCondition.task_failure.value:
+                not succeeded,
+        }
+        for output_file in output_files or []:
+            condition = output_file.upload_options.upload_condition
+            if not conditions[str(getattr(
+                    condition, 'value', condition)).lower()]:
+                continue
+            destination = output_file.destination.container
+            pattern = output_file.file_pattern
+            # blob names are relative to the part of the pattern without
+            # wildcards, a single file is uploaded as path itself
+            parts = pattern.replace('\\', '/').split('/')
+            fixed = []
+            for part in parts[:-1]:
+                if _WILDCARDS.search(part):
+                    break
+                fixed.append(part)
+            base_dir = os.path.normpath(os.path.join(working_dir, *fixed))
+            for path in sorted(glob.glob(os.path.join(working_dir, pattern),
+                                         recursive=True)):
+                if not os.path.isfile(path):
+                    continue
+                if destination.path and not _WILDCARDS.search(pattern):
+                    blob_name = destination.path
+                else:
+                    blob_name = os.path.relpath(path, base_dir).replace(
+                        os.sep, '/')
+                    if destination.path:
+                        blob_name = destination.path.rstrip('/') + '/' + \
+                            blob_name
+                try:
+                    self.blob_service.upload_to_url(
+                        destination.container_url, blob_name, path)
+                except AzureHttpError as err:
+                    print('Emulated output upload of {} failed: {}'.format(
+                        path, err))
+
+    # -- scheduler -------------------------------------------------------
+
+    def _tick(self):
+        now = time.time()
+        with self.lock:
+            for pool in list(self.pools.values()):
+                if pool.state == batchmodels.PoolState.deleting:
+                    if now >= pool.deleted_at:
+                        for node in list(pool.nodes.values()):
+                            self._remove_node(node)
+                        shutil.rmtree(os.path.join(self.root, 'nodes',
+                                                   pool.id),
+                                      ignore_errors=True)
+                        del self.pools[pool.id]
+                    continue
+
+                if pool.spec.enable_auto_scale:
+                    if now >= pool.next_sample:
+                        self._sample(pool, now)
+                    if now >= pool.next_evaluation:
+                        self._evaluate_autoscale(pool, now)
+                        if self._needs_resize(pool):
+                            self._grow(pool)
+                            self._shrink(pool)
+
+                for node in list(pool.nodes.values()):
+                    if node.removing and not node.running_tasks:
+                        self._remove_node(node)
+                    elif node.preempt_at is not None and \
+                            now >= node.preempt_at:
+                        self.preempt_node(node)
+                    elif node.ready_at is not None and now >= node.ready_at:
+                        if node.state in (
+                                batchmodels.ComputeNodeState.creating,
+                                batchmodels.ComputeNodeState.preempted):
+                            node.state = batchmodels.ComputeNodeState.\
+                                starting
+                            node.ready_at = now + self._delay(
+                                self.boot_delay)
+                        else:
+                            node.ready_at = None
+                            self._boot(node)
+
+                if pool.allocation_state == \
+                        batchmodels.AllocationState.resizing and all(
+                            node.state != batchmodels.ComputeNodeState.
+                            creating and not node.removing
+                            for node in pool.nodes.values()) and \
+                        not self._needs_resize(pool):
+                    pool.allocation_state = \
+                        batchmodels.AllocationState.steady
+
+            for job in self.jobs.values():
+                pool = self.pools.get(job.pool_id)
+                if pool is not None and \
+                        pool.state == batchmodels.PoolState.active:
+                    self._schedule(job, pool)
+
+    def _run_scheduler(self):
+        while not self._stopped.wait(0.05):
+            self._tick()
+
+    def close(self):
+        """Stops the scheduler and kills every running process"""
+        self._stopped.set()
+        with self.lock:
+            for pool in self.pools.values():
+                for node in pool.nodes.values():
+                    self._kill(node.start_task_process)
+            for job in self.jobs.values():
+                for task in job.tasks.values():
+                    for process in task.processes:
+                        self._kill(process)
+
+
+def get_emulator_settings(config, section='backend'):
+    """Reads the CFG_EMULATOR_* settings of a job configuration
+
+    :param config: The job configuration.
+    :type config: `configparser.ConfigParser`
+    :param str section: The section of the settings.
+    :rtype: dict
+    :return: The keyword arguments of create_clients.
+    """
+    seed = config.get(section, 'CFG_EMULATOR_SEED', fallback='')
+    return {
+        'root': config.get(section, 'CFG_EMULATOR_ROOT', fallback='') or None,
+        'seed': int(seed) if seed else None,
+        'allocation_delay': config.getfloat(
+            section, 'CFG_EMULATOR_ALLOCATION_SECONDS', fallback=2.0),
+        'boot_delay': config.getfloat(
+            section, 'CFG_EMULATOR_BOOT_SECONDS', fallback=1.0),
+        'jitter': config.getfloat(
+            section, 'CFG_EMULATOR_JITTER_SECONDS', fallback=0.5),
+        'node_failure_rate': config.getfloat(
+            section, 'CFG_EMULATOR_NODE_FAILURE_RATE', fallback=0.0),
+        'task_failure_rate': config.getfloat(
+            section, 'CFG_EMULATOR_TASK_FAILURE_RATE', fallback=0.0),
+        'api_latency': config.getfloat(
+            section, 'CFG_EMULATOR_API_LATENCY_SECONDS', fallback=0.0),
+        'api_failure_rate': config.getfloat(
+            section, 'CFG_EMULATOR_API_FAILURE_RATE', fallback=0.0),
+        'preemption_interval': config.getfloat(
+            section, 'CFG_EMULATOR_PREEMPTION_INTERVAL_SECONDS',
+            fallback=0.0),
+        'preemption_duration': config.getfloat(
+            section, 'CFG_EMULATOR_PREEMPTION_SECONDS', fallback=10.0),
+        'storage_latency': config.getfloat(
+            section, 'CFG_EMULATOR_STORAGE_LATENCY_SECONDS', fallback=0.0),
+        'storage_failure_rate': config.getfloat(
+            section, 'CFG_EMULATOR_STORAGE_FAILURE_RATE', fallback=0.0),
+    }
+
+
+def create_clients(root=None, seed=None, storage_latency=0.0,
+                   storage_failure_rate=0.0, **settings):
+    """Creates an emulated Batch service and blob store sharing a root.
+
+    :param str root: The emulator directory, defaults to
+        ~/.hpc-dfo/emulator. Blobs are kept between runs, pools and jobs
+        only live as long as the process.
+    :param int seed: Seed of the simulated delays and failures.
+    :param float storage_latency: seconds added to every storage call
+    :param float storage_failure_rate: probability of a storage call failing
+    :param settings: Keyword arguments of `EmulatedBatchService`.
+    :rtype: tuple
+    :return: (batch client, blob client)
+    """
+    if root is None:
+        root = os.path.dirname(common.helpers.get_local_state_path(
+            'emulator', 'blobs'))
+    random_state = random.Random(seed)
+    blob_service = EmulatedBlobService(
+        os.path.join(root, 'blobs'), latency=storage_latency,
+        failure_rate=storage_failure_rate, random_state=random_state)
+    batch_service = EmulatedBatchService(
+        blob_service, root, random_state=random_state, **settings)
+    return batch_service, blob_service
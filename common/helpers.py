@@ -23,18 +23,34 @@
 # DEALINGS IN THE SOFTWARE.
 
 from __future__ import print_function
+import concurrent.futures
 import datetime
+import hashlib
 import io
+import json
 import os
 import time
 
 import azure.storage.blob as azureblob
 import azure.batch.models as batchmodels
 
+import common.polling
+import common.transfer
+
 
 _STANDARD_OUT_FILE_NAME = 'stdout.txt'
 _STANDARD_ERROR_FILE_NAME = 'stderr.txt'
 _SAMPLES_CONFIG_FILE_NAME = 'configuration.cfg'
+_UPLOAD_MAX_WORKERS = 8
+_HASH_CHUNK_SIZE = 4 * 1024 * 1024
+_LOCAL_STATE_DIR_NAME = '.hpc-dfo'
+_BLOCK_UPLOAD_THRESHOLD = 256 * 1024 * 1024
+_IMAGE_CACHE_FILE_NAME = 'image-cache.json'
+_IMAGE_CACHE_TTL = datetime.timedelta(days=1)
+_IMAGE_CACHE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# batch account url -> verified image index, built once per process
+_verified_image_indexes = {}
 
 
 class TimeoutError(Exception):
@@ -62,32 +78,113 @@ def decode_string(string, encoding=None):
     raise ValueError('invalid string type: {}'.format(type(string)))
 
 
+def build_verified_image_index(node_agent_skus):
+    """Indexes the verified images of node agent skus by publisher and offer
+
+    :param node_agent_skus: The node agent skus listed by the service.
+    :type node_agent_skus: iterable of `azure.batch.models.NodeAgentSku`
+    :rtype: dict
+    :return: (publisher, offer) in lower case -> list of
+        (node agent sku id, image reference), in node agent sku order and
+        then image sku order
+    """
+    index = {}
+    for sku in node_agent_skus:
+        for image_ref in sorted(
+                sku.verified_image_references, key=lambda item: item.sku):
+            index.setdefault(
+                (image_ref.publisher.lower(), image_ref.offer.lower()),
+                []).append((sku.id, image_ref))
+    return index
+
+
+def _load_image_cache():
+    """Loads the on-disk cache of resolved images.
+
+    :rtype: dict
+    """
+    cache_path = get_local_state_path(_IMAGE_CACHE_FILE_NAME)
+    if not os.path.isfile(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def _save_image_cache(cache):
+    """Atomically writes the on-disk cache of resolved images.
+
+    :param dict cache: The cache content.
+    """
+    cache_path = get_local_state_path(_IMAGE_CACHE_FILE_NAME)
+    temp_path = cache_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(temp_path, cache_path)
+
+
 def select_latest_verified_vm_image_with_node_agent_sku(
-        batch_client, publisher, offer, sku_starts_with):
+        batch_client, publisher, offer, sku_starts_with, refresh=False,
+        cache_ttl=_IMAGE_CACHE_TTL):
     """Select the latest verified image that Azure Batch supports given
     a publisher, offer and sku (starts with filter).
 
+    Results are cached on disk for cache_ttl per batch account, publisher,
+    offer and sku filter, so the full node agent sku listing is only
+    downloaded when the cache is missing or stale.
+
     :param batch_client: The batch client to use.
     :type batch_client: `batchserviceclient.BatchServiceClient`
     :param str publisher: vm image publisher
     :param str offer: vm image offer
     :param str sku_starts_with: vm sku starts with filter
+    :param bool refresh: ignore any cached result and query the service
+    :param cache_ttl: How long a cached result is used for.
+    :type cache_ttl: `datetime.timedelta`
     :rtype: tuple
     :return: (node agent sku id to use, vm image ref to use)
     """
-    # get verified vm image list and node agent sku ids from service
-    node_agent_skus = batch_client.account.list_node_agent_skus()
-    # pick the latest supported sku
-    skus_to_use = [
-        (sku, image_ref) for sku in node_agent_skus for image_ref in sorted(
-            sku.verified_image_references, key=lambda item: item.sku)
-        if image_ref.publisher.lower() == publisher.lower() and
-        image_ref.offer.lower() == offer.lower() and
-        image_ref.sku.startswith(sku_starts_with)
-    ]
+    batch_url = batch_client.config.batch_url
+    cache_key = '|'.join(
+        (batch_url, publisher.lower(), offer.lower(), sku_starts_with))
+    cache = _load_image_cache()
+    entry = cache.get(cache_key)
+    if entry is not None and not refresh:
+        resolved_at = datetime.datetime.strptime(
+            entry['resolved_at'], _IMAGE_CACHE_TIME_FORMAT)
+        if datetime.datetime.utcnow() - resolved_at < cache_ttl:
+            return (entry['node_agent_sku_id'],
+                    batchmodels.ImageReference(**entry['image_reference']))
+
+    if refresh or batch_url not in _verified_image_indexes:
+        # get verified vm image list and node agent sku ids from service
+        _verified_image_indexes[batch_url] = build_verified_image_index(
+            batch_client.account.list_node_agent_skus())
+    index = _verified_image_indexes[batch_url]
+
     # skus are listed in reverse order, pick first for latest
-    sku_to_use, image_ref_to_use = skus_to_use[0]
-    return (sku_to_use.id, image_ref_to_use)
+    sku_to_use, image_ref_to_use = next(
+        ((sku_id, image_ref)
+         for sku_id, image_ref in index.get(
+             (publisher.lower(), offer.lower()), [])
+         if image_ref.sku.startswith(sku_starts_with)),
+        (None, None))
+    if sku_to_use is None:
+        raise ValueError('no verified image found for {} {} {}*'.format(
+            publisher, offer, sku_starts_with))
+
+    cache[cache_key] = {
+        'node_agent_sku_id': sku_to_use,
+        'image_reference': {
+            'publisher': image_ref_to_use.publisher,
+            'offer': image_ref_to_use.offer,
+            'sku': image_ref_to_use.sku,
+            'version': image_ref_to_use.version,
+        },
+        'resolved_at': datetime.datetime.utcnow().strftime(
+            _IMAGE_CACHE_TIME_FORMAT),
+    }
+    _save_image_cache(cache)
+    return (sku_to_use, image_ref_to_use)
 
 
 def wait_for_tasks_to_complete(batch_client, job_id, timeout):
@@ -99,19 +196,46 @@ def wait_for_tasks_to_complete(batch_client, job_id, timeout):
     :param timeout: The maximum amount of time to wait.
     :type timeout: `datetime.timedelta`
     """
-    time_to_timeout_at = datetime.datetime.now() + timeout
+    poller = common.polling.AdaptivePoller()
+    poller.watch(
+        job_id,
+        lambda: list_incomplete_task_ids(batch_client, job_id),
+        lambda incomplete_task_ids: not incomplete_task_ids,
+        lambda _, incomplete_task_ids: print(
+            "Checking if all tasks are complete... {} remaining".format(
+                len(incomplete_task_ids))))
+    if not poller.run(timeout):
+        raise TimeoutError("Timed out waiting for tasks to complete")
+
+
+def list_incomplete_task_ids(batch_client, job_id):
+    """Lists the ids of the tasks of a job which are not completed, only
+    transferring the task ids.
 
-    while datetime.datetime.now() < time_to_timeout_at:
-        print("Checking if all tasks are complete...")
-        tasks = batch_client.task.list(job_id)
+    :param batch_client: The batch client to use.
+    :type batch_client: `batchserviceclient.BatchServiceClient`
+    :param str job_id: The id of the job.
+    :rtype: tuple
+    :return: The sorted ids of the incomplete tasks.
+    """
+    tasks = batch_client.task.list(
+        job_id, task_list_options=batchmodels.TaskListOptions(
+            filter="state ne 'completed'", select='id'))
+    return tuple(sorted(task.id for task in tasks))
 
-        incomplete_tasks = [task for task in tasks if
-                            task.state != batchmodels.TaskState.completed]
-        if not incomplete_tasks:
-            return
-        time.sleep(5)
 
-    raise TimeoutError("Timed out waiting for tasks to complete")
+def list_failed_task_ids(batch_client, job_id):
+    """Lists the ids of the tasks of a job which completed with a failure.
+
+    :param batch_client: The batch client to use.
+    :type batch_client: `batchserviceclient.BatchServiceClient`
+    :param str job_id: The id of the job.
+    :rtype: list
+    """
+    tasks = batch_client.task.list(
+        job_id, task_list_options=batchmodels.TaskListOptions(
+            filter="executionInfo/result eq 'failure'", select='id'))
+    return [task.id for task in tasks]
 
 
 def print_task_output(batch_client, job_id, task_ids, encoding=None):
@@ -260,39 +384,6 @@ def create_job(batch_service_client, job_id, pool_id):
             print("Job {!r} already exists".format(job_id))
 
 
-def wait_for_all_nodes_state(batch_client, pool, node_state):
-    """Waits for all nodes in pool to reach any specified state in set
-
-    :param batch_client: The batch client to use.
-    :type batch_client: `batchserviceclient.BatchServiceClient`
-    :param pool: The pool containing the node.
-    :type pool: `batchserviceclient.models.CloudPool`
-    :param set node_state: node states to wait for
-    :rtype: list
-    :return: list of `batchserviceclient.models.ComputeNode`
-    """
-    print('waiting for all nodes in pool {} to reach one of: {!r}'.format(
-        pool.id, node_state))
-    i = 0
-    while True:
-        # refresh pool to ensure that there is no resize error
-        pool = batch_client.pool.get(pool.id)
-        if pool.resize_errors is not None:
-            resize_errors = "\n".join([repr(e) for e in pool.resize_errors])
-            raise RuntimeError(
-                'resize error encountered for pool {}:\n{}'.format(
-                    pool.id, resize_errors))
-        nodes = list(batch_client.compute_node.list(pool.id))
-        if (len(nodes) >= pool.target_dedicated_nodes and
-                all(node.state in node_state for node in nodes)):
-            return nodes
-        i += 1
-        if i % 3 == 0:
-            print('waiting for {} nodes to reach desired state...'.format(
-                pool.target_dedicated_nodes))
-        time.sleep(10)
-
-
 def create_container_and_create_sas(
         block_blob_client, container_name, permission, expiry=None,
         timeout=None):
@@ -322,6 +413,21 @@ def create_container_and_create_sas(
         container_name=container_name, permission=permission, expiry=expiry)
 
 
+def make_container_sas_url(block_blob_client, container_name, sas_token):
+    """Builds the URL of a container with its SAS token, as resource files
+    and output files of Batch tasks expect it.
+
+    :param block_blob_client: The storage block blob client to use.
+    :type block_blob_client: `azure.storage.blob.BlockBlobService`
+    :param str container_name: The name of the container.
+    :param str sas_token: A SAS token of the container.
+    :rtype: str
+    """
+    return '{}://{}/{}?{}'.format(
+        block_blob_client.protocol, block_blob_client.primary_endpoint,
+        container_name, sas_token)
+
+
 def create_sas_token(
         block_blob_client, container_name, blob_name, permission, expiry=None,
         timeout=None):
@@ -349,7 +455,8 @@ def create_sas_token(
 
 def upload_blob_and_create_sas(
         block_blob_client, container_name, blob_name, file_name, expiry,
-        timeout=None, path_prefix='/'):
+        timeout=None, path_prefix='/', create_container=True,
+        block_upload_threshold=_BLOCK_UPLOAD_THRESHOLD):
     """Uploads a file from local disk to Azure Storage and creates
     a SAS for it.
 
@@ -362,37 +469,68 @@ def upload_blob_and_create_sas(
     :type expiry: `datetime.datetime`
     :param int timeout: timeout in minutes from now for expiry,
         will only be used if expiry is not specified
+    :param bool create_container: create the container before uploading,
+        callers that already created it can skip the extra request
+    :param int block_upload_threshold: files of at least this many bytes
+        are sent with the resumable parallel block uploader
     :return: A SAS URL to the blob with the specified expiry time.
     :rtype: str
     """
-    
-    
-    block_blob_client.create_container(
-        container_name,
-        fail_on_exist=False)
+    if create_container:
+        block_blob_client.create_container(
+            container_name,
+            fail_on_exist=False)
+
+    if os.path.getsize(file_name) >= block_upload_threshold:
+        common.transfer.upload_file_in_blocks(
+            block_blob_client,
+            container_name,
+            path_prefix + blob_name,
+            file_name)
+    else:
+        block_blob_client.create_blob_from_path(
+            container_name,
+            path_prefix + blob_name,
+            file_name)
+
+    return create_blob_sas_url(
+        block_blob_client, container_name, path_prefix + blob_name,
+        expiry=expiry, timeout=timeout)
 
-    block_blob_client.create_blob_from_path(
-        container_name,
-        path_prefix + blob_name,
-        file_name)
 
+def create_blob_sas_url(
+        block_blob_client, container_name, blob_name, expiry=None,
+        timeout=None):
+    """Creates a read-only SAS URL for a blob which already exists.
+
+    :param block_blob_client: The storage block blob client to use.
+    :type block_blob_client: `azure.storage.blob.BlockBlobService`
+    :param str container_name: The name of the container of the blob.
+    :param str blob_name: The full name of the blob.
+    :param expiry: The SAS expiry time.
+    :type expiry: `datetime.datetime`
+    :param int timeout: timeout in minutes from now for expiry,
+        will only be used if expiry is not specified
+    :return: A SAS URL to the blob with the specified expiry time.
+    :rtype: str
+    """
     sas_token = create_sas_token(
         block_blob_client,
         container_name,
-        path_prefix + blob_name,
+        blob_name,
         permission=azureblob.BlobPermissions.READ,
         expiry=expiry,
         timeout=timeout)
 
     sas_url = block_blob_client.make_blob_url(
         container_name,
-        path_prefix + blob_name,
+        blob_name,
         sas_token=sas_token)
 
     return sas_url
 
 
-def upload_file_to_container(block_blob_client, container_name, file_path, timeout, path_prefix=''):
+def upload_file_to_container(block_blob_client, container_name, file_path, timeout, path_prefix='', create_container=True):
     """
     Uploads a local file to an Azure Blob storage container.
 
@@ -402,6 +540,7 @@ def upload_file_to_container(block_blob_client, container_name, file_path, timeo
     :param str file_path: The local path to the file.
     :param int timeout: timeout in minutes from now for expiry,
         will only be used if expiry is not specified
+    :param bool create_container: create the container before uploading
     :rtype: `azure.batch.models.ResourceFile`
     :return: A ResourceFile initialized with a SAS URL appropriate for Batch
     tasks.
@@ -410,11 +549,83 @@ def upload_file_to_container(block_blob_client, container_name, file_path, timeo
     print('Uploading {} to [{}]{}...'.format(file_path, container_name, path_prefix + os.path.basename(file_path)))
     sas_url = upload_blob_and_create_sas(
         block_blob_client, container_name, blob_name, file_path, expiry=None,
-        timeout=timeout, path_prefix=path_prefix)
+        timeout=timeout, path_prefix=path_prefix,
+        create_container=create_container)
     return batchmodels.ResourceFile(
         file_path=blob_name, http_url=sas_url)
 
 
+def compute_file_hash(file_path):
+    """Computes the MD5 hex digest of a local file's content
+
+    :param str file_path: The local path to the file.
+    :rtype: str
+    :return: The hex digest of the file content.
+    """
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def upload_files_to_container(
+        block_blob_client, container_name, file_paths, timeout,
+        path_prefix='', max_workers=_UPLOAD_MAX_WORKERS):
+    """
+    Uploads a collection of local files to an Azure Blob storage container
+    using a bounded pool of upload threads.
+
+    The container is created once up front. Files with identical content
+    are uploaded only once and every copy gets a ResourceFile pointing at
+    that single blob.
+
+    :param block_blob_client: A blob service client.
+    :type block_blob_client: `azure.storage.blob.BlockBlobService`
+    :param str container_name: The name of the Azure Blob storage container.
+    :param file_paths: The local paths to the files.
+    :type file_paths: iterable of str
+    :param int timeout: timeout in minutes from now for expiry
+    :param str path_prefix: blob name prefix (virtual directory)
+    :param int max_workers: maximum number of concurrent uploads
+    :rtype: list
+    :return: A list of `azure.batch.models.ResourceFile`, in the same order
+        as file_paths.
+    """
+    file_paths = list(file_paths)
+    if not file_paths:
+        return []
+
+    block_blob_client.create_container(container_name, fail_on_exist=False)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        hashes = list(executor.map(compute_file_hash, file_paths))
+
+        # only the first file seen with a given content is uploaded
+        first_path_by_hash = {}
+        for file_path, content_hash in zip(file_paths, hashes):
+            first_path_by_hash.setdefault(content_hash, file_path)
+        futures = {
+            content_hash: executor.submit(
+                upload_file_to_container, block_blob_client, container_name,
+                file_path, timeout, path_prefix=path_prefix,
+                create_container=False)
+            for content_hash, file_path in first_path_by_hash.items()}
+        sas_urls = {content_hash: future.result().http_url
+                    for content_hash, future in futures.items()}
+
+    if len(sas_urls) < len(file_paths):
+        print('Skipped {} duplicate file(s) for [{}]{}'.format(
+            len(file_paths) - len(sas_urls), container_name, path_prefix))
+
+    return [
+        batchmodels.ResourceFile(
+            file_path=os.path.basename(file_path),
+            http_url=sas_urls[content_hash])
+        for file_path, content_hash in zip(file_paths, hashes)]
+
+
 def download_blob_from_container(
         block_blob_client, container_name, blob_name, directory_path):
     """
@@ -453,6 +664,23 @@ def generate_unique_resource_name(resource_prefix):
         datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
 
 
+def get_local_state_path(*path_parts):
+    """Returns a path inside the local state directory (~/.hpc-dfo), which
+    keeps data such as upload manifests between runs. Parent directories
+    are created if needed.
+
+    :param path_parts: path components relative to the state directory
+    :rtype: str
+    :return: The absolute path.
+    """
+    path = os.path.join(os.path.expanduser('~'), _LOCAL_STATE_DIR_NAME,
+                        *path_parts)
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    return path
+
+
 def query_yes_no(question, default="yes"):
     """
     Prompts the user for yes/no input, displaying the specified question text.
@@ -483,6 +711,22 @@ def query_yes_no(question, default="yes"):
             print("Please respond with 'yes' or 'no' (or 'y' or 'n').\n")
 
 
+def confirm(question, headless, default="yes"):
+    """Asks a yes/no question, or answers it with the default without
+    prompting when running headless.
+
+    :param str question: The question to ask.
+    :param bool headless: answer with the default instead of prompting
+    :param str default: The answer, "yes" or "no".
+    :rtype: str
+    :return: "yes" or "no"
+    """
+    if headless:
+        print('{} [{}]'.format(question, default))
+        return default
+    return query_yes_no(question, default)
+
+
 def print_batch_exception(batch_exception):
     """
     Prints the contents of the specified Batch exception.
@@ -0,0 +1,227 @@
+from __future__ import print_function
+import datetime
+import json
+import os
+import re
+import statistics
+
+import common.helpers
+
+
+_HISTORY_FILE_NAME = 'imb-history.jsonl'
+_BASELINE_RUNS = 5
+_REGRESSION_TOLERANCE = 0.1
+_LATENCY_COLUMNS = ('t_usec', 't_avg_usec')
+_BANDWIDTH_COLUMN = 'mbytes_per_sec'
+_BENCHMARK_HEADER = re.compile(r'^#\s*Benchmarking\s+(\S+)')
+_PROCESSES_HEADER = re.compile(r'^#\s*#processes\s*=\s*(\d+)')
+
+
+def _column_name(header):
+    """Normalizes an IMB table header, eg 't[usec]' -> 't_usec'"""
+    name = header.lstrip('#').lower()
+    name = name.replace('[usec]', '_usec').replace('/sec', '_per_sec')
+    return name
+
+
+def parse_imb_output(text):
+    """Parses the result tables of an IMB-MPI1 run
+
+    :param str text: The stdout of IMB-MPI1.
+    :rtype: list
+    :return: A list of dicts, one per benchmark table, with the benchmark
+        name, the number of processes and the rows of the table, each row
+        being a dict of column name (bytes, repetitions, t_usec,
+        mbytes_per_sec, ...) to number.
+    """
+    tables = []
+    table = None
+    columns = None
+    processes = None
+    for line in text.splitlines():
+        line = line.strip()
+        match = _BENCHMARK_HEADER.match(line)
+        if match:
+            table = {'benchmark': match.group(1), 'processes': None,
+                     'rows': []}
+            tables.append(table)
+            columns = None
+            continue
+        match = _PROCESSES_HEADER.match(line)
+        if match:
+            processes = int(match.group(1))
+            if table is not None and table['processes'] is None:
+                table['processes'] = processes
+            continue
+        if table is None:
+            continue
+        if line.startswith('#bytes') or line.startswith('#repetitions'):
+            columns = [_column_name(header) for header in line.split()]
+            continue
+        if columns is None or not line or line.startswith('#'):
+            continue
+        values = line.split()
+        if len(values) != len(columns):
+            continue
+        try:
+            row = {column: (int(value) if column in ('bytes', 'repetitions')
+                            else float(value))
+                   for column, value in zip(columns, values)}
+        except ValueError:
+            continue
+        table['rows'].append(row)
+    return [table for table in tables if table['rows']]
+
+
+def make_run_records(run_id, vm_size, node_count, fabric, text):
+    """Parses an IMB run into history records tagged with its sweep point
+
+    :param str run_id: The id shared by all records of a sweep.
+    :param str vm_size: The VM size the benchmark ran on.
+    :param int node_count: The number of nodes.
+    :param str fabric: The I_MPI_FABRICS setting.
+    :param str text: The stdout of IMB-MPI1.
+    :rtype: list
+    :return: A list of record dicts.
+    """
+    timestamp = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    records = []
+    for table in parse_imb_output(text):
+        record = {
+            'run_id': run_id,
+            'timestamp': timestamp,
+            'vm_size': vm_size,
+            'node_count': node_count,
+            'fabric': fabric,
+        }
+        record.update(table)
+        records.append(record)
+    return records
+
+
+def get_history_path():
+    """Returns the path of the local IMB results history
+
+    :rtype: str
+    """
+    return common.helpers.get_local_state_path(
+        'benchmarks', _HISTORY_FILE_NAME)
+
+
+def load_history(history_path=None):
+    """Loads all records of the IMB results history
+
+    :param str history_path: The history file, defaults to get_history_path.
+    :rtype: list
+    """
+    if history_path is None:
+        history_path = get_history_path()
+    if not os.path.isfile(history_path):
+        return []
+    with open(history_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(records, history_path=None):
+    """Appends records to the IMB results history
+
+    :param list records: The records to append.
+    :param str history_path: The history file, defaults to get_history_path.
+    """
+    if history_path is None:
+        history_path = get_history_path()
+    with open(history_path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _sweep_key(record):
+    return (record['vm_size'], record['node_count'], record['fabric'],
+            record['benchmark'], record['processes'])
+
+
+def _latency(row):
+    for column in _LATENCY_COLUMNS:
+        if column in row:
+            return row[column]
+    return None
+
+
+def find_regressions(record, history, tolerance=_REGRESSION_TOLERANCE,
+                     baseline_runs=_BASELINE_RUNS):
+    """Compares a record with the baseline of earlier runs of the same
+    benchmark, VM size, node count, fabric and process count.
+
+    The baseline of each message size is the median over the latest
+    baseline_runs earlier runs. A row regresses when its latency is more
+    than tolerance above the baseline or its bandwidth more than tolerance
+    below it.
+
+    :param dict record: The record of the new run.
+    :param list history: Earlier records, oldest first.
+    :param float tolerance: The relative change which is flagged.
+    :param int baseline_runs: The number of earlier runs in the baseline.
+    :rtype: list
+    :return: A list of dicts with benchmark, bytes, metric, baseline, value
+        and change (relative, positive is worse).
+    """
+    key = _sweep_key(record)
+    earlier = [other for other in history
+               if _sweep_key(other) == key and
+               other['run_id'] != record['run_id']][-baseline_runs:]
+    if not earlier:
+        return []
+
+    regressions = []
+    for row in record['rows']:
+        baseline_rows = [other_row for other in earlier
+                         for other_row in other['rows']
+                         if other_row['bytes'] == row['bytes']]
+        if not baseline_rows:
+            continue
+        checks = (
+            ('latency_usec', _latency, 1),
+            ('bandwidth_mbytes_per_sec',
+             lambda r: r.get(_BANDWIDTH_COLUMN), -1),
+        )
+        for metric, getter, direction in checks:
+            value = getter(row)
+            baseline_values = [getter(r) for r in baseline_rows
+                               if getter(r) is not None]
+            if value is None or not baseline_values:
+                continue
+            baseline = statistics.median(baseline_values)
+            if baseline <= 0:
+                continue
+            change = direction * (value - baseline) / baseline
+            if change > tolerance:
+                regressions.append({
+                    'benchmark': record['benchmark'],
+                    'bytes': row['bytes'],
+                    'metric': metric,
+                    'baseline': baseline,
+                    'value': value,
+                    'change': change,
+                })
+    return regressions
+
+
+def format_record(record):
+    """Formats a record as a latency/bandwidth table
+
+    :param dict record: The record to format.
+    :rtype: str
+    """
+    lines = ['{} on {} x {} ({}, {} processes)'.format(
+        record['benchmark'], record['node_count'], record['vm_size'],
+        record['fabric'], record['processes'])]
+    lines.append('{:>12} {:>14} {:>14}'.format(
+        'bytes', 'latency[usec]', 'Mbytes/sec'))
+    for row in record['rows']:
+        latency = _latency(row)
+        bandwidth = row.get(_BANDWIDTH_COLUMN)
+        lines.append('{:>12} {:>14} {:>14}'.format(
+            row['bytes'],
+            '-' if latency is None else '{:.2f}'.format(latency),
+            '-' if bandwidth is None else '{:.2f}'.format(bandwidth)))
+    return '\n'.join(lines)
@@ -0,0 +1,143 @@
+from __future__ import print_function
+
+
+# The InfiniBand generations of the RDMA capable VM sizes. Network Direct
+# sizes reach the fabric through DAPL with the Intel MPI 5.1 of CentOS-HPC
+# 7.4; SR-IOV sizes expose the adapter to the VM, used through OFA verbs
+# with the Mellanox OFED of CentOS-HPC 7.6.
+_NETWORK_DIRECT = 'network-direct'
+_SRIOV = 'sr-iov'
+_TCP = 'tcp'
+
+_RDMA_VM_SIZES = {
+    'standard_a8': _NETWORK_DIRECT,
+    'standard_a9': _NETWORK_DIRECT,
+    'standard_h16r': _NETWORK_DIRECT,
+    'standard_h16mr': _NETWORK_DIRECT,
+    'standard_nc24r': _NETWORK_DIRECT,
+    'standard_nc24rs_v2': _NETWORK_DIRECT,
+    'standard_nc24rs_v3': _NETWORK_DIRECT,
+    'standard_nd24rs': _NETWORK_DIRECT,
+    'standard_hb60rs': _SRIOV,
+    'standard_hc44rs': _SRIOV,
+}
+
+_INTERCONNECTS = {
+    _NETWORK_DIRECT: {
+        'image': ('OpenLogic', 'CentOS-HPC', '7.4'),
+        'fabric': 'shm:dapl',
+        'environment': [('I_MPI_DAPL_PROVIDER', 'ofa-v2-ib0'),
+                        ('I_MPI_DYNAMIC_CONNECTION', '0')],
+    },
+    _SRIOV: {
+        'image': ('OpenLogic', 'CentOS-HPC', '7.6'),
+        'fabric': 'shm:ofa',
+        'environment': [('I_MPI_DYNAMIC_CONNECTION', '0')],
+    },
+    _TCP: {
+        'image': None,
+        'fabric': 'shm:tcp',
+        'environment': [],
+    },
+}
+
+_TCP_FABRIC = 'shm:tcp'
+_RDMA_FABRICS = ('dapl', 'ofa', 'tmi')
+# Exported on a node whose InfiniBand port never became active
+_FALLBACK_ENV_NAME = 'HPC_DFO_FABRIC_FALLBACK'
+_IB_PORT_STATE_PATHS = '/sys/class/infiniband/*/ports/1/state'
+
+
+def get_interconnect(vm_size):
+    """Looks up the interconnect of a VM size
+
+    :param str vm_size: The size of VM, eg 'Standard_H16r'
+    :rtype: dict
+    :return: The kind of interconnect, whether it is RDMA capable, the
+        (publisher, offer, sku) of the HPC image with its drivers (None for
+        tcp), the I_MPI_FABRICS value and the other MPI environment variables
+        as (name, value) tuples.
+    """
+    kind = _RDMA_VM_SIZES.get(vm_size.lower(), _TCP)
+    interconnect = dict(_INTERCONNECTS[kind])
+    interconnect['kind'] = kind
+    interconnect['rdma'] = kind != _TCP
+    return interconnect
+
+
+def get_tcp_interconnect():
+    """Returns the tcp interconnect, used in place of the RDMA one of a VM
+    size when the image of its nodes has no RDMA drivers
+
+    :rtype: dict
+    """
+    interconnect = dict(_INTERCONNECTS[_TCP])
+    interconnect['kind'] = _TCP
+    interconnect['rdma'] = False
+    return interconnect
+
+
+def is_rdma_fabric(fabric):
+    """Returns True if an I_MPI_FABRICS value needs an RDMA interconnect
+
+    :param str fabric: The fabric, eg 'shm:dapl' or 'tcp'
+    :rtype: bool
+    """
+    return any(name in fabric for name in _RDMA_FABRICS)
+
+
+def resolve_fabric(interconnect, fabric='auto'):
+    """Picks the fabric to use, falling back to tcp when an RDMA fabric is
+    requested for a VM size without RDMA.
+
+    :param dict interconnect: The interconnect from get_interconnect.
+    :param str fabric: An I_MPI_FABRICS value, or 'auto' for the fabric of
+        the interconnect.
+    :rtype: str
+    """
+    if fabric == 'auto':
+        return interconnect['fabric']
+    if is_rdma_fabric(fabric) and not interconnect['rdma']:
+        print('Fabric {} needs an RDMA capable VM size, using {}'.format(
+            fabric, _TCP_FABRIC))
+        return _TCP_FABRIC
+    return fabric
+
+
+def probe_command(timeout):
+    """Builds the node command waiting for an InfiniBand port to become
+    active. If none does within the timeout, the MPI fabric is switched to
+    tcp and HPC_DFO_FABRIC_FALLBACK=1 is exported.
+
+    :param int timeout: The maximum time to wait in seconds.
+    :rtype: str
+    """
+    return (
+        'for i in $(seq {timeout}); do '
+        'grep -qs ACTIVE {paths} && break; sleep 1; done; '
+        'if grep -qs ACTIVE {paths}; then echo "InfiniBand ready"; else '
+        'echo "InfiniBand not active after {timeout}s, using {tcp}"; '
+        'export I_MPI_FABRICS={tcp} {fallback}=1; '
+        'unset I_MPI_DAPL_PROVIDER; fi'.format(
+            timeout=timeout, paths=_IB_PORT_STATE_PATHS, tcp=_TCP_FABRIC,
+            fallback=_FALLBACK_ENV_NAME))
+
+
+def get_fabric_commands(interconnect, fabric='auto', probe_timeout=120):
+    """Builds the node commands which set up the MPI fabric, to run before
+    the preparation script and the application command. An RDMA fabric is
+    only kept once the InfiniBand port is active, see probe_command.
+
+    :param dict interconnect: The interconnect from get_interconnect.
+    :param str fabric: An I_MPI_FABRICS value, or 'auto'
+    :param int probe_timeout: The maximum time to wait for InfiniBand in
+        seconds.
+    :rtype: list
+    """
+    fabric = resolve_fabric(interconnect, fabric)
+    commands = ['export I_MPI_FABRICS={}'.format(fabric)]
+    if is_rdma_fabric(fabric):
+        commands.extend('export {}={}'.format(name, value)
+                        for name, value in interconnect['environment'])
+        commands.append(probe_command(probe_timeout))
+    return commands
@@ -0,0 +1,172 @@
+from __future__ import print_function
+
+
+# (physical cores, hardware threads per core, NUMA domains) of the VM sizes
+# the jobs run on. HB60rs exposes one NUMA domain per 4 core CCX.
+_VM_TOPOLOGIES = {
+    'standard_a8': (8, 1, 1),
+    'standard_a9': (16, 1, 2),
+    'standard_h8': (8, 1, 1),
+    'standard_h8m': (8, 1, 1),
+    'standard_h16': (16, 1, 2),
+    'standard_h16m': (16, 1, 2),
+    'standard_h16r': (16, 1, 2),
+    'standard_h16mr': (16, 1, 2),
+    'standard_hb60rs': (60, 1, 15),
+    'standard_hc44rs': (44, 1, 2),
+    'standard_f2s_v2': (1, 2, 1),
+    'standard_f4s_v2': (2, 2, 1),
+    'standard_f8s_v2': (4, 2, 1),
+    'standard_f16s_v2': (8, 2, 1),
+    'standard_f32s_v2': (16, 2, 1),
+    'standard_f64s_v2': (32, 2, 2),
+    'standard_f72s_v2': (36, 2, 2),
+    'standard_d2s_v3': (1, 2, 1),
+    'standard_d4s_v3': (2, 2, 1),
+    'standard_d8s_v3': (4, 2, 1),
+    'standard_d16s_v3': (8, 2, 1),
+    'standard_d32s_v3': (16, 2, 1),
+    'standard_d64s_v3': (32, 2, 2),
+}
+
+# One single-threaded rank per core, or one rank per NUMA domain with a
+# thread per core of the domain
+_MPI = 'mpi'
+_HYBRID = 'hybrid'
+_POLICIES = (_MPI, _HYBRID)
+
+
+def get_topology(vm_size):
+    """Looks up the cores, threads per core and NUMA domains of a VM size
+
+    :param str vm_size: The size of VM, eg 'Standard_H16r'
+    :rtype: tuple
+    :return: (physical cores, hardware threads per core, NUMA domains), or
+        None for an unknown size
+    """
+    return _VM_TOPOLOGIES.get(vm_size.lower())
+
+
+def plan_layout(vm_size, node_count, policy=_MPI, ranks_per_node=None,
+                threads_per_rank=None, use_hyperthreads=False,
+                topology=None):
+    """Plans the placement of the MPI ranks and OpenMP threads of a task.
+
+    Unset counts follow the policy: 'mpi' runs a single-threaded rank per
+    core, 'hybrid' a rank per NUMA domain with a thread per core of the
+    domain. Giving only one of the counts derives the other from the cores
+    of the node.
+
+    :param str vm_size: The size of VM.
+    :param int node_count: The number of nodes of the task.
+    :param str policy: 'mpi' or 'hybrid'
+    :param int ranks_per_node: MPI ranks on each node, None for the policy.
+    :param int threads_per_rank: OpenMP threads of each rank, None for the
+        policy.
+    :param bool use_hyperthreads: count hardware threads as cores
+    :param tuple topology: (cores, threads per core, NUMA domains) to use
+        instead of the known topology of vm_size
+    :rtype: dict
+    :return: The layout: nodes, ranks, ranks_per_node, threads_per_rank,
+        slots_per_node and the environment as (name, value) tuples.
+    :raises ValueError: for an unknown VM size without topology, or a
+        layout which oversubscribes the cores
+    """
+    if policy not in _POLICIES:
+        raise ValueError('unknown layout policy {}, expected one of {}'.format(
+            policy, ', '.join(_POLICIES)))
+    if topology is None:
+        topology = get_topology(vm_size)
+        if topology is None:
+            raise ValueError(
+                'unknown topology of VM size {}, set the cores, threads per '
+                'core and NUMA domains explicitly'.format(vm_size))
+    cores, threads_per_core, numa_domains = topology
+    slots = cores * (threads_per_core if use_hyperthreads else 1)
+
+    if ranks_per_node is None and threads_per_rank is None:
+        if policy == _HYBRID:
+            ranks_per_node = numa_domains
+            threads_per_rank = slots // numa_domains
+        else:
+            ranks_per_node, threads_per_rank = slots, 1
+    elif ranks_per_node is None:
+        ranks_per_node = slots // threads_per_rank
+    elif threads_per_rank is None:
+        threads_per_rank = (
+            slots // ranks_per_node if policy == _HYBRID else 1)
+
+    if ranks_per_node < 1 or threads_per_rank < 1:
+        raise ValueError(
+            '{} has {} slot(s) per node, too few for {} rank(s) of {} '
+            'thread(s)'.format(vm_size, slots, ranks_per_node,
+                               threads_per_rank))
+    if ranks_per_node * threads_per_rank > slots:
+        raise ValueError(
+            '{} rank(s) x {} thread(s) oversubscribe the {} slot(s) of '
+            'a {} node'.format(ranks_per_node, threads_per_rank, slots,
+                               vm_size))
+
+    if threads_per_rank == 1:
+        pin_domain = 'core'
+    elif ranks_per_node == numa_domains and \
+            threads_per_rank * numa_domains == slots:
+        pin_domain = 'numa'
+    else:
+        pin_domain = 'omp'
+    environment = [
+        ('OMP_NUM_THREADS', str(threads_per_rank)),
+        ('OMP_PLACES', 'threads' if use_hyperthreads else 'cores'),
+        ('OMP_PROC_BIND', 'close'),
+        ('I_MPI_PIN', '1'),
+        ('I_MPI_PIN_DOMAIN', pin_domain),
+        ('I_MPI_PIN_CELL', 'unit' if use_hyperthreads else 'core'),
+    ]
+    return {
+        'vm_size': vm_size,
+        'nodes': node_count,
+        'ranks': ranks_per_node * node_count,
+        'ranks_per_node': ranks_per_node,
+        'threads_per_rank': threads_per_rank,
+        'slots_per_node': slots,
+        'environment': environment,
+    }
+
+
+def get_layout_commands(layout,
+                        hostfile_path='$AZ_BATCH_TASK_WORKING_DIR/hostfile'):
+    """Builds the node commands exporting a layout to the application
+    command: the pinning and OpenMP variables, HPC_DFO_RANKS,
+    HPC_DFO_RANKS_PER_NODE and HPC_DFO_HOSTFILE, a host:ranks machine file
+    written from $AZ_BATCH_HOST_LIST. Job scripts then run
+    mpirun -n $HPC_DFO_RANKS -ppn $HPC_DFO_RANKS_PER_NODE
+    -machinefile $HPC_DFO_HOSTFILE
+
+    :param dict layout: A layout from plan_layout.
+    :param str hostfile_path: Where to write the machine file on the node.
+    :rtype: list
+    """
+    commands = ['export {}={}'.format(name, value)
+                for name, value in layout['environment']]
+    commands.extend([
+        'export HPC_DFO_RANKS={} HPC_DFO_RANKS_PER_NODE={} '
+        'HPC_DFO_HOSTFILE={}'.format(
+            layout['ranks'], layout['ranks_per_node'], hostfile_path),
+        'echo $AZ_BATCH_HOST_LIST | tr , "\\n" | sed "s/\\$/:{}/" > '
+        '$HPC_DFO_HOSTFILE'.format(layout['ranks_per_node']),
+    ])
+    return commands
+
+
+def format_layout(layout):
+    """Formats a layout as a one line summary
+
+    :param dict layout: A layout from plan_layout.
+    :rtype: str
+    """
+    idle = layout['slots_per_node'] - (
+        layout['ranks_per_node'] * layout['threads_per_rank'])
+    return ('{ranks} rank(s) on {nodes} x {vm_size}: {ranks_per_node} per '
+            'node x {threads_per_rank} thread(s){idle}'.format(
+                idle=', {} idle slot(s) per node'.format(idle) if idle else '',
+                **layout))
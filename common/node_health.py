@@ -0,0 +1,177 @@
+from __future__ import print_function
+import azure.batch.models as batchmodels
+
+import common.helpers
+import common.polling
+
+
+_BAD_STATES = frozenset((
+    batchmodels.ComputeNodeState.start_task_failed,
+    batchmodels.ComputeNodeState.unusable,
+))
+_MAX_REPAIRS = 2
+_MAX_REPLACEMENTS = 2
+# remove_nodes accepts at most 100 nodes per call
+_REMOVE_NODES_MAX = 100
+
+
+class NodeHealthManager(object):
+    """Waits for enough healthy nodes in a pool, repairing the bad ones.
+
+    A node in start_task_failed or unusable state is rebooted first, then
+    reimaged, up to max_repairs times. A node which is still bad after that
+    is removed from the pool and the pool is resized back to its target so
+    the service allocates a replacement, up to max_replacements nodes in
+    total. Waiting ends as soon as required_nodes nodes are idle, the rest
+    of the pool may still be coming up. Preempted low-priority nodes are
+    not repaired, the service brings them back when capacity allows.
+    """
+    def __init__(self, batch_client, pool_id, required_nodes,
+                 max_repairs=_MAX_REPAIRS, max_replacements=_MAX_REPLACEMENTS):
+        self.batch_client = batch_client
+        self.pool_id = pool_id
+        self.required_nodes = required_nodes
+        self.max_repairs = max_repairs
+        self.max_replacements = max_replacements
+        self.repairs = {}
+        self.replacements = 0
+        self.target_dedicated_nodes = None
+        self.target_low_priority_nodes = None
+        self.resize_pending = False
+        self.nodes = []
+        # nodes acted on which have not left their bad state yet
+        self._awaiting_change = set()
+
+    def _repair(self, node):
+        attempt = self.repairs.get(node.id, 0)
+        self.repairs[node.id] = attempt + 1
+        self._awaiting_change.add(node.id)
+        try:
+            if attempt == 0:
+                print('Rebooting node {} ({})'.format(node.id, node.state))
+                self.batch_client.compute_node.reboot(self.pool_id, node.id)
+            else:
+                print('Reimaging node {} ({})'.format(node.id, node.state))
+                self.batch_client.compute_node.reimage(self.pool_id, node.id)
+        except batchmodels.BatchErrorException as err:
+            common.helpers.print_batch_exception(err)
+
+    def _replace(self, node_ids):
+        print('Removing node(s) {} to be replaced'.format(', '.join(node_ids)))
+        self.batch_client.pool.remove_nodes(
+            self.pool_id, batchmodels.NodeRemoveParameter(node_list=node_ids))
+        self.replacements += len(node_ids)
+        self._awaiting_change.update(node_ids)
+        self.resize_pending = True
+
+    def refresh(self):
+        """Reads the pool and its nodes, and starts any repair which is due.
+
+        :rtype: tuple
+        :return: (allocation state, sorted node states) snapshot
+        :raises RuntimeError: if the pool has resize errors or can no longer
+            reach required_nodes usable nodes
+        """
+        pool = self.batch_client.pool.get(
+            self.pool_id, pool_get_options=batchmodels.PoolGetOptions(
+                select='id,allocationState,resizeErrors,targetDedicatedNodes,'
+                       'targetLowPriorityNodes'))
+        if pool.resize_errors is not None:
+            resize_errors = "\n".join([repr(e) for e in pool.resize_errors])
+            raise RuntimeError(
+                'resize error encountered for pool {}:\n{}'.format(
+                    pool.id, resize_errors))
+        if self.target_dedicated_nodes is None:
+            self.target_dedicated_nodes = pool.target_dedicated_nodes
+            self.target_low_priority_nodes = (
+                pool.target_low_priority_nodes or 0)
+        self.nodes = list(self.batch_client.compute_node.list(
+            self.pool_id,
+            compute_node_list_options=batchmodels.ComputeNodeListOptions(
+                select='id,state')))
+        steady = pool.allocation_state == batchmodels.AllocationState.steady
+
+        to_replace = []
+        lost = 0
+        for node in self.nodes:
+            if node.state not in _BAD_STATES:
+                self._awaiting_change.discard(node.id)
+            elif node.id in self._awaiting_change:
+                continue
+            elif self.repairs.get(node.id, 0) < self.max_repairs:
+                self._repair(node)
+            elif self.replacements + len(to_replace) < self.max_replacements:
+                to_replace.append(node.id)
+            else:
+                lost += 1
+
+        if to_replace and steady:
+            self._replace(to_replace[:_REMOVE_NODES_MAX])
+        elif self.resize_pending and steady and not to_replace:
+            print('Resizing pool {} back to {} dedicated and {} low-priority '
+                  'node(s)'.format(self.pool_id, self.target_dedicated_nodes,
+                                   self.target_low_priority_nodes))
+            try:
+                # an unset low-priority target would resize it to 0
+                self.batch_client.pool.resize(
+                    self.pool_id, batchmodels.PoolResizeParameter(
+                        target_dedicated_nodes=self.target_dedicated_nodes,
+                        target_low_priority_nodes=(
+                            self.target_low_priority_nodes)))
+                self.resize_pending = False
+            except batchmodels.BatchErrorException as err:
+                common.helpers.print_batch_exception(err)
+
+        usable = max(len(self.nodes), self.target_dedicated_nodes +
+                     self.target_low_priority_nodes) - lost
+        if usable < self.required_nodes:
+            raise RuntimeError(
+                'pool {} has only {} usable node(s) left, {} required'.format(
+                    self.pool_id, usable, self.required_nodes))
+
+        return (pool.allocation_state,
+                tuple(sorted(node.state for node in self.nodes)))
+
+    def is_done(self, state):
+        """Returns True once required_nodes nodes are idle.
+
+        :param tuple state: A snapshot returned by refresh.
+        :rtype: bool
+        """
+        _, node_states = state
+        healthy = sum(1 for node_state in node_states
+                      if node_state == batchmodels.ComputeNodeState.idle)
+        return healthy >= self.required_nodes
+
+    def healthy_nodes(self):
+        """Returns the idle nodes seen by the latest refresh.
+
+        :rtype: list
+        """
+        return [node for node in self.nodes
+                if node.state == batchmodels.ComputeNodeState.idle]
+
+    def wait(self, timeout=None):
+        """Refreshes and repairs until required_nodes nodes are idle.
+
+        :param timeout: The maximum amount of time to wait, None to wait
+            without a limit.
+        :type timeout: `datetime.timedelta`
+        :rtype: list
+        :return: The idle `azure.batch.models.ComputeNode` of the pool.
+        :raises common.helpers.TimeoutError: if the timeout expires
+        """
+        print('Waiting for {} healthy node(s) in pool {}...'.format(
+            self.required_nodes, self.pool_id))
+
+        def _on_change(_, state):
+            print('  pool {}: {}'.format(
+                state[0], ', '.join(state[1]) or 'no nodes'))
+
+        poller = common.polling.AdaptivePoller()
+        poller.watch(self.pool_id, self.refresh, self.is_done, _on_change)
+        if not poller.run(timeout):
+            raise common.helpers.TimeoutError(
+                'Timed out waiting for {} healthy node(s) in pool {}'.format(
+                    self.required_nodes, self.pool_id))
+        return self.healthy_nodes()
@@ -0,0 +1,556 @@
+from __future__ import print_function
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import azure.batch.models as batchmodels
+from azure.storage.blob import BlobPermissions
+
+sys.path.append('.')
+import common.emulator  # noqa
+import common.helpers  # noqa
+import common.tracing  # noqa
+import common.transfer  # noqa
+import multi_task_helpers  # noqa
+
+
+_HISTORY_FILE_NAME = 'overhead-history.jsonl'
+_BASELINE_RUNS = 5
+_REGRESSION_TOLERANCE = 0.2
+_PERCENTILES = (50, 90, 99)
+_MEGABYTE = 1024 * 1024
+_WORKLOADS = ('upload-small', 'upload-large', 'download', 'submit', 'poll',
+              'jobs')
+# Sizes of the default suite and of --quick, overridden by the options
+_DEFAULT_PARAMS = {
+    'small_files': 10000, 'small_bytes': 4096, 'large_files': 1,
+    'large_mb': 2048, 'download_blobs': 200, 'tasks': 5000,
+    'single_tasks': 200, 'polls': 50, 'jobs': 20, 'tasks_per_job': 100,
+    'nodes': 8, 'tasks_per_node': 4,
+}
+_QUICK_PARAMS = {
+    'small_files': 500, 'small_bytes': 4096, 'large_files': 1,
+    'large_mb': 64, 'download_blobs': 50, 'tasks': 500, 'single_tasks': 50,
+    'polls': 10, 'jobs': 4, 'tasks_per_job': 25, 'nodes': 4,
+    'tasks_per_node': 4,
+}
+_VM_SIZE = 'standard_d2s_v3'
+_IMAGE = ('OpenLogic', 'CentOS', '7.6')
+
+
+def percentiles(values):
+    """Computes the latency percentiles of a list of durations
+
+    :param list values: durations in seconds
+    :rtype: dict
+    :return: p50, p90, p99 and max in milliseconds, empty without values
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {}
+    for percentile in _PERCENTILES:
+        index = min(len(values) - 1,
+                    int(round(percentile / 100.0 * (len(values) - 1))))
+        result['p{}'.format(percentile)] = values[index] * 1000
+    result['max'] = values[-1] * 1000
+    return result
+
+
+def _make_record(workload, params, count, seconds, latencies, size=0,
+                 **extra):
+    record = {
+        'workload': workload,
+        'params': params,
+        'count': count,
+        'bytes': size,
+        'seconds': seconds,
+        'per_second': count / seconds if seconds else 0,
+        'mb_per_second': size / _MEGABYTE / seconds if seconds else 0,
+        'latency_ms': percentiles(latencies),
+    }
+    record.update(extra)
+    return record
+
+
+@contextlib.contextmanager
+def _quiet(verbose):
+    """Silences the progress output of the measured helpers"""
+    if verbose:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+class OverheadSuite(object):
+    """Drives the staging, submission, polling and download helpers of the
+    runner against the local emulator with synthetic workloads.
+
+    Every Batch and Storage call goes through a tracer, so each workload
+    reports its wall time, throughput and the latency percentiles of the
+    calls it makes. The emulated services add no delay unless api_latency
+    is given, which leaves the cost of the Python side.
+    """
+    def __init__(self, root, params, api_latency=0.0, verbose=False):
+        """
+        :param str root: Scratch directory of the emulator and the
+            synthetic files, deleted by close().
+        :param dict params: The workload sizes, see _DEFAULT_PARAMS.
+        :param float api_latency: seconds the emulator adds to every call
+        :param bool verbose: show the output of the measured helpers
+        """
+        self.root = root
+        self.params = params
+        self.verbose = verbose
+        self.tracer = common.tracing.Tracer()
+        batch_client, blob_client = common.emulator.create_clients(
+            root=os.path.join(root, 'emulator'), allocation_delay=0,
+            boot_delay=0, jitter=0, api_latency=api_latency,
+            storage_latency=api_latency)
+        self._emulated_batch_client = batch_client
+        self.batch_client = self.tracer.trace_client(batch_client, 'batch')
+        self.blob_client = self.tracer.trace_client(blob_client, 'storage')
+        self.container_name = common.helpers.generate_unique_resource_name(
+            'overhead').lower()
+        # task outputs are uploaded as on Azure, through a container SAS
+        output_container_name = self.container_name + '-output'
+        self.output_container_sas = common.helpers.make_container_sas_url(
+            blob_client, output_container_name,
+            common.helpers.create_container_and_create_sas(
+                blob_client, output_container_name,
+                BlobPermissions.WRITE, timeout=120))
+        self.job_id = None
+        self.pool_id = None
+
+    def _path(self, *parts):
+        path = os.path.join(self.root, *parts)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        return path
+
+    def _measure(self, function, *args, **kwargs):
+        """Runs function and returns (result, seconds, tracer events before)
+        """
+        first_event = len(self.tracer.events)
+        start = time.time()
+        with _quiet(self.verbose):
+            result = function(*args, **kwargs)
+        return result, time.time() - start, first_event
+
+    def _latencies(self, name, first_event):
+        return [event['dur'] / 1e6 for event in
+                self.tracer.events[first_event:] if event['name'] == name]
+
+    def upload_small(self):
+        """Stages many small files with upload_files_to_container"""
+        count = self.params['small_files']
+        size = self.params['small_bytes']
+        paths = []
+        for index in range(count):
+            path = self._path('small', '{:06d}.dat'.format(index))
+            with open(path, 'wb') as f:
+                # distinct contents, the upload skips duplicates
+                f.write(('{:06d}'.format(index) * (size // 6 + 1))[
+                    :size].encode('ascii'))
+            paths.append(path)
+        _, seconds, first_event = self._measure(
+            common.helpers.upload_files_to_container, self.blob_client,
+            self.container_name, paths, timeout=60, path_prefix='small/')
+        return _make_record(
+            'upload-small', {'files': count, 'bytes': size}, count, seconds,
+            self._latencies('storage.create_blob_from_path', first_event),
+            count * size)
+
+    def upload_large(self):
+        """Uploads large files in parallel blocks with upload_file_in_blocks
+        """
+        count = self.params['large_files']
+        size = self.params['large_mb'] * _MEGABYTE
+        block = os.urandom(_MEGABYTE)
+        paths = []
+        for index in range(count):
+            path = self._path('large', '{:02d}.dat'.format(index))
+            with open(path, 'wb') as f:
+                for _ in range(self.params['large_mb']):
+                    f.write(block)
+            paths.append(path)
+        first_event = len(self.tracer.events)
+        start = time.time()
+        with _quiet(self.verbose):
+            for path in paths:
+                common.transfer.upload_file_in_blocks(
+                    self.blob_client, self.container_name,
+                    'large/' + os.path.basename(path), path,
+                    journal_path=path + '.journal')
+        seconds = time.time() - start
+        for path in paths:
+            os.remove(path)
+        return _make_record(
+            'upload-large', {'files': count, 'mb': self.params['large_mb']},
+            count, seconds, self._latencies('storage.put_block', first_event),
+            count * size, blocks=len(self._latencies(
+                'storage.put_block', first_event)))
+
+    def download(self):
+        """Downloads the staged blobs with download_container, then single
+        small blobs with download_blob_from_container"""
+        records = []
+        directory = self._path('download', 'container')
+        etags_path = common.helpers.get_local_state_path(
+            'downloads', self.container_name + '.json')
+        paths, seconds, first_event = self._measure(
+            common.transfer.download_container, self.blob_client,
+            self.container_name, directory)
+        size = sum(os.path.getsize(path) for path in paths)
+        records.append(_make_record(
+            'download', {'blobs': len(paths), 'mb': size // _MEGABYTE},
+            len(paths), seconds,
+            self._latencies('storage.get_blob_to_bytes', first_event), size))
+        shutil.rmtree(directory, ignore_errors=True)
+        if os.path.isfile(etags_path):
+            os.remove(etags_path)
+
+        blob_names = [
+            blob.name for blob in self.blob_client.list_blobs(
+                self.container_name, prefix='small/')][
+                    :self.params['download_blobs']]
+        directory = self._path('download', 'blobs')
+        os.makedirs(os.path.join(directory, 'small'))
+        first_event = len(self.tracer.events)
+        start = time.time()
+        with _quiet(self.verbose):
+            for blob_name in blob_names:
+                common.helpers.download_blob_from_container(
+                    self.blob_client, self.container_name, blob_name,
+                    directory)
+        seconds = time.time() - start
+        records.append(_make_record(
+            'download-blob', {'blobs': len(blob_names)}, len(blob_names),
+            seconds,
+            self._latencies('storage.get_blob_to_path', first_event),
+            len(blob_names) * self.params['small_bytes']))
+        return records
+
+    def _task(self, task_id, command_line='/bin/true'):
+        return multi_task_helpers.build_task(
+            task_id, 1, command_line, [], batchmodels.ElevationLevel.admin,
+            '../std*.txt', self.output_container_sas, None, [],
+            output_path=task_id)
+
+    def submit(self):
+        """Queues thousands of tasks with add_tasks and single ones with
+        add_task, on a job whose pool has no nodes so none of them runs"""
+        self.pool_id = 'overhead-idle'
+        self.job_id = 'overhead-submit'
+        self.batch_client.pool.add(batchmodels.PoolAddParameter(
+            id=self.pool_id, vm_size=_VM_SIZE, target_dedicated_nodes=0))
+        self.batch_client.job.add(batchmodels.JobAddParameter(
+            id=self.job_id,
+            pool_info=batchmodels.PoolInformation(pool_id=self.pool_id)))
+        count = self.params['tasks']
+        tasks = [self._task('task-{:06d}'.format(index))
+                 for index in range(count)]
+        _, seconds, first_event = self._measure(
+            multi_task_helpers.add_tasks, self.batch_client, self.job_id,
+            tasks)
+        records = [_make_record(
+            'submit-collection', {'tasks': count}, count, seconds,
+            self._latencies('batch.task.add_collection', first_event))]
+
+        count = self.params['single_tasks']
+        first_event = len(self.tracer.events)
+        start = time.time()
+        with _quiet(self.verbose):
+            for index in range(count):
+                multi_task_helpers.add_task(
+                    self.batch_client, self.job_id,
+                    'single-{:06d}'.format(index), 1, '/bin/true', [],
+                    batchmodels.ElevationLevel.admin, '../std*.txt',
+                    self.output_container_sas, None, [])
+        records.append(_make_record(
+            'submit-single', {'tasks': count}, count, time.time() - start,
+            self._latencies('batch.task.add', first_event)))
+        return records
+
+    def poll(self):
+        """Lists the incomplete tasks of the submitted job repeatedly, the
+        query each waiter poll makes"""
+        if self.job_id is None:
+            self.submit()
+        count = self.params['polls']
+        first_event = len(self.tracer.events)
+        durations = []
+        start = time.time()
+        for _ in range(count):
+            poll_start = time.time()
+            incomplete = common.helpers.list_incomplete_task_ids(
+                self.batch_client, self.job_id)
+            durations.append(time.time() - poll_start)
+        seconds = time.time() - start
+        return _make_record(
+            'poll', {'tasks': len(incomplete), 'polls': count}, count,
+            seconds, durations,
+            service_latency_ms=percentiles(
+                self._latencies('batch.task.list', first_event)))
+
+    def jobs(self):
+        """Runs many concurrent jobs of trivial tasks on an emulated pool,
+        from pool creation through submission to the waiter returning"""
+        params = self.params
+        pool_id = 'overhead-jobs'
+        start = time.time()
+        with _quiet(self.verbose):
+            multi_task_helpers.create_pool_and_wait_for_vms(
+                self.batch_client, pool_id, _IMAGE[0], _IMAGE[1], _IMAGE[2],
+                _VM_SIZE, params['nodes'],
+                max_tasks_per_node=params['tasks_per_node'])
+        pool_seconds = time.time() - start
+
+        def _submit_job(index):
+            job_id = 'overhead-job-{:03d}'.format(index)
+            common.helpers.create_job(self.batch_client, job_id, pool_id)
+            multi_task_helpers.add_tasks(
+                self.batch_client, job_id,
+                [self._task('task-{:04d}'.format(task_index))
+                 for task_index in range(params['tasks_per_job'])])
+            return job_id
+
+        start = time.time()
+        with _quiet(self.verbose):
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=params['jobs']) as executor:
+                job_ids = list(executor.map(_submit_job,
+                                            range(params['jobs'])))
+            # one loop waits for every job
+            multi_task_helpers.wait_for_jobs_to_complete(
+                self.batch_client, job_ids, datetime.timedelta(minutes=30))
+        waited = datetime.datetime.utcnow()
+        seconds = time.time() - start
+
+        queue_latencies = []
+        last_end = None
+        for job_id in job_ids:
+            tasks = self._emulated_batch_client.task.list(job_id)
+            for task in tasks:
+                queue_latencies.append((
+                    task.execution_info.start_time -
+                    task.creation_time).total_seconds())
+                if last_end is None or task.execution_info.end_time > last_end:
+                    last_end = task.execution_info.end_time
+            self.batch_client.job.delete(job_id)
+        self.batch_client.pool.delete(pool_id)
+        count = params['jobs'] * params['tasks_per_job']
+        return _make_record(
+            'jobs', {key: params[key] for key in (
+                'jobs', 'tasks_per_job', 'nodes', 'tasks_per_node')},
+            count, seconds, queue_latencies, pool_seconds=pool_seconds,
+            detection_lag_ms=percentiles(
+                [max(0.0, (waited - last_end).total_seconds())]))
+
+    def run(self, workloads):
+        """Runs workloads in the suite order
+
+        :param list workloads: names from _WORKLOADS
+        :rtype: list
+        :return: The records of every workload.
+        """
+        methods = {
+            'upload-small': self.upload_small,
+            'upload-large': self.upload_large,
+            'download': self.download,
+            'submit': self.submit,
+            'poll': self.poll,
+            'jobs': self.jobs,
+        }
+        records = []
+        for workload in _WORKLOADS:
+            if workload not in workloads:
+                continue
+            print('Running {}...'.format(workload))
+            result = methods[workload]()
+            for record in (result if isinstance(result, list) else [result]):
+                print('  ' + format_record(record))
+                records.append(record)
+        return records
+
+    def close(self):
+        self._emulated_batch_client.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def get_history_path():
+    """Returns the path of the local orchestration overhead history
+
+    :rtype: str
+    """
+    return common.helpers.get_local_state_path(
+        'benchmarks', _HISTORY_FILE_NAME)
+
+
+def load_history(history_path=None):
+    """Loads all records of the overhead history
+
+    :param str history_path: The history file, defaults to get_history_path.
+    :rtype: list
+    """
+    if history_path is None:
+        history_path = get_history_path()
+    if not os.path.isfile(history_path):
+        return []
+    with open(history_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(records, history_path=None):
+    """Appends records to the overhead history
+
+    :param list records: The records to append.
+    :param str history_path: The history file, defaults to get_history_path.
+    """
+    if history_path is None:
+        history_path = get_history_path()
+    with open(history_path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _get_commit():
+    """Returns the short commit id of the working tree, or None"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_with_history(record, history, baseline_runs=_BASELINE_RUNS):
+    """Compares the throughput and median latency of a record with the
+    median of the latest earlier runs of the same workload, sizes and
+    emulated API latency.
+
+    :param dict record: The record of the new run.
+    :param list history: Earlier records, oldest first.
+    :param int baseline_runs: The number of earlier runs in the baseline.
+    :rtype: dict
+    :return: metric -> (baseline, value, change), change being relative
+        and positive when worse; empty without earlier runs
+    """
+    earlier = [other for other in history
+               if other['workload'] == record['workload'] and
+               other['params'] == record['params'] and
+               other.get('api_latency_ms') == record.get('api_latency_ms') and
+               other['run_id'] != record['run_id']][-baseline_runs:]
+    if not earlier:
+        return {}
+    comparison = {}
+    checks = (
+        ('per_second', lambda r: r['per_second'], -1),
+        ('p50_ms', lambda r: r['latency_ms'].get('p50'), 1),
+    )
+    for metric, getter, direction in checks:
+        value = getter(record)
+        baseline_values = [getter(other) for other in earlier
+                           if getter(other) is not None]
+        if value is None or not baseline_values:
+            continue
+        baseline = statistics.median(baseline_values)
+        if baseline > 0:
+            comparison[metric] = (
+                baseline, value, direction * (value - baseline) / baseline)
+    return comparison
+
+
+def format_record(record):
+    """Formats a record as a one line summary
+
+    :param dict record: The record to format.
+    :rtype: str
+    """
+    latency = record['latency_ms']
+    line = '{:<18} {:>7} in {:>8.2f}s {:>10.1f}/s'.format(
+        record['workload'], record['count'], record['seconds'],
+        record['per_second'])
+    if record['bytes']:
+        line += ' {:>8.1f} MB/s'.format(record['mb_per_second'])
+    if latency:
+        line += '  p50 {p50:.2f} p90 {p90:.2f} p99 {p99:.2f} max {max:.2f} ' \
+            'ms'.format(**latency)
+    if 'detection_lag_ms' in record:
+        line += ', completion seen {:.0f} ms late'.format(
+            record['detection_lag_ms'].get('p50', 0))
+    return line
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure the orchestration overhead of the runner '
+        'against the local emulator')
+    parser.add_argument('--workloads', default=','.join(_WORKLOADS),
+                        help='comma separated subset of {}'.format(
+                            ', '.join(_WORKLOADS)))
+    parser.add_argument('--quick', action='store_true',
+                        help='run small versions of the workloads')
+    for name, value in sorted(_DEFAULT_PARAMS.items()):
+        parser.add_argument('--' + name.replace('_', '-'), type=int,
+                            help='default {}, {} with --quick'.format(
+                                value, _QUICK_PARAMS[name]))
+    parser.add_argument('--api-latency-ms', type=float, default=0,
+                        help='latency the emulator adds to every call')
+    parser.add_argument('--root',
+                        help='scratch directory, defaults to a temporary one')
+    parser.add_argument('--no-record', action='store_true',
+                        help='do not append the results to the history')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the output of the measured helpers')
+    args = parser.parse_args()
+
+    params = dict(_QUICK_PARAMS if args.quick else _DEFAULT_PARAMS)
+    for name in params:
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+    workloads = [name.strip() for name in args.workloads.split(',')]
+    unknown = set(workloads) - set(_WORKLOADS)
+    if unknown:
+        parser.error('unknown workload(s) {}'.format(', '.join(unknown)))
+    if 'download' in workloads and 'upload-small' not in workloads:
+        parser.error('download needs the blobs of upload-small')
+
+    suite = OverheadSuite(
+        args.root or tempfile.mkdtemp(prefix='hpc-dfo-overhead-'), params,
+        api_latency=args.api_latency_ms / 1000.0, verbose=args.verbose)
+    try:
+        records = suite.run(workloads)
+    finally:
+        suite.close()
+
+    run_id = common.helpers.generate_unique_resource_name('overhead')
+    history = load_history()
+    for record in records:
+        record.update({
+            'run_id': run_id,
+            'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'commit': _get_commit(),
+            'api_latency_ms': args.api_latency_ms,
+        })
+        for metric, (baseline, value, change) in sorted(
+                compare_with_history(record, history).items()):
+            print('{} {}: {:.2f} vs baseline {:.2f} ({:+.0%}{})'.format(
+                record['workload'], metric, value, baseline,
+                (value - baseline) / baseline,
+                ', worse' if change > _REGRESSION_TOLERANCE else ''))
+    if not args.no_record:
+        append_history(records)
+        print('Results appended to {}'.format(get_history_path()))
@@ -0,0 +1,84 @@
+from __future__ import print_function
+import gzip
+import os
+import tarfile
+
+import common.helpers
+
+
+_ARCHIVE_SUFFIX = '.tar.gz'
+_COMPRESS_LEVEL = 6
+
+
+def get_archive_path(container_name, directory):
+    """Returns the local path of the archive packed from a job directory
+
+    :param str container_name: The name of the container the archive is
+        staged to.
+    :param str directory: The directory being packed.
+    :rtype: str
+    :return: The path of the archive file.
+    """
+    archive_name = os.path.basename(os.path.normpath(directory)) + \
+        _ARCHIVE_SUFFIX
+    return common.helpers.get_local_state_path(
+        'archives', container_name, archive_name)
+
+
+def pack_directory(directory, archive_path, max_member_size=None):
+    """Packs the files of a directory into a gzipped tar archive.
+
+    Members are stored relative to the parent of directory (so the archive
+    of jobs/pingpong/shared unpacks to shared/...), in sorted order and with
+    owner and gzip header timestamps cleared. Packing unchanged files
+    therefore produces a byte-identical archive, which lets content-hash
+    based staging skip the upload.
+
+    :param str directory: The directory to pack.
+    :param str archive_path: The path of the archive to write.
+    :param int max_member_size: files larger than this many bytes are left
+        out of the archive, None packs every file
+    :rtype: list
+    :return: The absolute paths of the files left out of the archive.
+    """
+    base_path = os.path.dirname(os.path.abspath(directory))
+    packed_paths = []
+    skipped_paths = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.abspath(os.path.join(dirpath, filename))
+            if (max_member_size is not None and
+                    os.path.getsize(file_path) > max_member_size):
+                skipped_paths.append(file_path)
+            else:
+                packed_paths.append(file_path)
+
+    print('Packing {} file(s) from {} into {}...'.format(
+        len(packed_paths), directory, archive_path))
+    with open(archive_path, 'wb') as archive_file, \
+            gzip.GzipFile(filename='', mode='wb', fileobj=archive_file,
+                          compresslevel=_COMPRESS_LEVEL, mtime=0) as gz, \
+            tarfile.open(fileobj=gz, mode='w') as tar:
+        for file_path in packed_paths:
+            arcname = os.path.relpath(file_path, base_path).replace(
+                os.sep, '/')
+            info = tar.gettarinfo(file_path, arcname=arcname)
+            info.uid = info.gid = 0
+            info.uname = info.gname = ''
+            with open(file_path, 'rb') as member:
+                tar.addfile(info, member)
+
+    return skipped_paths
+
+
+def unpack_command(archive_file_path):
+    """Builds the node-side command which unpacks an archive created by
+    pack_directory into the current working directory.
+
+    :param str archive_file_path: The path of the archive on the node,
+        environment variables such as $AZ_BATCH_TASK_SHARED_DIR are allowed.
+    :rtype: str
+    :return: The shell command.
+    """
+    return 'tar -xzf {}'.format(archive_file_path)
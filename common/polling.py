@@ -0,0 +1,108 @@
+from __future__ import print_function
+import time
+
+
+_MIN_INTERVAL = 2.0
+_MAX_INTERVAL = 30.0
+_BACKOFF = 1.5
+
+
+class _Watch(object):
+    """A single thing being polled by an AdaptivePoller.
+    """
+    def __init__(self, poll, is_done, on_change, interval):
+        self.poll = poll
+        self.is_done = is_done
+        self.on_change = on_change
+        self.interval = interval
+        self.next_poll = 0.0
+        self.state = None
+        self.polled = False
+
+
+class AdaptivePoller(object):
+    """Polls any number of watches from one loop with adaptive intervals.
+
+    Each watch is polled again after a short interval while its state keeps
+    changing; every poll which returns the same state as the previous one
+    backs the interval off, up to a maximum. This keeps latency low right
+    after a transition without spending API calls on steady state.
+
+    A watch is a `poll` callable returning a comparable snapshot of the
+    state (ideally built from an OData `$select`/`$filter` query so only the
+    needed fields are transferred) and an `is_done` callable deciding from
+    that snapshot whether the watch is finished.
+    """
+    def __init__(self, min_interval=_MIN_INTERVAL, max_interval=_MAX_INTERVAL,
+                 backoff=_BACKOFF):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.results = {}
+        self._watches = {}
+
+    def watch(self, key, poll, is_done, on_change=None):
+        """Adds a watch, which is polled right away on the next run.
+
+        :param key: A hashable key identifying the watch in results.
+        :param poll: callable returning the current state snapshot
+        :param is_done: callable taking a state and returning True once the
+            watch is finished
+        :param on_change: optional callable taking (key, state), invoked
+            whenever the state differs from the previous poll
+        """
+        self._watches[key] = _Watch(
+            poll, is_done, on_change, self.min_interval)
+
+    def pending(self):
+        """Returns the keys of the watches which are not finished.
+
+        :rtype: list
+        """
+        return list(self._watches)
+
+    def _poll(self, key, watch, now):
+        state = watch.poll()
+        if not watch.polled or state != watch.state:
+            watch.interval = self.min_interval
+            if watch.on_change is not None:
+                watch.on_change(key, state)
+        else:
+            watch.interval = min(
+                watch.interval * self.backoff, self.max_interval)
+        watch.polled = True
+        watch.state = state
+        watch.next_poll = now + watch.interval
+        if watch.is_done(state):
+            del self._watches[key]
+            self.results[key] = state
+
+    def run(self, timeout):
+        """Polls the watches until all are finished or the timeout expires.
+
+        The final state of each finished watch is stored in results.
+
+        :param timeout: The maximum amount of time to wait, None to wait
+            without a limit.
+        :type timeout: `datetime.timedelta`
+        :rtype: bool
+        :return: True if every watch finished, False on timeout.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout.total_seconds()
+        while self._watches:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                return False
+            due = [(key, watch) for key, watch in self._watches.items()
+                   if watch.next_poll <= now]
+            for key, watch in due:
+                self._poll(key, watch, now)
+            if self._watches:
+                next_poll = min(
+                    watch.next_poll for watch in self._watches.values())
+                if deadline is not None:
+                    next_poll = min(next_poll, deadline)
+                time.sleep(max(0.0, next_poll - time.time()))
+        return True
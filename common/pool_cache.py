@@ -0,0 +1,194 @@
+from __future__ import print_function
+import datetime
+import hashlib
+import os
+import time
+
+import azure.batch.models as batchmodels
+
+import common.helpers
+
+
+_HASH_METADATA_NAME = 'hpc-dfo-config-hash'
+_TTL_METADATA_NAME = 'hpc-dfo-idle-ttl-minutes'
+_LAST_USED_METADATA_NAME = 'hpc-dfo-last-used'
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# Set to 1 for tasks on nodes which the start task of the warm pool already
+# prepared, so the preparation script can skip the package installs
+_PREPARED_ENV_NAME = 'HPC_DFO_NODE_PREPARED'
+
+
+def get_config_hash(config, sections=('node', 'pool'), excluded_keys=()):
+    """Hashes the settings of config sections which define a pool
+
+    :param config: The job configuration.
+    :type config: `configparser.ConfigParser`
+    :param tuple sections: The sections to hash.
+    :param excluded_keys: keys which do not change the pool itself
+    :type excluded_keys: iterable of str
+    :rtype: str
+    :return: A short hex digest, stable for equal settings.
+    """
+    excluded_keys = set(key.lower() for key in excluded_keys)
+    digest = hashlib.sha1()
+    for section in sections:
+        if not config.has_section(section):
+            continue
+        for key, value in sorted(config.items(section)):
+            if key.lower() not in excluded_keys:
+                digest.update('{}.{}={}\n'.format(
+                    section, key.lower(), value.strip()).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+def get_pool_metadata(config_hash, idle_ttl):
+    """Builds the metadata which marks a pool as a reusable warm pool
+
+    :param str config_hash: The hash of the pool configuration.
+    :param idle_ttl: How long the pool may stay idle before it is evicted.
+    :type idle_ttl: `datetime.timedelta`
+    :rtype: list
+    :return: A list of `azure.batch.models.MetadataItem`
+    """
+    return [
+        batchmodels.MetadataItem(name=_HASH_METADATA_NAME, value=config_hash),
+        batchmodels.MetadataItem(
+            name=_TTL_METADATA_NAME,
+            value=str(int(idle_ttl.total_seconds() // 60))),
+        batchmodels.MetadataItem(
+            name=_LAST_USED_METADATA_NAME,
+            value=datetime.datetime.utcnow().strftime(_TIME_FORMAT)),
+    ]
+
+
+def get_preparation_digest(directory):
+    """Digests the files of the preparation directory, so that nodes
+    prepared by an older version of it are prepared again.
+
+    :param str directory: The directory of the preparation script.
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(dirpath, filename)
+            digest.update('{}={}\n'.format(
+                os.path.relpath(file_path, directory).replace(os.sep, '/'),
+                common.helpers.compute_file_hash(file_path)).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+def _get_prepared_marker(digest):
+    return '$AZ_BATCH_NODE_SHARED_DIR/.hpc-dfo-prepared-{}'.format(digest)
+
+
+def get_mark_prepared_command(digest):
+    """The start task command which records that the node was prepared.
+
+    :param str digest: The digest from get_preparation_digest.
+    :rtype: str
+    """
+    return 'touch {}'.format(_get_prepared_marker(digest))
+
+
+def get_check_prepared_command(digest):
+    """The task command which exports HPC_DFO_NODE_PREPARED=1 on nodes
+    which the start task prepared.
+
+    :param str digest: The digest from get_preparation_digest.
+    :rtype: str
+    """
+    return 'if [ -f {} ]; then export {}=1; fi'.format(
+        _get_prepared_marker(digest), _PREPARED_ENV_NAME)
+
+
+def find_warm_pool(batch_client, pool_id):
+    """Looks up a warm pool which new jobs can be queued onto. A pool which
+    is being deleted is waited on and treated as missing.
+
+    :param batch_client: The batch client to use.
+    :type batch_client: `batchserviceclient.BatchServiceClient`
+    :param str pool_id: The id of the pool.
+    :rtype: `azure.batch.models.CloudPool`
+    :return: The pool, or None if it does not exist.
+    """
+    while True:
+        try:
+            pool = batch_client.pool.get(pool_id)
+        except batchmodels.BatchErrorException as err:
+            if err.error.code != 'PoolNotFound':
+                raise
+            return None
+        if pool.state != batchmodels.PoolState.deleting:
+            print('Found warm pool [{}] with {} node(s)'.format(
+                pool_id, pool.current_dedicated_nodes))
+            return pool
+        print('Waiting for pool [{}] to finish deleting...'.format(pool_id))
+        time.sleep(10)
+
+
+def touch_pool(batch_client, pool_id):
+    """Records that a warm pool was just used, restarting its idle TTL.
+
+    :param batch_client: The batch client to use.
+    :type batch_client: `batchserviceclient.BatchServiceClient`
+    :param str pool_id: The id of the pool.
+    """
+    pool = batch_client.pool.get(
+        pool_id, pool_get_options=batchmodels.PoolGetOptions(
+            select='id,metadata'))
+    metadata = [item for item in pool.metadata or []
+                if item.name != _LAST_USED_METADATA_NAME]
+    metadata.append(batchmodels.MetadataItem(
+        name=_LAST_USED_METADATA_NAME,
+        value=datetime.datetime.utcnow().strftime(_TIME_FORMAT)))
+    batch_client.pool.patch(
+        pool_id, batchmodels.PoolPatchParameter(metadata=metadata))
+
+
+def evict_idle_pools(batch_client, now=None):
+    """Deletes warm pools with no active job which have been idle for
+    longer than the TTL recorded in their metadata. Their autoscale
+    formula already released the nodes, this removes the pools themselves.
+    Pools which were never used count as idle since their creation.
+
+    :param batch_client: The batch client to use.
+    :type batch_client: `batchserviceclient.BatchServiceClient`
+    :param now: The current UTC time, defaults to utcnow.
+    :type now: `datetime.datetime`
+    :rtype: list
+    :return: The ids of the pools which were deleted.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    busy_pool_ids = set(
+        job.pool_info.pool_id for job in batch_client.job.list(
+            job_list_options=batchmodels.JobListOptions(
+                filter="state eq 'active'", select='id,poolInfo'))
+        if job.pool_info is not None)
+
+    evicted = []
+    pools = batch_client.pool.list(
+        pool_list_options=batchmodels.PoolListOptions(
+            filter="state eq 'active'", select='id,metadata,creationTime'))
+    for pool in pools:
+        metadata = {item.name: item.value for item in pool.metadata or []}
+        if (_HASH_METADATA_NAME not in metadata or
+                _TTL_METADATA_NAME not in metadata or
+                pool.id in busy_pool_ids):
+            continue
+        if _LAST_USED_METADATA_NAME in metadata:
+            last_used = datetime.datetime.strptime(
+                metadata[_LAST_USED_METADATA_NAME], _TIME_FORMAT)
+        else:
+            last_used = pool.creation_time.replace(tzinfo=None)
+        idle_ttl = datetime.timedelta(
+            minutes=int(metadata[_TTL_METADATA_NAME]))
+        if now - last_used > idle_ttl:
+            print('Evicting warm pool [{}], idle since {}'.format(
+                pool.id, last_used))
+            batch_client.pool.delete(pool.id)
+            evicted.append(pool.id)
+    return evicted
@@ -0,0 +1,361 @@
+from __future__ import print_function
+import argparse
+import calendar
+import datetime
+import json
+import os
+import time
+
+import azure.batch.models as batchmodels
+
+import common.helpers
+
+
+_ACCOUNTING_FILE_NAME = 'runs.jsonl'
+_FALLBACK_DELAY = datetime.timedelta(minutes=10)
+_SECONDS_PER_HOUR = 3600.0
+
+
+def _to_seconds(timestamp):
+    """Converts a datetime (naive UTC or aware) to epoch seconds"""
+    return (calendar.timegm(timestamp.utctimetuple()) +
+            timestamp.microsecond / 1e6)
+
+
+class PreemptionMonitor(object):
+    """Watches the nodes of a pool and the tasks of a job while it runs,
+    accounting for low-priority nodes being preempted.
+
+    Batch requeues the tasks of a preempted node by itself, a multi-instance
+    task as a whole when any of its nodes goes. Every preemption and every
+    requeue is reported, and the node time the requeued attempt had run, up
+    to the refresh which saw the requeue, is counted as lost. When nodes stay preempted for longer than fallback_delay, the pool gets as
+    many dedicated nodes on top of its target, up to max_fallback_nodes in
+    total, so the requeued tasks are not left waiting for capacity to come
+    back. Fallback nodes stay until the pool is deleted.
+
+    The core-hours of the dedicated and the low-priority nodes are counted
+    from their allocation, or from the start of the monitoring for the nodes
+    of a warm pool, to the latest refresh. Time spent preempted is not
+    billed and counted apart.
+    """
+    def __init__(self, batch_client, pool_id, job_id, cores_per_node,
+                 max_fallback_nodes=0, fallback_delay=_FALLBACK_DELAY,
+                 started=None):
+        """
+        :param batch_client: The batch client to use.
+        :type batch_client: `batchserviceclient.BatchServiceClient`
+        :param str pool_id: The id of the pool.
+        :param str job_id: The id of the job.
+        :param int cores_per_node: vCPUs of the VM size, billed per hour.
+        :param int max_fallback_nodes: dedicated nodes which may be added in
+            place of preempted ones
+        :param fallback_delay: How long nodes stay preempted before they are
+            replaced.
+        :type fallback_delay: `datetime.timedelta`
+        :param float started: Epoch seconds the run started at, node time
+            before it is not counted. Defaults to now.
+        """
+        self.batch_client = batch_client
+        self.pool_id = pool_id
+        self.job_id = job_id
+        self.cores_per_node = cores_per_node
+        self.max_fallback_nodes = max_fallback_nodes
+        self.fallback_delay = fallback_delay.total_seconds()
+        self.started = time.time() if started is None else started
+        self.fallback_nodes = 0
+        self.preemptions = 0
+        self.requeues = 0
+        # node seconds, keyed by is_dedicated
+        self.node_seconds = {True: 0.0, False: 0.0}
+        self.preempted_seconds = 0.0
+        self.lost_node_seconds = 0.0
+        # node id -> [is_dedicated, state, accounted until, preempted since]
+        self._nodes = {}
+        # task id -> [requeue count, start of the running attempt, nodes]
+        self._tasks = {}
+        self._completed_task_ids = set()
+        self._seeded = False
+
+    def _refresh_nodes(self, now):
+        nodes = self.batch_client.compute_node.list(
+            self.pool_id,
+            compute_node_list_options=batchmodels.ComputeNodeListOptions(
+                select='id,state,isDedicated,allocationTime'))
+        seen = {}
+        for node in nodes:
+            is_dedicated = node.is_dedicated is not False
+            entry = self._nodes.get(node.id)
+            if entry is None:
+                since = (_to_seconds(node.allocation_time)
+                         if node.allocation_time is not None else now)
+                # warm pool nodes were allocated for an earlier run
+                since = max(since, self.started)
+                entry = [is_dedicated, None, min(since, now), None]
+            elapsed = now - entry[2]
+            if entry[1] == batchmodels.ComputeNodeState.preempted:
+                self.preempted_seconds += elapsed
+            else:
+                self.node_seconds[is_dedicated] += elapsed
+            entry[2] = now
+
+            if node.state == batchmodels.ComputeNodeState.preempted:
+                if entry[1] != batchmodels.ComputeNodeState.preempted:
+                    self.preemptions += 1
+                    entry[3] = now
+                    print('Node {} preempted'.format(node.id))
+            elif entry[1] == batchmodels.ComputeNodeState.preempted:
+                print('Node {} is back after {:.0f}s preempted'.format(
+                    node.id, now - entry[3]))
+                entry[3] = None
+            entry[1] = node.state
+            seen[node.id] = entry
+        self._nodes = seen
+
+    def _refresh_tasks(self, now):
+        task_filter = None if not self._seeded else "state ne 'completed'"
+        tasks = list(self.batch_client.task.list(
+            self.job_id, task_list_options=batchmodels.TaskListOptions(
+                filter=task_filter,
+                select='id,state,executionInfo,multiInstanceSettings')))
+        incomplete_ids = set()
+        for task in tasks:
+            info = task.execution_info
+            requeue_count = (info.requeue_count or 0) if info else 0
+            instances = int(
+                task.multi_instance_settings.number_of_instances
+                if task.multi_instance_settings is not None else 1)
+            entry = self._tasks.setdefault(
+                task.id, [requeue_count, None, instances])
+            if requeue_count > entry[0]:
+                self.requeues += requeue_count - entry[0]
+                lost = (now - entry[1]) * entry[2] if entry[1] else 0.0
+                self.lost_node_seconds += lost
+                print('Task {} requeued, {:.2f} node-hour(s) lost'.format(
+                    task.id, lost / _SECONDS_PER_HOUR))
+                entry[0] = requeue_count
+                entry[1] = None
+            if task.state == batchmodels.TaskState.completed:
+                self._completed_task_ids.add(task.id)
+                continue
+            incomplete_ids.add(task.id)
+            if task.state == batchmodels.TaskState.running and \
+                    info is not None and info.start_time is not None:
+                entry[1] = _to_seconds(info.start_time)
+        if self._seeded:
+            self._completed_task_ids.update(
+                task_id for task_id in self._tasks
+                if task_id not in incomplete_ids)
+        self._seeded = True
+
+    def _fall_back(self, now):
+        overdue = sum(1 for entry in self._nodes.values()
+                      if entry[3] is not None and
+                      now - entry[3] >= self.fallback_delay)
+        wanted = min(overdue, self.max_fallback_nodes)
+        if wanted <= self.fallback_nodes:
+            return
+        pool = self.batch_client.pool.get(
+            self.pool_id, pool_get_options=batchmodels.PoolGetOptions(
+                select='id,allocationState,enableAutoScale,'
+                       'targetDedicatedNodes,targetLowPriorityNodes'))
+        if pool.enable_auto_scale or \
+                pool.allocation_state != batchmodels.AllocationState.steady:
+            return
+        added = wanted - self.fallback_nodes
+        print('Adding {} dedicated node(s) to pool {} in place of preempted '
+              'ones'.format(added, self.pool_id))
+        try:
+            self.batch_client.pool.resize(
+                self.pool_id, batchmodels.PoolResizeParameter(
+                    target_dedicated_nodes=pool.target_dedicated_nodes + added,
+                    target_low_priority_nodes=(
+                        pool.target_low_priority_nodes)))
+            self.fallback_nodes = wanted
+        except batchmodels.BatchErrorException as err:
+            common.helpers.print_batch_exception(err)
+
+    def refresh(self):
+        """Reads the nodes and the tasks, accounts the time since the last
+        refresh and adds fallback nodes when they are due.
+
+        :rtype: tuple
+        :return: (preemptions, requeues, preempted nodes) snapshot
+        """
+        now = time.time()
+        self._refresh_nodes(now)
+        self._refresh_tasks(now)
+        if self.max_fallback_nodes:
+            self._fall_back(now)
+        return (self.preemptions, self.requeues, sum(
+            1 for entry in self._nodes.values() if entry[3] is not None))
+
+    def get_accounting(self, dedicated_price=0.0, low_priority_price=0.0,
+                       failed_task_ids=()):
+        """Summarizes the node time of the run so far
+
+        :param float dedicated_price: price of a dedicated core-hour
+        :param float low_priority_price: price of a low-priority core-hour
+        :param failed_task_ids: The ids of the completed tasks which failed,
+            not counted as done work.
+        :type failed_task_ids: iterable of str
+        :rtype: dict
+        """
+        dedicated = (self.node_seconds[True] * self.cores_per_node /
+                     _SECONDS_PER_HOUR)
+        low_priority = (self.node_seconds[False] * self.cores_per_node /
+                        _SECONDS_PER_HOUR)
+        cost = dedicated * dedicated_price + low_priority * low_priority_price
+        succeeded = len(self._completed_task_ids - set(failed_task_ids))
+        return {
+            'pool_id': self.pool_id,
+            'job_id': self.job_id,
+            'dedicated_core_hours': round(dedicated, 3),
+            'low_priority_core_hours': round(low_priority, 3),
+            'preempted_core_hours': round(
+                self.preempted_seconds * self.cores_per_node /
+                _SECONDS_PER_HOUR, 3),
+            'lost_core_hours': round(
+                self.lost_node_seconds * self.cores_per_node /
+                _SECONDS_PER_HOUR, 3),
+            'preemptions': self.preemptions,
+            'requeues': self.requeues,
+            'fallback_nodes': self.fallback_nodes,
+            'succeeded_tasks': succeeded,
+            'cost': round(cost, 4),
+            'cost_per_task': round(cost / succeeded, 4) if succeeded else None,
+        }
+
+
+def format_accounting(accounting):
+    """Formats the accounting of a run as a few lines
+
+    :param dict accounting: From get_accounting, with the run fields.
+    :rtype: str
+    """
+    lines = [
+        'Core-hours: {dedicated_core_hours} dedicated, '
+        '{low_priority_core_hours} low-priority'.format(**accounting),
+        'Preemptions: {preemptions}, {requeues} task requeue(s), '
+        '{lost_core_hours} core-hour(s) of work lost, '
+        '{preempted_core_hours} core-hour(s) preempted, '
+        '{fallback_nodes} dedicated fallback node(s)'.format(**accounting),
+    ]
+    if accounting['cost']:
+        lines.append('Cost: {cost} for {succeeded_tasks} succeeded task(s), '
+                     '{per_task} per task'.format(per_task=accounting['cost_per_task'],
+                                       **accounting))
+    return '\n'.join(lines)
+
+
+def get_accounting_path():
+    """Returns the path of the local history of run accountings
+
+    :rtype: str
+    """
+    return common.helpers.get_local_state_path(
+        'accounting', _ACCOUNTING_FILE_NAME)
+
+
+def load_accountings(accounting_path=None):
+    """Loads the accountings of all recorded runs
+
+    :param str accounting_path: The history file, defaults to
+        get_accounting_path.
+    :rtype: list
+    """
+    if accounting_path is None:
+        accounting_path = get_accounting_path()
+    if not os.path.isfile(accounting_path):
+        return []
+    with open(accounting_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_accounting(accounting, accounting_path=None):
+    """Appends the accounting of a run to the history
+
+    :param dict accounting: The accounting to append.
+    :param str accounting_path: The history file, defaults to
+        get_accounting_path.
+    """
+    if accounting_path is None:
+        accounting_path = get_accounting_path()
+    with open(accounting_path, 'a') as f:
+        f.write(json.dumps(accounting, sort_keys=True) + '\n')
+
+
+def compare_mixes(accountings):
+    """Averages the recorded runs per VM size and node mix, cheapest cost
+    per task first
+
+    :param list accountings: Run accountings, eg from load_accountings.
+    :rtype: list
+    :return: dicts of vm_size, dedicated_nodes, low_priority_nodes, runs,
+        and the mean hours, cost_per_task, tasks_per_core_hour and
+        lost_share (lost over billed core-hours)
+    """
+    groups = {}
+    for accounting in accountings:
+        key = (accounting.get('vm_size'), accounting.get('dedicated_nodes'),
+               accounting.get('low_priority_nodes'))
+        groups.setdefault(key, []).append(accounting)
+
+    def _mean(values):
+        values = [value for value in values if value is not None]
+        return sum(values) / len(values) if values else None
+
+    mixes = []
+    for (vm_size, dedicated, low_priority), runs in groups.items():
+        core_hours = [run['dedicated_core_hours'] +
+                      run['low_priority_core_hours'] for run in runs]
+        mixes.append({
+            'vm_size': vm_size,
+            'dedicated_nodes': dedicated,
+            'low_priority_nodes': low_priority,
+            'runs': len(runs),
+            'hours': _mean([run.get('hours') for run in runs]),
+            'cost_per_task': _mean([run['cost_per_task'] for run in runs]),
+            'tasks_per_core_hour': _mean([
+                run['succeeded_tasks'] / hours if hours else None
+                for run, hours in zip(runs, core_hours)]),
+            'lost_share': _mean([
+                run['lost_core_hours'] / hours if hours else None
+                for run, hours in zip(runs, core_hours)]),
+        })
+    return sorted(mixes, key=lambda mix: (
+        mix['cost_per_task'] is None, mix['cost_per_task'] or 0))
+
+
+def _format_value(value, pattern):
+    return '-' if value is None else pattern.format(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares the cost and throughput of the dedicated and '
+                    'low-priority node mixes of the recorded runs.')
+    parser.add_argument('--history', default=None,
+                        help='accounting history, defaults to {}'.format(
+                            get_accounting_path()))
+    args = parser.parse_args()
+
+    mixes = compare_mixes(load_accountings(args.history))
+    if not mixes:
+        print('No runs recorded yet')
+        return
+    print('{:<20} {:>9} {:>12} {:>5} {:>7} {:>10} {:>12} {:>6}'.format(
+        'vm size', 'dedicated', 'low-priority', 'runs', 'hours',
+        'cost/task', 'tasks/core-h', 'lost'))
+    for mix in mixes:
+        print('{:<20} {:>9} {:>12} {:>5} {:>7} {:>10} {:>12} {:>6}'.format(
+            mix['vm_size'], mix['dedicated_nodes'],
+            mix['low_priority_nodes'], mix['runs'],
+            _format_value(mix['hours'], '{:.2f}'),
+            _format_value(mix['cost_per_task'], '{:.4f}'),
+            _format_value(mix['tasks_per_core_hour'], '{:.3f}'),
+            _format_value(mix['lost_share'], '{:.0%}')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+from __future__ import print_function
+import itertools
+import json
+import os
+
+import azure.batch.models as batchmodels
+
+
+_PARAM_PREFIX = 'param_'
+_MEMBER_NAME_FORMAT = 'member-{:03d}'
+_MEMBER_ENV_NAME = 'HPC_DFO_MEMBER'
+_OVERLAY_DIR_NAME = 'overlays'
+
+
+def expand_sweep(config, section='sweep'):
+    """Expands the parameter grid of a job configuration into members.
+
+    Every PARAM_<NAME> key of the section holds a comma separated list of
+    values; the members are the cartesian product of all of them, in the
+    order the keys appear in the file.
+
+    :param config: The job configuration.
+    :type config: `configparser.ConfigParser`
+    :param str section: The section holding the sweep.
+    :rtype: list
+    :return: A list of dicts with the member name and its params, a list of
+        (NAME, value) tuples. Empty if the job has no sweep.
+    """
+    if not config.has_section(section):
+        return []
+    axes = []
+    for key, value in config.items(section):
+        if not key.startswith(_PARAM_PREFIX):
+            continue
+        values = [item.strip() for item in value.split(',') if item.strip()]
+        if not values:
+            raise ValueError('sweep parameter {} has no values'.format(key))
+        axes.append((key[len(_PARAM_PREFIX):].upper(), values))
+    if not axes:
+        return []
+
+    names = [name for name, _ in axes]
+    return [
+        {'name': _MEMBER_NAME_FORMAT.format(index),
+         'params': list(zip(names, values))}
+        for index, values in enumerate(
+            itertools.product(*[values for _, values in axes]))]
+
+
+def get_nodes_per_task(config, members, section='sweep'):
+    """The nodes each task uses: CFG_NODES_PER_MEMBER for a sweep, every
+    dedicated and low-priority node of the pool otherwise.
+
+    :param config: The job configuration.
+    :type config: `configparser.ConfigParser`
+    :param list members: The members from expand_sweep.
+    :param str section: The section holding the sweep.
+    :rtype: int
+    """
+    if members:
+        return config.getint(section, 'CFG_NODES_PER_MEMBER', fallback=1)
+    return (config.getint('node', 'CFG_NODE_COUNT') +
+            config.getint('node', 'CFG_LOW_PRIORITY_NODE_COUNT', fallback=0))
+
+
+def get_environment_settings(member):
+    """Builds the environment of a member task from its params
+
+    :param dict member: A member returned by expand_sweep.
+    :rtype: list
+    :return: A list of `azure.batch.models.EnvironmentSetting`
+    """
+    settings = [batchmodels.EnvironmentSetting(name=name, value=value)
+                for name, value in member['params']]
+    settings.append(batchmodels.EnvironmentSetting(
+        name=_MEMBER_ENV_NAME, value=member['name']))
+    return settings
+
+
+def stage_member_overlays(blob_client, container_name, job_path, members,
+                          stage_files, timeout=120):
+    """Uploads the overlay files of every member.
+
+    The files of <job_path>/overlays/<NAME>/<value>/ are staged once per
+    parameter value and shared by every member with that value, so each
+    member only adds a few resource files on top of the common inputs.
+
+    :param blob_client: A blob service client.
+    :type blob_client: `azure.storage.blob.BlockBlobService`
+    :param str container_name: The name of the input container.
+    :param str job_path: The job directory.
+    :param list members: The members returned by expand_sweep.
+    :param stage_files: The function used to upload a list of files,
+        `common.helpers.upload_files_to_container` or
+        `common.sync.sync_files_to_container`.
+    :param int timeout: timeout in minutes from now for expiry
+    :rtype: dict
+    :return: member name -> list of `azure.batch.models.ResourceFile`
+    """
+    staged = {}
+    overlays = {}
+    for member in members:
+        resource_files = []
+        for name, value in member['params']:
+            if (name, value) not in staged:
+                overlay_path = os.path.join(
+                    job_path, _OVERLAY_DIR_NAME, name, value)
+                file_paths = []
+                if os.path.isdir(overlay_path):
+                    file_paths = sorted(
+                        os.path.realpath(os.path.join(overlay_path, f))
+                        for f in os.listdir(overlay_path)
+                        if os.path.isfile(os.path.join(overlay_path, f)))
+                staged[(name, value)] = stage_files(
+                    blob_client, container_name, file_paths, timeout=timeout,
+                    path_prefix='{}/{}/{}/'.format(
+                        _OVERLAY_DIR_NAME, name, value)) if file_paths else []
+            resource_files.extend(staged[(name, value)])
+        overlays[member['name']] = resource_files
+    return overlays
+
+
+def write_member_index(members, directory_path):
+    """Writes members.json next to the downloaded member outputs, mapping
+    every member directory to the params it ran with.
+
+    :param list members: The members returned by expand_sweep.
+    :param str directory_path: The local directory holding the outputs.
+    :rtype: str
+    :return: The path of the index file.
+    """
+    if not os.path.isdir(directory_path):
+        os.makedirs(directory_path)
+    index_path = os.path.join(directory_path, 'members.json')
+    with open(index_path, 'w') as f:
+        json.dump({member['name']: dict(member['params'])
+                   for member in members}, f, indent=1, sort_keys=True)
+    return index_path
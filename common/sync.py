@@ -0,0 +1,176 @@
+from __future__ import print_function
+import concurrent.futures
+import json
+import os
+
+import azure.batch.models as batchmodels
+
+import common.helpers
+
+
+_MANIFEST_VERSION = 1
+
+
+def get_manifest_path(container_name):
+    """Returns the local manifest path for a sync container
+
+    :param str container_name: The name of the synced container.
+    :rtype: str
+    :return: The path of the manifest file.
+    """
+    return common.helpers.get_local_state_path(
+        'manifests', container_name + '.json')
+
+
+def load_manifest(manifest_path):
+    """Loads a sync manifest from disk. A missing manifest, or one written
+    by another manifest version, is treated as empty.
+
+    :param str manifest_path: The path of the manifest file.
+    :rtype: dict
+    :return: blob name -> dict of path, size, mtime and hash
+    """
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != _MANIFEST_VERSION:
+        return {}
+    return manifest['files']
+
+
+def save_manifest(manifest_path, files):
+    """Atomically writes a sync manifest to disk.
+
+    :param str manifest_path: The path of the manifest file.
+    :param dict files: blob name -> dict of path, size, mtime and hash
+    """
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'version': _MANIFEST_VERSION, 'files': files}, f,
+                  indent=1, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def _describe_file(file_path, blob_name, manifest):
+    """Builds the manifest entry for a local file, only re-hashing the
+    file when its size or mtime differ from the recorded entry.
+
+    :param str file_path: The local path to the file.
+    :param str blob_name: The name of the blob the file is synced to.
+    :param dict manifest: The current manifest.
+    :rtype: dict
+    :return: The manifest entry for the file.
+    """
+    stat = os.stat(file_path)
+    entry = manifest.get(blob_name)
+    if (entry is not None and entry['size'] == stat.st_size and
+            entry['mtime'] == stat.st_mtime):
+        content_hash = entry['hash']
+    else:
+        content_hash = common.helpers.compute_file_hash(file_path)
+    return {
+        'path': file_path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'hash': content_hash,
+    }
+
+
+def sync_files_to_container(
+        block_blob_client, container_name, file_paths, timeout,
+        path_prefix='', manifest_path=None,
+        max_workers=common.helpers._UPLOAD_MAX_WORKERS):
+    """
+    Incrementally syncs local files to a stable Azure Blob storage container.
+
+    A local manifest records the size, mtime and content hash of every file
+    previously uploaded. Files whose content matches the manifest and whose
+    blob is still present in the container are not uploaded again; they are
+    referenced by a fresh SAS URL instead. Blobs directly under path_prefix
+    which this manifest uploaded and which no longer have a local file are
+    deleted; blobs uploaded by other runs or machines, or under nested
+    prefixes, are left alone.
+
+    :param block_blob_client: A blob service client.
+    :type block_blob_client: `azure.storage.blob.BlockBlobService`
+    :param str container_name: The name of the Azure Blob storage container.
+    :param file_paths: The local paths to the files.
+    :type file_paths: iterable of str
+    :param int timeout: timeout in minutes from now for expiry
+    :param str path_prefix: blob name prefix (virtual directory)
+    :param str manifest_path: The path of the manifest file, defaults to
+        one keyed by container name in the local state directory.
+    :param int max_workers: maximum number of concurrent hashes/uploads
+    :rtype: list
+    :return: A list of `azure.batch.models.ResourceFile`, in the same order
+        as file_paths.
+    """
+    file_paths = list(file_paths)
+    if manifest_path is None:
+        manifest_path = get_manifest_path(container_name)
+    manifest = load_manifest(manifest_path)
+    # the blobs of this call are all named path_prefix + file name
+    owned_blob_names = set(
+        name for name in manifest if name.startswith(path_prefix) and
+        '/' not in name[len(path_prefix):])
+
+    block_blob_client.create_container(container_name, fail_on_exist=False)
+    remote_sizes = {
+        blob.name: blob.properties.content_length
+        for blob in block_blob_client.list_blobs(
+            container_name, prefix=path_prefix or None)}
+
+    blob_names = [path_prefix + os.path.basename(file_path)
+                  for file_path in file_paths]
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        entries = list(executor.map(
+            lambda args: _describe_file(args[0], args[1], manifest),
+            zip(file_paths, blob_names)))
+
+        changed = {}
+        for blob_name, entry in zip(blob_names, entries):
+            previous = manifest.get(blob_name)
+            if (previous is None or previous['hash'] != entry['hash'] or
+                    remote_sizes.get(blob_name) != entry['size']):
+                changed[blob_name] = entry
+
+        futures = {
+            blob_name: executor.submit(
+                common.helpers.upload_file_to_container, block_blob_client,
+                container_name, entry['path'], timeout,
+                path_prefix=path_prefix, create_container=False)
+            for blob_name, entry in changed.items()}
+        sas_urls = {}
+        for blob_name, future in futures.items():
+            sas_urls[blob_name] = future.result().http_url
+            manifest[blob_name] = changed[blob_name]
+
+    for blob_name, entry in zip(blob_names, entries):
+        if blob_name not in sas_urls:
+            manifest[blob_name] = entry
+            sas_urls[blob_name] = common.helpers.create_blob_sas_url(
+                block_blob_client, container_name, blob_name,
+                timeout=timeout)
+
+    stale_blob_names = [name for name in remote_sizes
+                        if name in owned_blob_names and name not in sas_urls]
+    for blob_name in stale_blob_names:
+        block_blob_client.delete_blob(container_name, blob_name)
+    for blob_name in owned_blob_names:
+        if blob_name not in sas_urls:
+            del manifest[blob_name]
+
+    save_manifest(manifest_path, manifest)
+
+    print('Synced [{}]{}: {} uploaded, {} unchanged, {} removed'.format(
+        container_name, path_prefix, len(changed),
+        len(set(blob_names)) - len(changed), len(stale_blob_names)))
+
+    return [
+        batchmodels.ResourceFile(
+            file_path=os.path.basename(file_path),
+            http_url=sas_urls[blob_name])
+        for file_path, blob_name in zip(file_paths, blob_names)]
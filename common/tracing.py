@@ -0,0 +1,235 @@
+from __future__ import print_function
+import calendar
+import contextlib
+import functools
+import json
+import threading
+import time
+
+import azure.batch.models as batchmodels
+
+
+# Chrome trace process ids grouping the spans
+_RUNNER_PID = 1
+_NODE_PID = 2
+_TASK_PID = 3
+_PROCESS_NAMES = {
+    _RUNNER_PID: 'runner',
+    _NODE_PID: 'compute nodes',
+    _TASK_PID: 'tasks',
+}
+# Modules of the operation groups traced through a client
+_OPERATION_MODULES = ('azure.batch.operations', 'common.emulator')
+
+
+def _to_microseconds(timestamp):
+    """Converts a datetime (naive UTC or aware) to epoch microseconds"""
+    return int(calendar.timegm(timestamp.utctimetuple()) * 1e6 +
+               timestamp.microsecond)
+
+
+class _TracedObject(object):
+    """Proxy which records a span around every method call of the wrapped
+    object. Batch operation groups (client.pool, client.task, ...) are
+    wrapped as well, including those of the local emulator.
+    """
+    def __init__(self, tracer, target, category, prefix):
+        self._tracer = tracer
+        self._target = target
+        self._category = category
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        qualified_name = self._prefix + name
+        if callable(attr):
+            return self._tracer.wrap(qualified_name, attr, self._category)
+        if type(attr).__module__.startswith(_OPERATION_MODULES):
+            return _TracedObject(self._tracer, attr, self._category,
+                                 qualified_name + '.')
+        return attr
+
+
+class Tracer(object):
+    """Collects timed spans of a run as Chrome trace events.
+
+    Spans are recorded from any thread. The trace is written both as JSON
+    lines, one event per line, and as a Chrome trace file which can be
+    opened in chrome://tracing or Perfetto.
+    """
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self._thread_names = {}
+
+    def add_span(self, name, category, start, end, pid=_RUNNER_PID, tid=None,
+                 args=None):
+        """Records a span.
+
+        :param str name: The name of the span.
+        :param str category: The category, eg 'phase', 'batch', 'storage'
+        :param int start: start time in epoch microseconds
+        :param int end: end time in epoch microseconds
+        :param int pid: The trace process the span belongs to.
+        :param tid: The trace thread, defaults to the current thread.
+        :param dict args: Extra fields shown with the span.
+        """
+        if tid is None:
+            tid = threading.current_thread().ident
+        event = {
+            'name': name, 'cat': category, 'ph': 'X', 'ts': start,
+            'dur': max(0, end - start), 'pid': pid, 'tid': tid,
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self.events.append(event)
+
+    def name_thread(self, pid, tid, name):
+        """Labels a trace thread, eg with a compute node id."""
+        with self._lock:
+            self._thread_names[(pid, tid)] = name
+
+    @contextlib.contextmanager
+    def span(self, name, category='phase', **args):
+        """Context manager recording a span around its body.
+
+        :param str name: The name of the span.
+        :param str category: The category of the span.
+        """
+        start = int(time.time() * 1e6)
+        try:
+            yield
+        except Exception as err:
+            args['error'] = type(err).__name__
+            raise
+        finally:
+            self.add_span(name, category, start, int(time.time() * 1e6),
+                          args=args)
+
+    def wrap(self, name, function, category='phase'):
+        """Returns function wrapped so every call records a span.
+
+        :param str name: The name of the spans.
+        :param function: The callable to wrap.
+        :param str category: The category of the spans.
+        """
+        @functools.wraps(function)
+        def _traced(*args, **kwargs):
+            with self.span(name, category):
+                return function(*args, **kwargs)
+        return _traced
+
+    def trace_client(self, client, category):
+        """Wraps a Batch or Storage client so every call records a span.
+
+        Listing calls return lazy pages; their span covers the call but not
+        the iteration.
+
+        :param client: The client to wrap.
+        :param str category: The category of the spans, eg 'batch'
+        :return: A proxy to use in place of the client.
+        """
+        return _TracedObject(self, client, category, category + '.')
+
+    def record_batch_spans(self, batch_client, pool_id, job_id):
+        """Records the timings the Batch service kept for the nodes and
+        tasks: node boot and start task per compute node, queueing and
+        execution per task. Must be called before the pool is deleted.
+
+        :param batch_client: The batch client to use.
+        :type batch_client: `batchserviceclient.BatchServiceClient`
+        :param str pool_id: The id of the pool.
+        :param str job_id: The id of the job.
+        """
+        nodes = batch_client.compute_node.list(
+            pool_id, compute_node_list_options=batchmodels.
+            ComputeNodeListOptions(select='id,allocationTime,startTaskInfo'))
+        for index, node in enumerate(nodes):
+            self.name_thread(_NODE_PID, index, node.id)
+            info = node.start_task_info
+            if info is None or info.start_time is None:
+                continue
+            if node.allocation_time is not None:
+                self.add_span(
+                    'node boot', 'node',
+                    _to_microseconds(node.allocation_time),
+                    _to_microseconds(info.start_time),
+                    pid=_NODE_PID, tid=index)
+            if info.end_time is not None:
+                self.add_span(
+                    'start task', 'node', _to_microseconds(info.start_time),
+                    _to_microseconds(info.end_time), pid=_NODE_PID,
+                    tid=index, args={'exit_code': info.exit_code,
+                                     'retries': info.retry_count})
+
+        tasks = batch_client.task.list(
+            job_id, task_list_options=batchmodels.TaskListOptions(
+                select='id,creationTime,executionInfo'))
+        for index, task in enumerate(tasks):
+            self.name_thread(_TASK_PID, index, task.id)
+            info = task.execution_info
+            if info is None or info.start_time is None:
+                continue
+            self.add_span(
+                'task queued', 'task', _to_microseconds(task.creation_time),
+                _to_microseconds(info.start_time), pid=_TASK_PID, tid=index)
+            if info.end_time is not None:
+                self.add_span(
+                    'task run', 'task', _to_microseconds(info.start_time),
+                    _to_microseconds(info.end_time), pid=_TASK_PID,
+                    tid=index, args={'exit_code': info.exit_code})
+
+    def _metadata_events(self):
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                   'args': {'name': name}}
+                  for pid, name in sorted(_PROCESS_NAMES.items())]
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': name}}
+                      for (pid, tid), name in sorted(
+                          self._thread_names.items()))
+        return events
+
+    def write(self, jsonl_path, chrome_trace_path=None):
+        """Writes the trace as JSON lines, and optionally as a Chrome trace.
+
+        :param str jsonl_path: The path of the JSON lines file.
+        :param str chrome_trace_path: The path of the Chrome trace file.
+        """
+        with self._lock:
+            events = self._metadata_events() + sorted(
+                self.events, key=lambda event: event['ts'])
+        with open(jsonl_path, 'w') as f:
+            for event in events:
+                f.write(json.dumps(event, sort_keys=True) + '\n')
+        if chrome_trace_path is not None:
+            with open(chrome_trace_path, 'w') as f:
+                json.dump({'traceEvents': events,
+                           'displayTimeUnit': 'ms'}, f)
+
+    def format_summary(self):
+        """Formats the spans as a table of count, total, mean and max
+        duration per category and name, in order of first occurrence.
+
+        :rtype: str
+        """
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event['ts'])
+        totals = {}
+        order = []
+        for event in events:
+            key = (event['cat'], event['name'])
+            if key not in totals:
+                totals[key] = []
+                order.append(key)
+            totals[key].append(event['dur'] / 1e6)
+        lines = ['{:<8} {:<44} {:>6} {:>10} {:>9} {:>9}'.format(
+            'category', 'span', 'count', 'total[s]', 'mean[s]', 'max[s]')]
+        for category, name in order:
+            durations = totals[(category, name)]
+            lines.append('{:<8} {:<44} {:>6} {:>10.1f} {:>9.2f} {:>9.2f}'
+                         .format(category, name[:44], len(durations),
+                                 sum(durations),
+                                 sum(durations) / len(durations),
+                                 max(durations)))
+        return '\n'.join(lines)
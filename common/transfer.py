@@ -0,0 +1,411 @@
+from __future__ import print_function
+import concurrent.futures
+import fnmatch
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+
+from azure.common import AzureMissingResourceHttpError
+from azure.storage.blob.models import BlobBlock, BlockListType
+
+import common.helpers
+import common.polling
+
+
+_BLOCK_SIZE = 8 * 1024 * 1024
+_TRANSFER_MAX_WORKERS = 8
+_BLOCK_ID_FORMAT = 'block-{:08d}'
+_RANGE_SIZE = 16 * 1024 * 1024
+_PARTIAL_SUFFIX = '.partial'
+
+
+def get_journal_path(container_name, blob_name, direction='upload'):
+    """Returns the local journal path for a resumable transfer
+
+    :param str container_name: The name of the container.
+    :param str blob_name: The name of the blob.
+    :param str direction: 'upload' or 'download'
+    :rtype: str
+    :return: The path of the journal file.
+    """
+    key = hashlib.sha1('{}:{}/{}'.format(
+        direction, container_name, blob_name).encode('utf-8')).hexdigest()
+    return common.helpers.get_local_state_path('journals', key + '.jsonl')
+
+
+def _load_journal(journal_path, expected):
+    """Loads a transfer journal: a JSON line with the fields identifying
+    the transfer, then a JSON line per transferred block. A journal
+    recorded for a different file (size, mtime or block size changed) is
+    discarded, as is a last line cut short by an interruption.
+
+    :param str journal_path: The path of the journal file.
+    :param dict expected: The fields which must match for a resume.
+    :rtype: dict
+    :return: block id -> recorded value of every block already
+        transferred
+    """
+    if not os.path.isfile(journal_path):
+        return {}
+    blocks = {}
+    with open(journal_path) as f:
+        try:
+            fields = json.loads(f.readline())
+        except ValueError:
+            return {}
+        if any(fields.get(key) != value for key, value in expected.items()):
+            return {}
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            blocks[entry['id']] = entry['value']
+    return blocks
+
+
+def _start_journal(journal_path, fields, blocks):
+    """Atomically writes a transfer journal with the blocks transferred so
+    far, the next ones are appended by _append_journal.
+
+    :param str journal_path: The path of the journal file.
+    :param dict fields: The fields identifying the transfer.
+    :param dict blocks: block id -> recorded value of the transferred
+        blocks
+    """
+    temp_path = journal_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(json.dumps(fields) + '\n')
+        for block_id, value in sorted(blocks.items()):
+            f.write(json.dumps({'id': block_id, 'value': value}) + '\n')
+    os.replace(temp_path, journal_path)
+
+
+def _append_journal(journal_path, block_id, value):
+    """Records one more transferred block at the end of a journal, so
+    journaling costs the same for every block however large the file.
+
+    :param str journal_path: The path of the journal file.
+    :param str block_id: The id of the transferred block.
+    :param value: What to record for the block, eg its size
+    """
+    with open(journal_path, 'a') as f:
+        f.write(json.dumps({'id': block_id, 'value': value}) + '\n')
+
+
+def _get_uncommitted_block_sizes(block_blob_client, container_name, blob_name):
+    """Lists the blocks staged on the service but not committed yet.
+
+    :rtype: dict
+    :return: block id -> block size
+    """
+    try:
+        block_list = block_blob_client.get_block_list(
+            container_name, blob_name,
+            block_list_type=BlockListType.Uncommitted)
+    except AzureMissingResourceHttpError:
+        return {}
+    return {block.id: block.size for block in block_list.uncommitted_blocks}
+
+
+def upload_file_in_blocks(
+        block_blob_client, container_name, blob_name, file_path,
+        block_size=_BLOCK_SIZE, max_workers=_TRANSFER_MAX_WORKERS,
+        journal_path=None):
+    """Uploads a large local file as a block blob using parallel put_block
+    calls, then commits the blocks with put_block_list.
+
+    The file is read through a memory map and each block is sent with its
+    MD5 so the service validates it. Every block that succeeds is recorded
+    with its size in a local journal; if the upload is interrupted, calling
+    this again for the same unchanged file only sends the blocks that are
+    missing on the service, or staged there with a different size.
+
+    :param block_blob_client: The storage block blob client to use.
+    :type block_blob_client: `azure.storage.blob.BlockBlobService`
+    :param str container_name: The name of the container to upload to.
+    :param str blob_name: The name of the blob to upload the file to.
+    :param str file_path: The local path to the file, must not be empty.
+    :param int block_size: The size of each block in bytes.
+    :param int max_workers: maximum number of concurrent put_block calls
+    :param str journal_path: The path of the journal file, defaults to one
+        keyed by container and blob name in the local state directory.
+    """
+    if journal_path is None:
+        journal_path = get_journal_path(container_name, blob_name)
+    stat = os.stat(file_path)
+    fields = {
+        'path': os.path.abspath(file_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'block_size': block_size,
+    }
+    block_count = (stat.st_size + block_size - 1) // block_size
+    block_ids = [_BLOCK_ID_FORMAT.format(i) for i in range(block_count)]
+    block_sizes = [min(block_size, stat.st_size - i * block_size)
+                   for i in range(block_count)]
+
+    # only trust journal entries the service still holds with the right size
+    journal_blocks = _load_journal(journal_path, fields)
+    if journal_blocks:
+        staged_sizes = _get_uncommitted_block_sizes(
+            block_blob_client, container_name, blob_name)
+        journal_blocks = {
+            block_id: size
+            for block_id, size in zip(block_ids, block_sizes)
+            if journal_blocks.get(block_id) == size and
+            staged_sizes.get(block_id) == size}
+    pending = [i for i, block_id in enumerate(block_ids)
+               if block_id not in journal_blocks]
+    _start_journal(journal_path, fields, journal_blocks)
+
+    if len(pending) < block_count:
+        print('Resuming upload of {} to [{}]{}: {} of {} blocks left'.format(
+            file_path, container_name, blob_name, len(pending), block_count))
+
+    journal_lock = threading.Lock()
+
+    with open(file_path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            def _put_block(index):
+                block = data[index * block_size:(index + 1) * block_size]
+                block_blob_client.put_block(
+                    container_name, blob_name, block, block_ids[index],
+                    validate_content=True)
+                with journal_lock:
+                    journal_blocks[block_ids[index]] = block_sizes[index]
+                    _append_journal(
+                        journal_path, block_ids[index], block_sizes[index])
+
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max_workers) as executor:
+                for _ in executor.map(_put_block, pending):
+                    pass
+        finally:
+            data.close()
+
+    block_blob_client.put_block_list(
+        container_name, blob_name,
+        [BlobBlock(id=block_id) for block_id in block_ids])
+    if os.path.isfile(journal_path):
+        os.remove(journal_path)
+
+
+def wait_for_blobs(block_blob_client, container_name, patterns, timeout):
+    """Waits until every pattern matches at least one blob of a container.
+
+    :param block_blob_client: A blob service client.
+    :type block_blob_client: `azure.storage.blob.BlockBlobService`
+    :param str container_name: The name of the container.
+    :param list patterns: fnmatch patterns matched against blob names
+    :param timeout: The maximum amount of time to wait.
+    :type timeout: `datetime.timedelta`
+    :rtype: bool
+    :return: True if every pattern matched, False on timeout.
+    """
+    print('Waiting for {} output(s) in container [{}]...'.format(
+        len(patterns), container_name))
+
+    def _poll():
+        names = [blob.name for blob in
+                 block_blob_client.list_blobs(container_name)]
+        return tuple(pattern for pattern in patterns
+                     if not fnmatch.filter(names, pattern))
+
+    def _on_change(_, missing):
+        if missing:
+            print('  {} of {} output(s) missing'.format(
+                len(missing), len(patterns)))
+
+    poller = common.polling.AdaptivePoller(min_interval=1, max_interval=10)
+    poller.watch(container_name, _poll, lambda missing: not missing,
+                 _on_change)
+    return poller.run(timeout)
+
+
+def get_etags_path(block_blob_client, container_name):
+    """Returns the local record of the etags downloaded from a container,
+    keyed by the storage account endpoint and the container name
+
+    :param block_blob_client: A blob service client.
+    :type block_blob_client: `azure.storage.blob.BlockBlobService`
+    :param str container_name: The name of the container.
+    :rtype: str
+    :return: The path of the etag record.
+    """
+    key = hashlib.sha1('{}/{}'.format(
+        block_blob_client.primary_endpoint,
+        container_name).encode('utf-8')).hexdigest()
+    return common.helpers.get_local_state_path('downloads', key + '.json')
+
+
+def _load_etags(etags_path):
+    """Loads the etags of blobs downloaded from a container.
+
+    :param str etags_path: The path of the etag record.
+    :rtype: dict
+    :return: blob name -> etag
+    """
+    if not os.path.isfile(etags_path):
+        return {}
+    with open(etags_path) as f:
+        return json.load(f)
+
+
+def _save_etags(etags_path, etags):
+    """Atomically writes the etags of blobs downloaded from a container.
+
+    :param str etags_path: The path of the etag record.
+    :param dict etags: blob name -> etag
+    """
+    temp_path = etags_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(etags, f, indent=1, sort_keys=True)
+    os.replace(temp_path, etags_path)
+
+
+class _BlobDownload(object):
+    """Tracks the ranges of a single blob being downloaded to a partial
+    file, and renames the file into place once every range is written.
+    """
+    def __init__(self, container_name, blob, destination_path, range_size):
+        self.blob = blob
+        self.destination_path = destination_path
+        self.partial_path = destination_path + _PARTIAL_SUFFIX
+        self.journal_path = get_journal_path(
+            container_name, blob.name, direction='download')
+        self.fields = {
+            'etag': blob.properties.etag,
+            'size': blob.properties.content_length,
+            'block_size': range_size,
+        }
+        size = blob.properties.content_length
+        self.ranges = [(start, min(start + range_size, size) - 1)
+                       for start in range(0, size, range_size)]
+        self.done = {}
+        if os.path.isfile(self.partial_path):
+            self.done = _load_journal(self.journal_path, self.fields)
+        if not self.done:
+            parent = os.path.dirname(destination_path)
+            if parent and not os.path.isdir(parent):
+                os.makedirs(parent)
+            with open(self.partial_path, 'wb') as f:
+                f.truncate(size)
+            _start_journal(self.journal_path, self.fields, {})
+        self.pending = [i for i in range(len(self.ranges))
+                        if str(i) not in self.done]
+        self.lock = threading.Lock()
+
+    def write_range(self, index, content):
+        """Writes a downloaded range and records it in the journal.
+
+        :rtype: bool
+        :return: True if this was the last missing range.
+        """
+        with open(self.partial_path, 'r+b') as f:
+            f.seek(self.ranges[index][0])
+            f.write(content)
+        with self.lock:
+            self.done[str(index)] = True
+            _append_journal(self.journal_path, str(index), True)
+            return len(self.done) == len(self.ranges)
+
+    def finish(self):
+        """Moves the completed partial file into place."""
+        os.replace(self.partial_path, self.destination_path)
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+
+
+def download_container(
+        block_blob_client, container_name, directory_path, pattern='*',
+        max_workers=_TRANSFER_MAX_WORKERS, range_size=_RANGE_SIZE):
+    """Downloads every blob of a container matching a pattern.
+
+    The container is listed once. Blobs are split into ranged GETs of
+    range_size bytes which are fetched concurrently by a pool of workers,
+    so one large blob and many small ones both keep every worker busy.
+    Ranges are written into a .partial file and journaled; an interrupted
+    download resumes from the missing ranges as long as the blob etag is
+    unchanged. Blobs already downloaded with the same size and the etag
+    recorded for the account and container are skipped; a local file of
+    the same size which was not downloaded from this blob is replaced.
+
+    :param block_blob_client: A blob service client.
+    :type block_blob_client: `azure.storage.blob.BlockBlobService`
+    :param str container_name: The Azure Blob storage container from which
+        to download the blobs.
+    :param str directory_path: The local directory to download into, blob
+        names are kept as relative paths.
+    :param str pattern: fnmatch pattern matched against blob names
+    :param int max_workers: maximum number of concurrent ranged GETs
+    :param int range_size: The size of each ranged GET in bytes.
+    :rtype: list
+    :return: The local paths of every matching blob.
+    """
+    print('Downloading blobs matching {!r} from container [{}] to {}...'
+          .format(pattern, container_name, directory_path))
+    start_time = time.time()
+
+    etags_path = get_etags_path(block_blob_client, container_name)
+    etags = _load_etags(etags_path)
+    etags_lock = threading.Lock()
+
+    destination_paths = []
+    downloads = []
+    skipped = 0
+    for blob in block_blob_client.list_blobs(container_name):
+        if not fnmatch.fnmatch(blob.name, pattern):
+            continue
+        destination_path = os.path.join(
+            directory_path, *blob.name.split('/'))
+        destination_paths.append(destination_path)
+        if (os.path.isfile(destination_path) and
+                os.path.getsize(destination_path) ==
+                blob.properties.content_length and
+                etags.get(blob.name) == blob.properties.etag):
+            skipped += 1
+            continue
+        downloads.append(_BlobDownload(
+            container_name, blob, destination_path, range_size))
+
+    def _complete(download):
+        download.finish()
+        with etags_lock:
+            etags[download.blob.name] = download.blob.properties.etag
+            _save_etags(etags_path, etags)
+
+    def _get_range(download, index):
+        start_range, end_range = download.ranges[index]
+        content = block_blob_client.get_blob_to_bytes(
+            container_name, download.blob.name, start_range=start_range,
+            end_range=end_range, max_connections=1,
+            if_match=download.blob.properties.etag).content
+        if download.write_range(index, content):
+            _complete(download)
+        return len(content)
+
+    transferred = 0
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        futures = []
+        for download in downloads:
+            if not download.pending:
+                # empty blob, or every range was already journaled
+                _complete(download)
+            futures.extend(executor.submit(_get_range, download, index)
+                           for index in download.pending)
+        for future in concurrent.futures.as_completed(futures):
+            transferred += future.result()
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print('  Downloaded {} blob(s), {:.1f} MB in {:.1f}s ({:.1f} MB/s), '
+          'skipped {} already present'.format(
+              len(downloads), transferred / 1048576.0, elapsed,
+              transferred / 1048576.0 / elapsed, skipped))
+
+    return destination_paths
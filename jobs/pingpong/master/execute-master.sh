@@ -4,7 +4,7 @@
 #export PATH=$PATH:/usr/lib64/openmpi/bin/
 #mpicc pingpong.c -o pingpong
 
-#mpirun -n $1 -ppn `nproc` -hosts $AZ_BATCH_HOST_LIST IMB-MPI1 pingpong
+#mpirun -n $HPC_DFO_RANKS -ppn $HPC_DFO_RANKS_PER_NODE -machinefile $HPC_DFO_HOSTFILE IMB-MPI1 pingpong
 
 #echo HOSTS are $AZ_BATCH_HOST_LIST
 
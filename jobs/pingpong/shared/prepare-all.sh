@@ -15,23 +15,31 @@ echo AZ_BATCH_HOST_LIST=$AZ_BATCH_HOST_LIST
 
 echo Current working directory is `pwd`
 
-# Requirements
-yum -y install epel-release
-yum -y install gfortran cmake git makedepf90 gcc netcdf netcdf-devel netcdf-fortran-devel netcdf-fortran netcdf-static mpich-3.0 mpich-3.0-devel netcdf-fortran-mpich netcdf-fortran-mpich-devel hdf5-mpich hdf5-mpich-devel
+# Requirements, the runtime libraries are needed by prebuilt binaries too.
+# Images built by common.container (HPC_DFO_CONTAINER_IMAGE=1) have them all,
+# as do nodes the start task of a warm pool prepared (HPC_DFO_NODE_PREPARED=1).
+if [ "$HPC_DFO_CONTAINER_IMAGE" != 1 ] && [ "$HPC_DFO_NODE_PREPARED" != 1 ]; then
+    yum -y install epel-release
+    yum -y install netcdf netcdf-fortran mpich-3.0 netcdf-fortran-mpich hdf5-mpich
+fi
 export PATH=$PATH:/usr/lib64/mpich/bin/
 
-mpicc pingpong.c -o pingpong
+# HPC_DFO_PREBUILT=1 when the binaries were unpacked from the build cache
+if [ "$HPC_DFO_PREBUILT" != 1 ]; then
+    if [ "$HPC_DFO_CONTAINER_IMAGE" != 1 ] && [ "$HPC_DFO_NODE_PREPARED" != 1 ]; then
+        yum -y install gfortran cmake git makedepf90 gcc netcdf-devel netcdf-fortran-devel netcdf-static mpich-3.0-devel netcdf-fortran-mpich-devel hdf5-mpich-devel
+    fi
+    mpicc $(dirname $0)/pingpong.c -o pingpong
+fi
 
 source /opt/intel/impi/5.1.3.223/bin64/mpivars.sh
 
 chmod -R 777 /mnt
 
-export I_MPI_FABRICS=shm:dapl
-export I_MPI_DAPL_PROVIDER=ofa-v2-ib0
-export I_MPI_DYNAMIC_CONNECTION=0
-
-# Do we have to wait 30 seconds for RDMA/IB to be available on eth1?
-sleep 30
+# The runner exports the fabric of the VM size (see common/interconnect.py)
+# after waiting for InfiniBand to come up, tcp works everywhere else
+export I_MPI_FABRICS=${I_MPI_FABRICS:-shm:tcp}
+echo I_MPI_FABRICS=$I_MPI_FABRICS
 
 
 mpirun IMB-MPI1 pingpong > pong1.log
@@ -1,4 +1,5 @@
 from __future__ import print_function
+import concurrent.futures
 import datetime
 import os
 import sys
@@ -33,50 +34,585 @@ coloredlogs.install(level='DEBUG', logger=logger)
 
 
 sys.path.append('.')
+import common.autoscale  # noqa
+import common.build_cache  # noqa
+import common.checkpoint  # noqa
+import common.emulator  # noqa
+import common.container  # noqa
 import common.helpers  # noqa
+import common.interconnect  # noqa
+import common.layout  # noqa
+import common.packing  # noqa
+import common.pool_cache  # noqa
+import common.preemption  # noqa
+import common.sweep  # noqa
+import common.sync  # noqa
+import common.tracing  # noqa
+import common.transfer  # noqa
 
 
-# Set these environment variables
-# export _BATCH_ACCOUNT_KEY=abd123==
-# etc
-_BATCH_ACCOUNT_KEY = os.environ['_BATCH_ACCOUNT_KEY']
-_BATCH_ACCOUNT_NAME = os.environ['_BATCH_ACCOUNT_NAME']
-_BATCH_ACCOUNT_URL = os.environ['_BATCH_ACCOUNT_URL']
-
-_STORAGE_ACCOUNT_NAME = os.environ['_STORAGE_ACCOUNT_NAME']
-_STORAGE_ACCOUNT_KEY = os.environ['_STORAGE_ACCOUNT_KEY']
-
 # Path to the jobs directory
 JOB_PATH = './jobs/pingpong'
 
 config = configparser.ConfigParser()
 config.read(JOB_PATH + '/config.ini')
 
+# 'azure', or 'emulator' to run pools, tasks and storage on this machine
+_BACKEND = config.get('backend', 'CFG_BACKEND', fallback='azure')
+if _BACKEND == 'azure':
+    # Set these environment variables
+    # export _BATCH_ACCOUNT_KEY=abd123==
+    # etc
+    _BATCH_ACCOUNT_KEY = os.environ['_BATCH_ACCOUNT_KEY']
+    _BATCH_ACCOUNT_NAME = os.environ['_BATCH_ACCOUNT_NAME']
+    _BATCH_ACCOUNT_URL = os.environ['_BATCH_ACCOUNT_URL']
+
+    _STORAGE_ACCOUNT_NAME = os.environ['_STORAGE_ACCOUNT_NAME']
+    _STORAGE_ACCOUNT_KEY = os.environ['_STORAGE_ACCOUNT_KEY']
+elif _BACKEND != 'emulator':
+    raise ValueError('unknown backend {}, expected azure or emulator'.format(
+        _BACKEND))
+
 
 
 # Maximum time to run in minutes
-MAX_RUNTIME = 30
+MAX_RUNTIME = config.getint('node', 'CFG_MAX_RUNTIME', fallback=30)
 _APP_NAME = 'pingpong'
 _OS_NAME = config['node']['CFG_OS_NAME']
-_POOL_ID = common.helpers.generate_unique_resource_name(
-    'pool_{}_{}'.format(_OS_NAME, _APP_NAME))
+
+# A warm pool is kept after the run and reused by later runs with the same
+# [node] and [pool] settings, until it has been idle for the TTL
+_WARM_POOL = config.getboolean('pool', 'CFG_WARM_POOL', fallback=False)
+_WARM_POOL_IDLE_TTL = datetime.timedelta(minutes=config.getint(
+    'pool', 'CFG_WARM_POOL_IDLE_TTL_MINUTES', fallback=60))
+# Settings which change how the runner behaves but not the pool itself;
+# the idle TTL is part of the pool's autoscale formula
+_POOL_IDENTITY_EXCLUDED_KEYS = (
+    'CFG_PIPELINED_LAUNCH', 'CFG_WARM_POOL',
+    'CFG_MAX_RUNTIME', 'CFG_REFRESH_IMAGE_CACHE', 'CFG_NODE_REPAIR_ATTEMPTS',
+    'CFG_MAX_NODE_REPLACEMENTS', 'CFG_MAX_FALLBACK_DEDICATED_NODES',
+    'CFG_PREEMPTION_FALLBACK_MINUTES')
+_POOL_CONFIG_HASH = common.pool_cache.get_config_hash(
+    config, sections=('node', 'pool', 'container'),
+    excluded_keys=_POOL_IDENTITY_EXCLUDED_KEYS)
+
+if _WARM_POOL:
+    _POOL_ID = 'pool_{}_{}'.format(_OS_NAME, _POOL_CONFIG_HASH)
+else:
+    _POOL_ID = common.helpers.generate_unique_resource_name(
+        'pool_{}_{}'.format(_OS_NAME, _APP_NAME))
 _POOL_NODE_COUNT = config['node']['CFG_NODE_COUNT']
+# Low-priority nodes come on top of the dedicated CFG_NODE_COUNT, cheaper
+# but preempted whenever Azure needs the capacity back
+_POOL_LOW_PRIORITY_NODE_COUNT = config.getint(
+    'node', 'CFG_LOW_PRIORITY_NODE_COUNT', fallback=0)
+_POOL_TOTAL_NODE_COUNT = int(_POOL_NODE_COUNT) + _POOL_LOW_PRIORITY_NODE_COUNT
 _POOL_VM_SIZE = config['node']['CFG_VM_SIZE']
 _NODE_OS_PUBLISHER = config['node']['CFG_OS_PUBLISHER']
 _NODE_OS_OFFER = config['node']['CFG_OS_OFFER']
 _NODE_OS_SKU = config['node']['CFG_OS_SKU']
-
-_POOL_INTERNODE = config['pool']['CFG_INTERNODE']
+# Resolve the VM image from the service instead of the local image cache
+_REFRESH_IMAGE_CACHE = config.getboolean(
+    'node', 'CFG_REFRESH_IMAGE_CACHE', fallback=False)
+
+# The VM size decides the interconnect: RDMA capable sizes get the HPC image
+# with the matching drivers (unless CFG_AUTO_IMAGE is False) and their fabric,
+# kept on the nodes only once the InfiniBand port is up; others use tcp
+_INTERCONNECT = common.interconnect.get_interconnect(_POOL_VM_SIZE)
+_FABRIC = config.get('node', 'CFG_FABRIC', fallback='auto')
+_IB_PROBE_TIMEOUT = config.getint('node', 'CFG_IB_PROBE_SECONDS', fallback=120)
+if (config.getboolean('node', 'CFG_AUTO_IMAGE', fallback=True) and
+        _INTERCONNECT['image'] is not None):
+    _NODE_OS_PUBLISHER, _NODE_OS_OFFER, _NODE_OS_SKU = _INTERCONNECT['image']
+
+# A container pool runs on a container-enabled VM image and every node pulls
+# CFG_IMAGE (built from CFG_PACKAGES with python -m common.container) when it
+# joins the pool; the start, coordination and application commands then run
+# inside the image instead of installing packages on the node
+_CONTAINER = config.getboolean('container', 'CFG_CONTAINER', fallback=False)
+if _CONTAINER:
+    _NODE_OS_PUBLISHER = config.get(
+        'container', 'CFG_OS_PUBLISHER', fallback='microsoft-azure-batch')
+    _NODE_OS_OFFER = config.get(
+        'container', 'CFG_OS_OFFER', fallback='centos-container')
+    _NODE_OS_SKU = config.get('container', 'CFG_OS_SKU', fallback='7-6')
+    _CONTAINER_IMAGE = config['container']['CFG_IMAGE']
+    # Set _REGISTRY_USERNAME and _REGISTRY_PASSWORD for a private registry
+    _CONTAINER_REGISTRY = common.container.get_registry(
+        config.get('container', 'CFG_REGISTRY_SERVER', fallback=''),
+        os.environ.get('_REGISTRY_USERNAME'),
+        os.environ.get('_REGISTRY_PASSWORD'))
+    _CONTAINER_CONFIGURATION = common.container.get_container_configuration(
+        [_CONTAINER_IMAGE] + config.get(
+            'container', 'CFG_PREFETCH_IMAGES', fallback='').split(),
+        _CONTAINER_REGISTRY)
+    _CONTAINER_SETTINGS = common.container.get_task_container_settings(
+        _CONTAINER_IMAGE, config.get(
+            'container', 'CFG_RUN_OPTIONS', fallback='--net=host --ipc=host'),
+        _CONTAINER_REGISTRY)
+    # The container-enabled VM image replaces the HPC image of RDMA sizes,
+    # only its RDMA variants (eg centos-container-rdma) have the drivers
+    _CONTAINER_RDMA = config.getboolean(
+        'container', 'CFG_RDMA', fallback='rdma' in _NODE_OS_OFFER.lower())
+    if _INTERCONNECT['rdma'] and not _CONTAINER_RDMA:
+        if common.interconnect.is_rdma_fabric(_FABRIC):
+            raise ValueError('CFG_FABRIC = {} needs RDMA drivers, which the '
+                             'container VM image {} does not have'.format(
+                                 _FABRIC, _NODE_OS_OFFER))
+        logger.warning('{} is RDMA capable but the container VM image {} has '
+                       'no RDMA drivers, using tcp'.format(
+                           _POOL_VM_SIZE, _NODE_OS_OFFER))
+        _INTERCONNECT = common.interconnect.get_tcp_interconnect()
+else:
+    _CONTAINER_CONFIGURATION = None
+    _CONTAINER_SETTINGS = None
+
+# Multi-node MPI needs inter-node communication on any VM size, RDMA sizes
+# only reach each other over InfiniBand with it
+_POOL_INTERNODE = config.getboolean(
+    'pool', 'CFG_INTERNODE',
+    fallback=_POOL_TOTAL_NODE_COUNT > 1 or _INTERCONNECT['rdma'])
 
 JOB_NAME = config['job']['JOB_NAME']
 
-
-_JOB_ID = 'job-{}'.format(_POOL_ID)
+# Incremental sync reuses a stable per-job input container and only uploads
+# files which changed since the previous run
+_INCREMENTAL_SYNC = config.getboolean(
+    'staging', 'CFG_INCREMENTAL_SYNC', fallback=False)
+
+# Packing bundles each of shared/ and master/ into a single archive blob,
+# files larger than CFG_PACK_MAX_FILE_MB are still uploaded on their own
+_PACK_INPUTS = config.getboolean('staging', 'CFG_PACK_INPUTS', fallback=False)
+_PACK_MAX_FILE_SIZE = config.getint(
+    'staging', 'CFG_PACK_MAX_FILE_MB', fallback=64) * 1024 * 1024
+_PACKED_PATH_PREFIX = 'packed/'
+
+# The build cache keeps the outputs of the node-side build as a blob keyed by
+# the hash of the build sources, the OS image and the MPI flavor. Nodes of a
+# later run with the same key unpack it instead of installing the build
+# packages and compiling.
+_BUILD_CACHE = config.getboolean('build', 'CFG_BUILD_CACHE', fallback=False)
+_BUILD_CONTAINER = config.get(
+    'build', 'CFG_BUILD_CONTAINER', fallback='build-cache')
+_BUILD_SOURCES = [
+    path.strip() for path in config.get(
+        'build', 'CFG_BUILD_SOURCES', fallback='shared').split(',')
+    if path.strip()]
+_BUILD_ARTIFACTS = config.get('build', 'CFG_BUILD_ARTIFACTS', fallback='').split()
+_MPI_FLAVOR = config.get('build', 'CFG_MPI_FLAVOR', fallback='mpich')
+
+# Pipelined launch requests the pool before staging the inputs and queues
+# the task without waiting for every node to become idle
+_PIPELINED_LAUNCH = config.getboolean(
+    'pool', 'CFG_PIPELINED_LAUNCH', fallback=False)
+
+# An autoscaling pool is sized by the number of queued and running tasks,
+# between CFG_AUTOSCALE_MIN_NODES and CFG_AUTOSCALE_MAX_NODES, instead of
+# CFG_NODE_COUNT. Simulate the formula locally with
+#   python -m common.autoscale jobs/<job>/config.ini --tasks 40
+_AUTOSCALE = config.getboolean('pool', 'CFG_AUTOSCALE', fallback=False)
+_AUTOSCALE_MIN_NODES = config.getint(
+    'pool', 'CFG_AUTOSCALE_MIN_NODES', fallback=0)
+_AUTOSCALE_MAX_NODES = config.getint(
+    'pool', 'CFG_AUTOSCALE_MAX_NODES', fallback=8)
+_AUTOSCALE_INTERVAL = datetime.timedelta(minutes=config.getint(
+    'pool', 'CFG_AUTOSCALE_INTERVAL_MINUTES', fallback=5))
+if _AUTOSCALE and _POOL_LOW_PRIORITY_NODE_COUNT:
+    raise ValueError('the autoscale formula only sizes dedicated nodes, '
+                     'CFG_LOW_PRIORITY_NODE_COUNT needs a fixed size pool')
+
+# Tasks of preempted nodes are requeued by Batch; nodes preempted for longer
+# than CFG_PREEMPTION_FALLBACK_MINUTES are made up for by dedicated nodes,
+# at most CFG_MAX_FALLBACK_DEDICATED_NODES of them
+_MAX_FALLBACK_DEDICATED_NODES = config.getint(
+    'pool', 'CFG_MAX_FALLBACK_DEDICATED_NODES', fallback=0)
+_PREEMPTION_FALLBACK_DELAY = datetime.timedelta(minutes=config.getint(
+    'pool', 'CFG_PREEMPTION_FALLBACK_MINUTES', fallback=10))
+if _WARM_POOL and _MAX_FALLBACK_DEDICATED_NODES:
+    raise ValueError('warm pools are sized by their idle TTL formula, '
+                     'CFG_MAX_FALLBACK_DEDICATED_NODES needs a pool which '
+                     'is not warm')
+
+# Bad nodes are rebooted, then reimaged, then removed and replaced
+_NODE_REPAIR_ATTEMPTS = config.getint(
+    'pool', 'CFG_NODE_REPAIR_ATTEMPTS', fallback=2)
+_MAX_NODE_REPLACEMENTS = config.getint(
+    'pool', 'CFG_MAX_NODE_REPLACEMENTS', fallback=2)
+
+# Headless runs answer every prompt from the lifecycle policy below
+_HEADLESS = config.getboolean('lifecycle', 'CFG_HEADLESS', fallback=False)
+_TEARDOWN_ON_SUCCESS = config.getboolean(
+    'lifecycle', 'CFG_TEARDOWN_ON_SUCCESS', fallback=True)
+_TEARDOWN_ON_FAILURE = config.getboolean(
+    'lifecycle', 'CFG_TEARDOWN_ON_FAILURE', fallback=True)
+_DOWNLOAD_RESULTS = config.getboolean(
+    'lifecycle', 'CFG_DOWNLOAD_RESULTS', fallback=True)
+# Output blobs (names or fnmatch patterns, per task) to wait for before
+# the pool is torn down
+_EXPECTED_OUTPUTS = [
+    name.strip() for name in config.get(
+        'lifecycle', 'CFG_EXPECTED_OUTPUTS', fallback='stdout.txt').split(',')
+    if name.strip()]
+_OUTPUT_WAIT = datetime.timedelta(minutes=config.getint(
+    'lifecycle', 'CFG_OUTPUT_WAIT_MINUTES', fallback=5))
+
+# Restart files of the application are uploaded every interval while it
+# runs and restored when Batch requeues or retries the task, so a lost node
+# costs at most one interval of work. Without a name, checkpoints belong to
+# the run and are deleted once it succeeds; a name lets a later run resume.
+_CHECKPOINT = config.getboolean('checkpoint', 'CFG_CHECKPOINT', fallback=False)
+_CHECKPOINT_FILES = config.get(
+    'checkpoint', 'CFG_CHECKPOINT_FILES', fallback='').replace(',', ' ').split()
+_CHECKPOINT_INTERVAL = config.getint(
+    'checkpoint', 'CFG_CHECKPOINT_INTERVAL_MINUTES', fallback=15)
+_CHECKPOINT_CONTAINER = config.get(
+    'checkpoint', 'CFG_CHECKPOINT_CONTAINER', fallback='checkpoints')
+_CHECKPOINT_NAME = config.get(
+    'checkpoint', 'CFG_CHECKPOINT_NAME', fallback='').strip()
+# Retries of a failed task, each restarting from the newest checkpoint;
+# without checkpoints a retry would only rerun the task from scratch
+_TASK_RETRIES = (config.getint('checkpoint', 'CFG_TASK_RETRIES', fallback=0)
+                 if _CHECKPOINT else 0)
+
+# Price of a core-hour of each node kind, to compare the cost per task of
+# node mixes with python -m common.preemption
+_DEDICATED_CORE_HOUR_PRICE = config.getfloat(
+    'accounting', 'CFG_DEDICATED_CORE_HOUR_PRICE', fallback=0.0)
+_LOW_PRIORITY_CORE_HOUR_PRICE = config.getfloat(
+    'accounting', 'CFG_LOW_PRIORITY_CORE_HOUR_PRICE', fallback=0.0)
+
+# Spans of every phase and every Batch/Storage call of the run, written to
+# ~/.hpc-dfo/traces/<job id>.jsonl (and .json for chrome://tracing)
+_TRACER = common.tracing.Tracer()
+
+
+# Warm pools outlive the run, so their jobs need unique ids of their own
+if _WARM_POOL:
+    _JOB_ID = common.helpers.generate_unique_resource_name(
+        'job-{}'.format(_POOL_ID))
+else:
+    _JOB_ID = 'job-{}'.format(_POOL_ID)
 _TASK_ID = common.helpers.generate_unique_resource_name(
     'task_{}_{}'.format(_OS_NAME, _APP_NAME))
 _TASK_OUTPUT_FILE_PATH_ON_VM = '../std*.txt'
-_TASK_OUTPUT_BLOB_NAME = 'stdout.txt'
-_NUM_INSTANCES = _POOL_NODE_COUNT
+# Blobs in the output container to download at the end of the run
+_TASK_OUTPUT_BLOB_PATTERN = config.get(
+    'job', 'CFG_OUTPUT_BLOB_PATTERN', fallback='*')
+
+# A [sweep] section with PARAM_<NAME> keys turns the job into an ensemble,
+# one task per member of the parameter grid, each using
+# CFG_NODES_PER_MEMBER nodes of the shared pool
+_SWEEP_MEMBERS = common.sweep.expand_sweep(config)
+_NUM_INSTANCES = common.sweep.get_nodes_per_task(config, _SWEEP_MEMBERS)
+
+# Warm pools keep their size while in use and release every node once idle
+# for the TTL, so they outlive the run without costing nodes
+_POOL_AUTOSCALE_FORMULA = None
+if _AUTOSCALE:
+    if _NUM_INSTANCES > _AUTOSCALE_MAX_NODES:
+        raise ValueError(
+            'tasks of {} node(s) never fit an autoscaled pool of at most '
+            'CFG_AUTOSCALE_MAX_NODES = {} nodes'.format(
+                _NUM_INSTANCES, _AUTOSCALE_MAX_NODES))
+    _POOL_AUTOSCALE_FORMULA = common.autoscale.build_autoscale_formula(
+        _AUTOSCALE_MIN_NODES, _AUTOSCALE_MAX_NODES, int(_NUM_INSTANCES))
+elif _WARM_POOL:
+    _POOL_AUTOSCALE_FORMULA = common.autoscale.build_fixed_size_formula(
+        _POOL_NODE_COUNT, _POOL_LOW_PRIORITY_NODE_COUNT)
+if _WARM_POOL:
+    _POOL_AUTOSCALE_FORMULA = common.autoscale.add_idle_ttl(
+        _POOL_AUTOSCALE_FORMULA, _WARM_POOL_IDLE_TTL.total_seconds() // 60)
+
+
+def _get_optional_int(section, key):
+    value = config.get(section, key, fallback='auto').strip().lower()
+    return None if value in ('', 'auto') else int(value)
+
+
+# Rank and thread placement of each task: the rank count, ranks per node,
+# pinning and OMP_NUM_THREADS exported to the application command, plus a
+# machine file, from the topology of the VM size and the [layout] policy
+_LAYOUT_TOPOLOGY = None
+if config.has_option('layout', 'CFG_CORES_PER_NODE'):
+    _LAYOUT_TOPOLOGY = (
+        config.getint('layout', 'CFG_CORES_PER_NODE'),
+        config.getint('layout', 'CFG_THREADS_PER_CORE', fallback=1),
+        config.getint('layout', 'CFG_NUMA_DOMAINS', fallback=1))
+_LAYOUT = common.layout.plan_layout(
+    _POOL_VM_SIZE, int(_NUM_INSTANCES),
+    policy=config.get('layout', 'CFG_POLICY', fallback='mpi'),
+    ranks_per_node=_get_optional_int('layout', 'CFG_RANKS_PER_NODE'),
+    threads_per_rank=_get_optional_int('layout', 'CFG_THREADS_PER_RANK'),
+    use_hyperthreads=config.getboolean(
+        'layout', 'CFG_USE_HYPERTHREADS', fallback=False),
+    topology=_LAYOUT_TOPOLOGY)
+
+
+def stage_job_inputs(blob_client, input_container_name, stage_files,
+                     checkpoint=None):
+    """Uploads the shared/ and master/ directories of the job and builds the
+    command lines which use them.
+
+    :param blob_client: A blob service client.
+    :type blob_client: `azure.storage.blob.BlockBlobService`
+    :param str input_container_name: The name of the input container.
+    :param stage_files: The function used to upload a list of files,
+        `common.helpers.upload_files_to_container` or
+        `common.sync.sync_files_to_container`.
+    :param checkpoint: The checkpoints of the run, if any.
+    :type checkpoint: `common.checkpoint.Checkpoint`
+    :rtype: tuple
+    :return: (common_files, input_files, coordination_cmdline,
+        start_task_cmdline, application_cmdline, member_overlays,
+        start_task_files), where member_overlays maps each sweep member to
+        its extra resource files and start_task_files are resource files the
+        start task needs besides the input container
+    """
+    # Get all files in the shared subdirectory
+    common_file_paths = [
+        os.path.realpath(file_path)
+        for file_path in absoluteFilePaths(JOB_PATH + '/shared')]
+
+    # Every command sets up the MPI fabric of the VM size first
+    fabric_cmdline = common.interconnect.get_fabric_commands(
+        _INTERCONNECT, _FABRIC, _IB_PROBE_TIMEOUT)
+
+    # Common resource files land in the task shared directory under their
+    # file names and input files in the working directory, while archives
+    # (and the start task's copy of the input container) keep the shared/
+    # and master/ directories. Scripts are run with bash as resource files
+    # are not executable.
+    if _PACK_INPUTS:
+        prepare_script_path = './shared/prepare-all.sh'
+        execute_script_path = './master/execute-master.sh'
+    else:
+        prepare_script_path = '$AZ_BATCH_TASK_SHARED_DIR/prepare-all.sh'
+        execute_script_path = './execute-master.sh'
+
+    # Command to run on all subtasks including primary before starting
+    # application command on primary.
+    coordination_cmdline = fabric_cmdline + [
+        'bash {}'.format(prepare_script_path)]
+
+    # The pool start task runs the same preparation on every node.
+    start_task_cmdline = fabric_cmdline + ['bash ./shared/prepare-all.sh']
+
+    # The collection of scripts/data files that are to be used/processed by
+    # the task (used/processed by primary in a multiinstance task).
+    input_file_paths = list(absoluteFilePaths(JOB_PATH + '/master'))
+
+    # Main application command to execute multiinstance task on a group of
+    # nodes, eg. MPI. It gets the rank count, the layout is exported.
+    application_cmdline = (
+        fabric_cmdline + common.layout.get_layout_commands(_LAYOUT) +
+        ['bash {} {}'.format(execute_script_path, _LAYOUT['ranks'])])
+    if checkpoint is not None:
+        # restore the newest checkpoint, then checkpoint while it runs
+        application_cmdline[-1:-1] = (checkpoint.get_restore_commands() +
+                                      checkpoint.get_start_commands())
+        application_cmdline += checkpoint.get_stop_commands()
+
+    common_files = []
+    input_files = []
+    start_task_files = []
+    if _PACK_INPUTS:
+        # Bundle shared/ and master/ into one archive each so that nodes
+        # download a couple of blobs instead of one per file. Files above
+        # the size limit are still staged individually below.
+        common_archive_path = common.packing.get_archive_path(
+            input_container_name, JOB_PATH + '/shared')
+        common_file_paths = common.packing.pack_directory(
+            JOB_PATH + '/shared', common_archive_path, _PACK_MAX_FILE_SIZE)
+        input_archive_path = common.packing.get_archive_path(
+            input_container_name, JOB_PATH + '/master')
+        input_file_paths = common.packing.pack_directory(
+            JOB_PATH + '/master', input_archive_path, _PACK_MAX_FILE_SIZE)
+
+        common_archive, input_archive = stage_files(
+            blob_client, input_container_name,
+            [common_archive_path, input_archive_path],
+            timeout=120, path_prefix=_PACKED_PATH_PREFIX)
+        common_files.append(common_archive)
+        input_files.append(input_archive)
+
+        # common resource files land in the task shared directory, the start
+        # task gets the whole input container in its working directory
+        coordination_cmdline.insert(0, common.packing.unpack_command(
+            '$AZ_BATCH_TASK_SHARED_DIR/' + common_archive.file_path))
+        start_task_cmdline.insert(0, common.packing.unpack_command(
+            _PACKED_PATH_PREFIX + common_archive.file_path))
+        application_cmdline.insert(0, common.packing.unpack_command(
+            input_archive.file_path))
+
+    if _BUILD_CACHE:
+        if not _BUILD_ARTIFACTS:
+            raise ValueError('CFG_BUILD_CACHE needs CFG_BUILD_ARTIFACTS')
+        build_cache = common.build_cache.BuildCache(
+            blob_client, _BUILD_CONTAINER,
+            common.build_cache.get_build_key(
+                JOB_PATH, _BUILD_SOURCES,
+                (_NODE_OS_PUBLISHER, _NODE_OS_OFFER, _NODE_OS_SKU),
+                _MPI_FLAVOR, _BUILD_ARTIFACTS),
+            _BUILD_ARTIFACTS, timeout=120 + MAX_RUNTIME)
+        # the artifact is unpacked right before the preparation script and,
+        # on a miss, packed and uploaded by the primary of the task right
+        # after it
+        common_files += build_cache.get_resource_files()
+        start_task_files += build_cache.get_resource_files()
+        coordination_cmdline[-1:-1] = build_cache.get_prepare_commands(
+            '$AZ_BATCH_TASK_SHARED_DIR/')
+        coordination_cmdline += build_cache.get_publish_commands()
+        start_task_cmdline[-1:-1] = build_cache.get_prepare_commands()
+
+    if _WARM_POOL:
+        # The start task of a warm pool prepares each node once and marks
+        # it, tasks on marked nodes skip the package installs
+        preparation_digest = common.pool_cache.get_preparation_digest(
+            JOB_PATH + '/shared')
+        start_task_cmdline.append(
+            common.pool_cache.get_mark_prepared_command(preparation_digest))
+        coordination_cmdline.insert(
+            0, common.pool_cache.get_check_prepared_command(
+                preparation_digest))
+
+    common_files += stage_files(
+        blob_client, input_container_name, common_file_paths,
+        timeout=120, path_prefix='shared/')
+
+    # Upload the script/data files to Azure Storage
+    input_files += stage_files(
+        blob_client, input_container_name, input_file_paths,
+        timeout=120, path_prefix='master/')
+
+    member_overlays = common.sweep.stage_member_overlays(
+        blob_client, input_container_name, JOB_PATH, _SWEEP_MEMBERS,
+        stage_files)
+
+    return (common_files, input_files, coordination_cmdline,
+            start_task_cmdline, application_cmdline, member_overlays,
+            start_task_files)
+
+
+def teardown_job_and_pool(batch_client):
+    """Deletes the job, and the pool unless it is a warm pool.
+
+    :param batch_client: The batch client to use.
+    :type batch_client: `batchserviceclient.BatchServiceClient`
+    """
+    if _WARM_POOL:
+        logger.info('Deleting job, keeping warm pool {}...'.format(_POOL_ID))
+    else:
+        logger.info('Deleting job and pool...')
+
+    # a failed run may not have got as far as creating them
+    try:
+        batch_client.job.delete(_JOB_ID)
+    except batchmodels.BatchErrorException as err:
+        if err.error.code != 'JobNotFound':
+            raise
+    try:
+        if _WARM_POOL:
+            common.pool_cache.touch_pool(batch_client, _POOL_ID)
+        else:
+            batch_client.pool.delete(_POOL_ID)
+    except batchmodels.BatchErrorException as err:
+        if err.error.code != 'PoolNotFound':
+            raise
+
+
+def get_expected_output_patterns(failed_task_ids=()):
+    """Returns the patterns of the output blobs the tasks which succeeded
+    upload
+
+    :param failed_task_ids: The ids of the tasks which failed.
+    :type failed_task_ids: iterable of str
+    :rtype: list
+    """
+    failed_task_ids = set(failed_task_ids)
+    if _SWEEP_MEMBERS:
+        prefixes = [member['name'] + '/' for member in _SWEEP_MEMBERS
+                    if '{}-{}'.format(_TASK_ID, member['name'])
+                    not in failed_task_ids]
+    else:
+        prefixes = [] if _TASK_ID in failed_task_ids else ['']
+    return ['{}*{}'.format(prefix, name)
+            for prefix in prefixes for name in _EXPECTED_OUTPUTS]
+
+
+def finish_run(blob_client, batch_client, output_container_name, succeeded,
+               tasks_completed, failed_task_ids=()):
+    """Tears down and downloads the results of a run as the lifecycle
+    policy says.
+
+    Once the tasks completed, the expected outputs of the tasks which
+    succeeded are waited for so the nodes are not removed while still
+    uploading. Teardown then runs concurrently with the download.
+
+    :param blob_client: A blob service client.
+    :type blob_client: `azure.storage.blob.BlockBlobService`
+    :param batch_client: The batch client to use.
+    :type batch_client: `batchserviceclient.BatchServiceClient`
+    :param str output_container_name: The name of the output container.
+    :param bool succeeded: whether every task completed successfully
+    :param bool tasks_completed: whether the tasks ran to completion, so
+        their outputs are expected in the output container
+    :param failed_task_ids: The ids of the tasks which failed, whose
+        outputs are not waited for.
+    :type failed_task_ids: iterable of str
+    """
+    teardown = _TEARDOWN_ON_SUCCESS if succeeded else _TEARDOWN_ON_FAILURE
+    teardown = common.helpers.confirm(
+        'Tear down the job and pool?', _HEADLESS,
+        default='yes' if teardown else 'no') == 'yes'
+    download = common.helpers.confirm(
+        'Download results?', _HEADLESS,
+        default='yes' if _DOWNLOAD_RESULTS else 'no') == 'yes'
+
+    expected_output_patterns = get_expected_output_patterns(failed_task_ids)
+    if tasks_completed and expected_output_patterns and (teardown or download):
+        with _TRACER.span('wait for outputs'):
+            if not common.transfer.wait_for_blobs(
+                    blob_client, output_container_name,
+                    expected_output_patterns, _OUTPUT_WAIT):
+                logger.warning('Expected outputs missing after {}'.format(
+                    _OUTPUT_WAIT))
+
+    # node and task timings are gone once the pool is deleted
+    try:
+        _TRACER.record_batch_spans(batch_client, _POOL_ID, _JOB_ID)
+    except batchmodels.BatchErrorException:
+        logger.warning('Could not read node and task timings')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        if teardown:
+            teardown_future = executor.submit(
+                _TRACER.wrap('teardown', teardown_job_and_pool), batch_client)
+        else:
+            logger.warning('Keeping job {} and pool {}'.format(
+                _JOB_ID, _POOL_ID))
+
+        # Download the task output files from the output Storage container
+        # to a local directory
+        if download:
+            downloadPath = os.path.expanduser('~') + "/" + output_container_name
+            logger.info('Downloading results to ' + downloadPath)
+            with _TRACER.span('download results'):
+                common.transfer.download_container(
+                    blob_client,
+                    output_container_name,
+                    downloadPath,
+                    pattern=_TASK_OUTPUT_BLOB_PATTERN)
+            if _SWEEP_MEMBERS:
+                common.sweep.write_member_index(_SWEEP_MEMBERS, downloadPath)
+
+        if teardown:
+            teardown_future.result()
+
+    trace_path = common.helpers.get_local_state_path(
+        'traces', _JOB_ID + '.jsonl')
+    _TRACER.write(trace_path, chrome_trace_path=trace_path[:-1])
+    print(_TRACER.format_summary())
+    logger.info('Trace written to {}'.format(trace_path))
 
 
 if __name__ == '__main__':
@@ -87,8 +623,17 @@ if __name__ == '__main__':
     # Create the blob client, for use in obtaining references to
     # blob storage containers and uploading files to containers.
 
-    blob_client = azureblob.BlockBlobService(
-        account_name=_STORAGE_ACCOUNT_NAME, account_key=_STORAGE_ACCOUNT_KEY)
+    if _BACKEND == 'emulator':
+        emulated_batch_client, blob_client = common.emulator.create_clients(
+            **common.emulator.get_emulator_settings(config))
+        blob_client.create_container('job-' + JOB_NAME)
+        logger.info('Emulating Batch and Storage in {}'.format(
+            emulated_batch_client.root))
+    else:
+        blob_client = azureblob.BlockBlobService(
+            account_name=_STORAGE_ACCOUNT_NAME,
+            account_key=_STORAGE_ACCOUNT_KEY)
+    blob_client = _TRACER.trace_client(blob_client, 'storage')
     # Can't get retry to work
     # TODO
     #blob_client.retry = LinearRetry(
@@ -96,8 +641,22 @@ if __name__ == '__main__':
 
     # Use the blob client to create the containers in Azure Storage if they
     # don't yet exist.
-    input_container_name = common.helpers.generate_unique_resource_name(
-        'input-{}'.format(_APP_NAME))
+    if _INCREMENTAL_SYNC:
+        input_container_name = 'sync-{}'.format(JOB_NAME.lower())
+        stage_files = common.sync.sync_files_to_container
+    else:
+        input_container_name = common.helpers.generate_unique_resource_name(
+            'input-{}'.format(_APP_NAME))
+        stage_files = common.helpers.upload_files_to_container
+    checkpoint = None
+    if _CHECKPOINT:
+        checkpoint = common.checkpoint.Checkpoint(
+            blob_client, _CHECKPOINT_CONTAINER, _CHECKPOINT_NAME or _JOB_ID,
+            _CHECKPOINT_FILES, interval_minutes=_CHECKPOINT_INTERVAL,
+            timeout=MAX_RUNTIME + 120)
+        logger.info('Checkpointing {} every {} minute(s) to [{}]{}/'.format(
+            ' '.join(_CHECKPOINT_FILES), _CHECKPOINT_INTERVAL,
+            _CHECKPOINT_CONTAINER, checkpoint.name))
     output_container_name = common.helpers.generate_unique_resource_name(
         'output-{}'.format(_APP_NAME))
     blob_client.create_container(input_container_name, fail_on_exist=False)
@@ -108,16 +667,16 @@ if __name__ == '__main__':
         permission=ContainerPermissions.READ + ContainerPermissions.LIST,
         expiry=datetime.datetime.utcnow() + datetime.timedelta(minutes=120)
         )
-    persistent_input_storage_sas = 'https://{}.blob.core.windows.net/job-{}?{}'.format(
-        _STORAGE_ACCOUNT_NAME, JOB_NAME, persistent_input_storage_sas)
+    persistent_input_storage_sas = common.helpers.make_container_sas_url(
+        blob_client, 'job-' + JOB_NAME, persistent_input_storage_sas)
 
     input_storage_sas = blob_client.generate_container_shared_access_signature(
         container_name=input_container_name, 
         permission=ContainerPermissions.READ + ContainerPermissions.LIST,
         expiry=datetime.datetime.utcnow() + datetime.timedelta(minutes=120)
         )
-    input_storage_sas = 'https://{}.blob.core.windows.net/{}?{}'.format(
-        _STORAGE_ACCOUNT_NAME, input_container_name, input_storage_sas)
+    input_storage_sas = common.helpers.make_container_sas_url(
+        blob_client, input_container_name, input_storage_sas)
 
 
 
@@ -130,110 +689,273 @@ if __name__ == '__main__':
         expiry=None,
         timeout=120)
 
-    output_container_sas = 'https://{}.blob.core.windows.net/{}?{}'.format(
-        _STORAGE_ACCOUNT_NAME, output_container_name, output_container_sas)
-
-
-    # Get all files in the shared subdirectory
-    common_file_paths = absoluteFilePaths(JOB_PATH + '/shared')
-
-    common_files = [
-        common.helpers.upload_file_to_container(
-            blob_client, input_container_name, os.path.realpath(file_path), timeout=120, path_prefix='shared/')
-        for file_path in common_file_paths]
-
-    # Command to run on all subtasks including primary before starting
-    # application command on primary.
-    coordination_cmdline = ['bash -c "./shared/prepare-all.sh"']
-
-    # The collection of scripts/data files that are to be used/processed by
-    # the task (used/processed by primary in a multiinstance task).
-    input_file_paths = absoluteFilePaths(JOB_PATH + '/master')
-
-    # Upload the script/data files to Azure Storage
-    input_files = [
-        common.helpers.upload_file_to_container(
-            blob_client, input_container_name, file_path, timeout=120, path_prefix='master/')
-        for file_path in input_file_paths]
-    print ("input files debug is\n")
-    print(input_files)
-
-    # Main application command to execute multiinstance task on a group of
-    # nodes, eg. MPI.
-    application_cmdline = ['bash -c "./master/execute-master.sh {}"'.format(_NUM_INSTANCES)]
-
-    if common.helpers.query_yes_no('Proceed with batch pool creation?') == 'no':
+    output_container_sas = common.helpers.make_container_sas_url(
+        blob_client, output_container_name, output_container_sas)
+
+
+    # Pipelined launch stages the inputs while the pool is allocated, except
+    # for warm pools whose start task needs them
+    pipelined_staging = _PIPELINED_LAUNCH and not _WARM_POOL
+    if not pipelined_staging:
+        with _TRACER.span('stage inputs'):
+            (common_files, input_files, coordination_cmdline,
+             start_task_cmdline, application_cmdline, member_overlays,
+             start_task_files) = stage_job_inputs(
+                 blob_client, input_container_name, stage_files, checkpoint)
+        print ("input files debug is\n")
+        print(input_files)
+
+    print('{} interconnect: {}, fabric {}, image {}/{}/{}'.format(
+        _POOL_VM_SIZE, _INTERCONNECT['kind'],
+        common.interconnect.resolve_fabric(_INTERCONNECT, _FABRIC),
+        _NODE_OS_PUBLISHER, _NODE_OS_OFFER, _NODE_OS_SKU))
+    print('Layout: {}'.format(common.layout.format_layout(_LAYOUT)))
+    if _SWEEP_MEMBERS:
+        print('Sweep of {} member(s), {} node(s) each'.format(
+            len(_SWEEP_MEMBERS), _NUM_INSTANCES))
+        if _POOL_TOTAL_NODE_COUNT % _NUM_INSTANCES:
+            logger.warning(
+                '{} node(s) per member do not divide the {} pool nodes, '
+                'some nodes will stay idle'.format(
+                    _NUM_INSTANCES, _POOL_TOTAL_NODE_COUNT))
+    if _POOL_LOW_PRIORITY_NODE_COUNT:
+        print('{} dedicated and {} low-priority node(s)'.format(
+            _POOL_NODE_COUNT, _POOL_LOW_PRIORITY_NODE_COUNT))
+
+    if common.helpers.confirm(
+            'Proceed with batch pool creation?', _HEADLESS) == 'no':
         raise SystemExit
 
 
 
     # Create a Batch service client.  We'll now be interacting with the Batch
     # service in addition to Storage
-    credentials = batchauth.SharedKeyCredentials(_BATCH_ACCOUNT_NAME, _BATCH_ACCOUNT_KEY)
-    batch_client = batch.BatchServiceClient(credentials, _BATCH_ACCOUNT_URL)
-
-    # Create the pool that will contain the compute nodes that will execute the
-    # tasks. The resource files we pass in are used for configuring the pool's
-    # start task, which is executed each time a node first joins the pool (or
-    # is rebooted or re-imaged).
-    multi_task_helpers.create_pool_and_wait_for_vms(
-        batch_client, _POOL_ID, _NODE_OS_PUBLISHER, _NODE_OS_OFFER,
-        _NODE_OS_SKU, _POOL_VM_SIZE, _POOL_NODE_COUNT, enable_inter_node_communication=_POOL_INTERNODE,
-        command_line=coordination_cmdline,
-        resource_files=[batch.models.ResourceFile(storage_container_url=persistent_input_storage_sas),
-            batch.models.ResourceFile(storage_container_url=input_storage_sas)],
-        elevation_level=batchmodels.ElevationLevel.admin)
-
-    # Create the job that will run the tasks.
-    common.helpers.create_job(batch_client, _JOB_ID, _POOL_ID)
-
-    # Add the tasks to the job.  We need to supply a container shared access
-    # signature (SAS) token for the tasks so that they can upload their output
-    # to Azure Storage.
-    multi_task_helpers.add_task(
-        batch_client, _JOB_ID, _TASK_ID, _NUM_INSTANCES,
-        common.helpers.wrap_commands_in_shell(_OS_NAME, application_cmdline),
-        input_files, batchmodels.ElevationLevel.admin,
-        _TASK_OUTPUT_FILE_PATH_ON_VM, output_container_sas,
-        common.helpers.wrap_commands_in_shell(_OS_NAME, coordination_cmdline),
-        common_files)
-
-    # Pause execution until task (and all subtasks for a multiinstance task)
-    # reach Completed state.
-    multi_task_helpers.wait_for_tasks_to_complete(
-        batch_client, _JOB_ID, datetime.timedelta(minutes=MAX_RUNTIME))
-
-    print("Success! Task reached the 'Completed' state within the specified timeout period.")
+    if _BACKEND == 'emulator':
+        batch_client = emulated_batch_client
+    else:
+        credentials = batchauth.SharedKeyCredentials(
+            _BATCH_ACCOUNT_NAME, _BATCH_ACCOUNT_KEY)
+        batch_client = batch.BatchServiceClient(
+            credentials, _BATCH_ACCOUNT_URL)
+    batch_client = _TRACER.trace_client(batch_client, 'batch')
+
+    # Anything going wrong from here on is a failed run, which is torn down
+    # (or kept for inspection) as the lifecycle policy says
+    tasks_completed = False
+    failed_task_ids = []
+    # core-hours of the run, preemptions and the requeues they caused
+    cores, threads_per_core, _ = (
+        _LAYOUT_TOPOLOGY or common.layout.get_topology(_POOL_VM_SIZE))
+    run_started = time.time()
+    preemption_monitor = None
+    if _POOL_LOW_PRIORITY_NODE_COUNT or _MAX_FALLBACK_DEDICATED_NODES:
+        preemption_monitor = common.preemption.PreemptionMonitor(
+            batch_client, _POOL_ID, _JOB_ID, cores * threads_per_core,
+            max_fallback_nodes=_MAX_FALLBACK_DEDICATED_NODES,
+            fallback_delay=_PREEMPTION_FALLBACK_DELAY, started=run_started)
+    try:
+        warm_pool = None
+        if _WARM_POOL:
+            with _TRACER.span('find warm pool'):
+                common.pool_cache.evict_idle_pools(batch_client)
+                warm_pool = common.pool_cache.find_warm_pool(
+                    batch_client, _POOL_ID)
+
+        if _PIPELINED_LAUNCH or _WARM_POOL or _AUTOSCALE:
+            # Request the pool first and stage the inputs while the VMs are
+            # being allocated. The job inputs are not uploaded yet when the pool
+            # is created, so the pool gets no start task; node preparation is
+            # done by the coordination command, which every node runs before
+            # the application command. The task is queued as soon as the
+            # inputs are staged and is scheduled once enough nodes are idle.
+            # An autoscaling pool starts small and only grows once tasks are
+            # queued, so it is never waited on. A warm pool does prepare its
+            # nodes in a start task, which a reused pool gets with the inputs
+            # of this run for the nodes joining it from now on.
+            pool_command_line = pool_resource_files = None
+            if _WARM_POOL:
+                pool_command_line = common.helpers.wrap_commands_in_shell(
+                    _OS_NAME, start_task_cmdline)
+                pool_resource_files = [
+                    batch.models.ResourceFile(
+                        storage_container_url=persistent_input_storage_sas),
+                    batch.models.ResourceFile(
+                        storage_container_url=input_storage_sas)] + \
+                    start_task_files
+            if warm_pool is not None:
+                batch_client.pool.patch(_POOL_ID, batchmodels.PoolPatchParameter(
+                    start_task=multi_task_helpers.build_start_task(
+                        pool_command_line, pool_resource_files,
+                        batchmodels.ElevationLevel.admin,
+                        _CONTAINER_SETTINGS)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                if warm_pool is None:
+                    pool_future = executor.submit(
+                        _TRACER.wrap('create pool',
+                                     multi_task_helpers.create_pool),
+                        batch_client, _POOL_ID, _NODE_OS_PUBLISHER, _NODE_OS_OFFER,
+                        _NODE_OS_SKU, _POOL_VM_SIZE, _POOL_NODE_COUNT,
+                        command_line=pool_command_line,
+                        resource_files=pool_resource_files,
+                        enable_inter_node_communication=_POOL_INTERNODE,
+                        elevation_level=batchmodels.ElevationLevel.admin,
+                        refresh_image_cache=_REFRESH_IMAGE_CACHE,
+                        metadata=common.pool_cache.get_pool_metadata(
+                            _POOL_CONFIG_HASH, _WARM_POOL_IDLE_TTL)
+                        if _WARM_POOL else None,
+                        auto_scale_formula=_POOL_AUTOSCALE_FORMULA,
+                        auto_scale_evaluation_interval=_AUTOSCALE_INTERVAL
+                        if _POOL_AUTOSCALE_FORMULA else None,
+                        container_configuration=_CONTAINER_CONFIGURATION,
+                        start_task_container_settings=_CONTAINER_SETTINGS,
+                        target_low_priority_nodes=(
+                            _POOL_LOW_PRIORITY_NODE_COUNT))
+                # without pipelining the inputs were staged before the prompt
+                if pipelined_staging:
+                    staging_future = executor.submit(
+                        _TRACER.wrap('stage inputs', stage_job_inputs),
+                        blob_client, input_container_name, stage_files,
+                        checkpoint)
+
+                if warm_pool is None:
+                    pool_future.result()
+                with _TRACER.span('create job'):
+                    common.helpers.create_job(batch_client, _JOB_ID, _POOL_ID)
+
+                if pipelined_staging:
+                    (common_files, input_files, coordination_cmdline, _,
+                     application_cmdline, member_overlays,
+                     _) = staging_future.result()
+            common_files.append(batch.models.ResourceFile(
+                storage_container_url=persistent_input_storage_sas))
+        else:
+            # Create the pool that will contain the compute nodes that will
+            # execute the tasks. The resource files we pass in are used for
+            # configuring the pool's start task, which is executed each time a
+            # node first joins the pool (or is rebooted or re-imaged).
+            with _TRACER.span('create pool and wait for nodes'):
+                multi_task_helpers.create_pool_and_wait_for_vms(
+                    batch_client, _POOL_ID, _NODE_OS_PUBLISHER, _NODE_OS_OFFER,
+                    _NODE_OS_SKU, _POOL_VM_SIZE, _POOL_NODE_COUNT, enable_inter_node_communication=_POOL_INTERNODE,
+                    command_line=common.helpers.wrap_commands_in_shell(
+                        _OS_NAME, start_task_cmdline),
+                    resource_files=[batch.models.ResourceFile(storage_container_url=persistent_input_storage_sas),
+                        batch.models.ResourceFile(storage_container_url=input_storage_sas)] + start_task_files,
+                    elevation_level=batchmodels.ElevationLevel.admin,
+                    refresh_image_cache=_REFRESH_IMAGE_CACHE,
+                    required_nodes=int(_NUM_INSTANCES),
+                    max_repairs=_NODE_REPAIR_ATTEMPTS,
+                    max_replacements=_MAX_NODE_REPLACEMENTS,
+                    container_configuration=_CONTAINER_CONFIGURATION,
+                    start_task_container_settings=_CONTAINER_SETTINGS,
+                    target_low_priority_nodes=_POOL_LOW_PRIORITY_NODE_COUNT)
+
+            # Create the job that will run the tasks.
+            with _TRACER.span('create job'):
+                common.helpers.create_job(batch_client, _JOB_ID, _POOL_ID)
+
+        # Add the tasks to the job.  We need to supply a container shared access
+        # signature (SAS) token for the tasks so that they can upload their output
+        # to Azure Storage.
+        with _TRACER.span('add tasks'):
+            if _SWEEP_MEMBERS:
+                # Every member is queued up front, so the scheduler starts the next
+                # one as soon as enough nodes are free. Members share the staged
+                # inputs, get their params as environment variables plus their
+                # overlay files, and upload their outputs under <member name>/.
+                multi_task_helpers.add_tasks(batch_client, _JOB_ID, [
+                    multi_task_helpers.build_task(
+                        '{}-{}'.format(_TASK_ID, member['name']), _NUM_INSTANCES,
+                        common.helpers.wrap_commands_in_shell(
+                            _OS_NAME, application_cmdline),
+                        input_files + member_overlays[member['name']],
+                        batchmodels.ElevationLevel.admin,
+                        _TASK_OUTPUT_FILE_PATH_ON_VM, output_container_sas,
+                        common.helpers.wrap_commands_in_shell(
+                            _OS_NAME, coordination_cmdline),
+                        common_files,
+                        environment_settings=common.sweep.get_environment_settings(
+                            member),
+                        output_path=member['name'],
+                        container_settings=_CONTAINER_SETTINGS,
+                        max_task_retries=_TASK_RETRIES)
+                    for member in _SWEEP_MEMBERS])
+            else:
+                multi_task_helpers.add_task(
+                    batch_client, _JOB_ID, _TASK_ID, _NUM_INSTANCES,
+                    common.helpers.wrap_commands_in_shell(_OS_NAME, application_cmdline),
+                    input_files, batchmodels.ElevationLevel.admin,
+                    _TASK_OUTPUT_FILE_PATH_ON_VM, output_container_sas,
+                    common.helpers.wrap_commands_in_shell(_OS_NAME, coordination_cmdline),
+                    common_files, container_settings=_CONTAINER_SETTINGS,
+                    max_task_retries=_TASK_RETRIES)
+
+        # Pause execution until task (and all subtasks for a multiinstance task)
+        # reach Completed state.
+        with _TRACER.span('wait for tasks'):
+            multi_task_helpers.wait_for_tasks_to_complete(
+                batch_client, _JOB_ID, datetime.timedelta(minutes=MAX_RUNTIME),
+                preemption_monitor=preemption_monitor)
+
+        tasks_completed = True
+        failed_task_ids = common.helpers.list_failed_task_ids(
+            batch_client, _JOB_ID)
+    except Exception:
+        logger.exception('Run failed')
+        if checkpoint is not None and not _CHECKPOINT_NAME:
+            logger.warning(
+                'Set CFG_CHECKPOINT_NAME = {} to resume from the '
+                'checkpoints of this run'.format(checkpoint.name))
+        finish_run(blob_client, batch_client, output_container_name,
+                   succeeded=False, tasks_completed=tasks_completed,
+                   failed_task_ids=failed_task_ids)
+        raise
+
+    if failed_task_ids:
+        logger.error('{} task(s) failed: {}'.format(
+            len(failed_task_ids), ', '.join(failed_task_ids)))
+        if checkpoint is not None and not _CHECKPOINT_NAME:
+            logger.warning(
+                'Set CFG_CHECKPOINT_NAME = {} to resume from the '
+                'checkpoints of this run'.format(checkpoint.name))
+    else:
+        print("Success! Task reached the 'Completed' state within the specified timeout period.")
+        if checkpoint is not None and not _CHECKPOINT_NAME:
+            checkpoint.delete(blob_client)
 
     # Print out some timing info
     end_time = datetime.datetime.now().replace(microsecond=0)
     
     logger.info('Sample end: {}'.format(end_time))
     logger.info('Elapsed time: {}'.format(end_time - start_time))
-    
-    # You have to give some time for the results to transfer before you kill things
-    logger.info("Sleeping 15 seconds...")
-    time.sleep(15)
-    
-    common.helpers.query_yes_no('Ready to proceed to deletion?')
-
-    logger.info('Deleting input container...')
-    #blob_client.delete_container(input_container_name)
-
-    logger.info('Deleting job and pool...')
-    batch_client.job.delete(_JOB_ID)
-    batch_client.pool.delete(_POOL_ID)
-
-    # Download the task output files from the output Storage container to a
-    # local directory
-    if common.helpers.query_yes_no('Download results?') == 'yes':
-        downloadPath = os.path.expanduser('~') + "/" + output_container_name
-        logger.info('Downloading results to ' + downloadPath)
-        os.mkdir(os.path.expanduser('~') + "/" + output_container_name)
-        common.helpers.download_blob_from_container(
-            blob_client,
-            output_container_name,
-            _TASK_OUTPUT_BLOB_NAME,
-            downloadPath)
-
-    logger.info("Done!")
\ No newline at end of file
+
+    if preemption_monitor is None:
+        # dedicated nodes are not watched while the tasks run, their node
+        # time is read once for the history
+        preemption_monitor = common.preemption.PreemptionMonitor(
+            batch_client, _POOL_ID, _JOB_ID, cores * threads_per_core,
+            started=run_started)
+    preemption_monitor.refresh()
+    accounting = preemption_monitor.get_accounting(
+        _DEDICATED_CORE_HOUR_PRICE, _LOW_PRIORITY_CORE_HOUR_PRICE,
+        failed_task_ids=failed_task_ids)
+    accounting.update({
+        'vm_size': _POOL_VM_SIZE,
+        'dedicated_nodes': int(_POOL_NODE_COUNT),
+        'low_priority_nodes': _POOL_LOW_PRIORITY_NODE_COUNT,
+        'hours': round((end_time - start_time).total_seconds() / 3600.0, 3),
+        'failed_tasks': len(failed_task_ids),
+        'time': end_time.isoformat(),
+    })
+    print(common.preemption.format_accounting(accounting))
+    # emulated node time says nothing about the cost of a mix
+    if _BACKEND != 'emulator':
+        common.preemption.append_accounting(accounting)
+
+    finish_run(blob_client, batch_client, output_container_name,
+               succeeded=not failed_task_ids, tasks_completed=True,
+               failed_task_ids=failed_task_ids)
+
+    logger.info("Done!")
+    if failed_task_ids:
+        sys.exit(1)
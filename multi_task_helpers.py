@@ -1,4 +1,5 @@
 from __future__ import print_function
+import concurrent.futures
 import datetime
 import sys
 import time
@@ -8,17 +9,57 @@ import os
 
 sys.path.append('.')
 import common.helpers  # noqa
+import common.node_health  # noqa
+import common.polling  # noqa
 
 
-def create_pool_and_wait_for_vms(
+_SUBTASK_QUERY_MAX_WORKERS = 8
+# add_collection accepts at most 100 tasks per call
+_ADD_COLLECTION_MAX_TASKS = 100
+_ADD_COLLECTION_MAX_WORKERS = 8
+_ADD_COLLECTION_MAX_ATTEMPTS = 3
+
+
+def build_start_task(command_line, resource_files=None,
+                     elevation_level=batchmodels.ElevationLevel.admin,
+                     container_settings=None):
+    """
+    Builds the start task which prepares each node joining a pool.
+
+    :param str command_line: command line of the start task.
+    :param list resource_files: A collection of resource files for the
+        start task.
+    :param str elevation_level: Elevation level the task will be run as;
+        either 'admin' or 'nonadmin'.
+    :param container_settings: Runs the start task in an image.
+    :type container_settings: `azure.batch.models.TaskContainerSettings`
+    :rtype: `azure.batch.models.StartTask`
+    """
+    user = batchmodels.AutoUserSpecification(
+        scope=batchmodels.AutoUserScope.pool,
+        elevation_level=elevation_level)
+    return batch.models.StartTask(
+        command_line=command_line,
+        container_settings=container_settings,
+        user_identity=batchmodels.UserIdentity(auto_user=user),
+        wait_for_success=False,
+        resource_files=resource_files)
+
+
+def create_pool(
         batch_service_client, pool_id,
         publisher, offer, sku, vm_size,
         target_dedicated_nodes,
         command_line=None, resource_files=None,
         elevation_level=batchmodels.ElevationLevel.admin,
-        enable_inter_node_communication=True):
+        enable_inter_node_communication=True, metadata=None,
+        refresh_image_cache=False, auto_scale_formula=None,
+        auto_scale_evaluation_interval=None, container_configuration=None,
+        start_task_container_settings=None, max_tasks_per_node=1,
+        target_low_priority_nodes=0):
     """
-    Creates a pool of compute nodes with the specified OS settings.
+    Creates a pool of compute nodes with the specified OS settings, without
+    waiting for the nodes to be allocated.
 
     :param batch_service_client: A Batch service client.
     :type batch_service_client: `azure.batch.BatchServiceClient`
@@ -35,64 +76,151 @@ def create_pool_and_wait_for_vms(
     start task.
     :param str elevation_level: Elevation level the task will be run as;
         either 'admin' or 'nonadmin'.
+    :param list metadata: A list of `azure.batch.models.MetadataItem` to
+        attach to the pool.
+    :param bool refresh_image_cache: resolve the VM image from the service
+        even if a cached result exists
+    :param str auto_scale_formula: An autoscale formula, eg from
+        `common.autoscale.build_autoscale_formula`; the pool is then sized
+        by the formula instead of target_dedicated_nodes.
+    :param auto_scale_evaluation_interval: How often the formula is
+        evaluated, at least 5 minutes.
+    :type auto_scale_evaluation_interval: `datetime.timedelta`
+    :param container_configuration: The images every node prefetches,
+        publisher/offer/sku must then be a container-enabled image.
+    :type container_configuration: `azure.batch.models.ContainerConfiguration`
+    :param start_task_container_settings: Runs the start task in an image.
+    :type start_task_container_settings:
+        `azure.batch.models.TaskContainerSettings`
+    :param int max_tasks_per_node: Tasks a node runs at once; pools running
+        multi-instance (MPI) tasks must use 1, the ranks of a node are laid
+        out by `common.layout` instead.
+    :param int target_low_priority_nodes: Number of low-priority VMs for the
+        pool, besides the dedicated ones; they are cheaper but may be
+        preempted, see `common.preemption`.
+    :rtype: `azure.batch.models.PoolAddParameter`
+    :return: The pool which was requested.
     """
 
     print('Creating pool [{}]...'.format(pool_id))
 
     sku_to_use, image_ref_to_use = \
         common.helpers.select_latest_verified_vm_image_with_node_agent_sku(
-            batch_service_client, publisher, offer, sku)
-    
-    user = batchmodels.AutoUserSpecification(
-        scope=batchmodels.AutoUserScope.pool,
-        elevation_level=elevation_level)
+            batch_service_client, publisher, offer, sku,
+            refresh=refresh_image_cache)
 
     new_pool = batch.models.PoolAddParameter(
         id=pool_id,
         virtual_machine_configuration=batchmodels.VirtualMachineConfiguration(
             image_reference=image_ref_to_use,
-            node_agent_sku_id=sku_to_use),
+            node_agent_sku_id=sku_to_use,
+            container_configuration=container_configuration),
         vm_size=vm_size,
-        target_dedicated_nodes=target_dedicated_nodes,
-        resize_timeout=datetime.timedelta(minutes=15),
+        target_dedicated_nodes=(
+            None if auto_scale_formula else target_dedicated_nodes),
+        target_low_priority_nodes=(
+            None if auto_scale_formula else target_low_priority_nodes),
+        resize_timeout=(
+            None if auto_scale_formula else datetime.timedelta(minutes=15)),
+        enable_auto_scale=bool(auto_scale_formula),
+        auto_scale_formula=auto_scale_formula,
+        auto_scale_evaluation_interval=auto_scale_evaluation_interval,
         enable_inter_node_communication=enable_inter_node_communication,
-        max_tasks_per_node=1,
-        start_task=batch.models.StartTask(
-            command_line=command_line,
-            user_identity=batchmodels.UserIdentity(auto_user=user),
-            wait_for_success=False,
-            resource_files=resource_files) if command_line else None,
+        max_tasks_per_node=max_tasks_per_node,
+        start_task=build_start_task(
+            command_line, resource_files, elevation_level,
+            start_task_container_settings) if command_line else None,
+        metadata=metadata,
     )
 
     common.helpers.create_pool_if_not_exist(batch_service_client, new_pool)
+    return new_pool
 
-    # because we want all nodes to be available before any tasks are assigned
-    # to the pool, here we will wait for all compute nodes to reach idle
-    nodes = common.helpers.wait_for_all_nodes_state(
-        batch_service_client, new_pool,
-        frozenset(
-            (batchmodels.ComputeNodeState.start_task_failed,
-             batchmodels.ComputeNodeState.unusable,
-             batchmodels.ComputeNodeState.idle)
-        )
-    )
-    # ensure all node are idle
-    if any(node.state != batchmodels.ComputeNodeState.idle for node in nodes):
-        raise RuntimeError('node(s) of pool {} not in idle state'.format(
-            pool_id))
 
-
-def add_task(
-        batch_service_client, job_id, task_id, num_instances,
-        application_cmdline, input_files, elevation_level,
-        output_file_names, output_container_sas,
-        coordination_cmdline, common_files):
+def create_pool_and_wait_for_vms(
+        batch_service_client, pool_id,
+        publisher, offer, sku, vm_size,
+        target_dedicated_nodes,
+        command_line=None, resource_files=None,
+        elevation_level=batchmodels.ElevationLevel.admin,
+        enable_inter_node_communication=True, refresh_image_cache=False,
+        required_nodes=None, max_repairs=2, max_replacements=2, timeout=None,
+        container_configuration=None, start_task_container_settings=None,
+        max_tasks_per_node=1, target_low_priority_nodes=0):
     """
-    Adds a task for each input file in the collection to the specified job.
+    Creates a pool of compute nodes with the specified OS settings and waits
+    for enough of them to become idle, repairing nodes whose start task
+    failed or which became unusable.
 
     :param batch_service_client: A Batch service client.
     :type batch_service_client: `azure.batch.BatchServiceClient`
-    :param str job_id: The ID of the job to which to add the task.
+    :param str pool_id: An ID for the new pool.
+    :param str publisher: Marketplace Image publisher
+    :param str offer: Marketplace Image offer
+    :param str sku: Marketplace Image sku
+    :param str vm_size: The size of VM, eg 'Standard_A1' or 'Standard_D1' per
+    https://azure.microsoft.com/en-us/documentation/articles/
+    virtual-machines-windows-sizes/
+    :param int target_dedicated_nodes: Number of target VMs for the pool
+    :param str command_line: command line for the pool's start task.
+    :param list resource_files: A collection of resource files for the pool's
+    start task.
+    :param str elevation_level: Elevation level the task will be run as;
+        either 'admin' or 'nonadmin'.
+    :param bool refresh_image_cache: resolve the VM image from the service
+        even if a cached result exists
+    :param int required_nodes: Number of idle nodes to wait for, defaults
+        to target_dedicated_nodes plus target_low_priority_nodes
+    :param int max_repairs: reboot/reimage attempts for each bad node
+    :param int max_replacements: bad nodes which may be removed and
+        replaced by resizing the pool
+    :param timeout: The maximum amount of time to wait for the nodes.
+    :type timeout: `datetime.timedelta`
+    :param container_configuration: The images every node prefetches, so
+        that nodes are ready once the images are pulled.
+    :type container_configuration: `azure.batch.models.ContainerConfiguration`
+    :param start_task_container_settings: Runs the start task in an image.
+    :type start_task_container_settings:
+        `azure.batch.models.TaskContainerSettings`
+    :param int max_tasks_per_node: Tasks a node runs at once, 1 for
+        multi-instance tasks.
+    :param int target_low_priority_nodes: Number of low-priority VMs for the
+        pool, besides the dedicated ones.
+    :rtype: list
+    :return: The idle `azure.batch.models.ComputeNode` of the pool.
+    """
+    new_pool = create_pool(
+        batch_service_client, pool_id, publisher, offer, sku, vm_size,
+        target_dedicated_nodes, command_line=command_line,
+        resource_files=resource_files, elevation_level=elevation_level,
+        enable_inter_node_communication=enable_inter_node_communication,
+        refresh_image_cache=refresh_image_cache,
+        container_configuration=container_configuration,
+        start_task_container_settings=start_task_container_settings,
+        max_tasks_per_node=max_tasks_per_node,
+        target_low_priority_nodes=target_low_priority_nodes)
+
+    # because we want enough nodes to be available before any tasks are
+    # assigned to the pool, here we wait for them to reach idle; one bad VM
+    # is repaired or replaced instead of failing the whole pool
+    if required_nodes is None:
+        required_nodes = int(target_dedicated_nodes) + int(
+            target_low_priority_nodes)
+    health_manager = common.node_health.NodeHealthManager(
+        batch_service_client, new_pool.id, required_nodes,
+        max_repairs=max_repairs, max_replacements=max_replacements)
+    return health_manager.wait(timeout)
+
+
+def build_task(
+        task_id, num_instances, application_cmdline, input_files,
+        elevation_level, output_file_names, output_container_sas,
+        coordination_cmdline, common_files, environment_settings=None,
+        output_path=None, container_settings=None, max_task_retries=0):
+    """
+    Builds a task, taking the same arguments as add_task, for submission
+    with add_tasks.
+
     :param str task_id: The ID of the task to be added.
     :param str application_cmdline: The application commandline for the task.
     :param list input_files: A collection of input files.
@@ -102,10 +230,17 @@ def add_task(
     :param int num_instances: Number of instances for the task
     :param str coordination_cmdline: The application commandline for the task.
     :param list common_files: A collection of common input files.
+    :param list environment_settings: A list of
+        `azure.batch.models.EnvironmentSetting` for the task.
+    :param str output_path: virtual directory of the output container the
+        output files are uploaded under
+    :param container_settings: Runs the task (and its coordination command)
+        inside an image prefetched by the pool.
+    :type container_settings: `azure.batch.models.TaskContainerSettings`
+    :param int max_task_retries: times Batch reruns the task after it
+        failed, eg to resume it from a checkpoint
+    :rtype: `azure.batch.models.TaskAddParameter`
     """
-
-    print('Adding {} task to job [{}]...'.format(task_id, job_id))
-
     multi_instance_settings = None
     if coordination_cmdline or (num_instances and num_instances > 1):
         multi_instance_settings = batchmodels.MultiInstanceSettings(
@@ -119,20 +254,159 @@ def add_task(
         file_pattern=output_file_names,
         destination=batchmodels.OutputFileDestination(
             container=batchmodels.OutputFileBlobContainerDestination(
-                container_url=output_container_sas)),
+                container_url=output_container_sas, path=output_path)),
         upload_options=batchmodels.OutputFileUploadOptions(
             upload_condition=batchmodels.
             OutputFileUploadCondition.task_completion))
-    task = batchmodels.TaskAddParameter(
+    return batchmodels.TaskAddParameter(
         id=task_id,
         command_line=application_cmdline,
+        container_settings=container_settings,
         user_identity=batchmodels.UserIdentity(auto_user=user),
         resource_files=input_files,
         multi_instance_settings=multi_instance_settings,
+        environment_settings=environment_settings,
+        constraints=batchmodels.TaskConstraints(
+            max_task_retry_count=max_task_retries)
+        if max_task_retries else None,
         output_files=[output_file])
+
+
+def add_task(
+        batch_service_client, job_id, task_id, num_instances,
+        application_cmdline, input_files, elevation_level,
+        output_file_names, output_container_sas,
+        coordination_cmdline, common_files, environment_settings=None,
+        output_path=None, container_settings=None, max_task_retries=0):
+    """
+    Adds a task for each input file in the collection to the specified job.
+
+    :param batch_service_client: A Batch service client.
+    :type batch_service_client: `azure.batch.BatchServiceClient`
+    :param str job_id: The ID of the job to which to add the task.
+    :param str task_id: The ID of the task to be added.
+    :param str application_cmdline: The application commandline for the task.
+    :param list input_files: A collection of input files.
+    :param elevation_level: Elevation level used to run the task; either
+     'admin' or 'nonadmin'.
+    :type elevation_level: `azure.batch.models.ElevationLevel`
+    :param int num_instances: Number of instances for the task
+    :param str coordination_cmdline: The application commandline for the task.
+    :param list common_files: A collection of common input files.
+    :param list environment_settings: A list of
+        `azure.batch.models.EnvironmentSetting` for the task.
+    :param str output_path: virtual directory of the output container the
+        output files are uploaded under
+    :param container_settings: Runs the task inside an image.
+    :type container_settings: `azure.batch.models.TaskContainerSettings`
+    :param int max_task_retries: times Batch reruns the task after it
+        failed
+    """
+
+    print('Adding {} task to job [{}]...'.format(task_id, job_id))
+
+    task = build_task(
+        task_id, num_instances, application_cmdline, input_files,
+        elevation_level, output_file_names, output_container_sas,
+        coordination_cmdline, common_files,
+        environment_settings=environment_settings, output_path=output_path,
+        container_settings=container_settings,
+        max_task_retries=max_task_retries)
     batch_service_client.task.add(job_id, task)
 
 
+def _add_task_chunk(batch_service_client, job_id, tasks, max_attempts):
+    """
+    Adds up to _ADD_COLLECTION_MAX_TASKS tasks with one add_collection call,
+    resending only the entries which failed with a server error. A chunk the
+    service rejects as too large is split in half.
+
+    :rtype: list
+    :return: (task id, error) of every task which could not be added.
+    """
+    pending = list(tasks)
+    failed = []
+    for attempt in range(max_attempts):
+        try:
+            result = batch_service_client.task.add_collection(
+                job_id, pending)
+        except batchmodels.BatchErrorException as err:
+            if (err.error.code != 'RequestBodyTooLarge' or
+                    len(pending) == 1):
+                raise
+            half = len(pending) // 2
+            return (
+                _add_task_chunk(batch_service_client, job_id,
+                                pending[:half], max_attempts) +
+                _add_task_chunk(batch_service_client, job_id,
+                                pending[half:], max_attempts))
+
+        tasks_by_id = {task.id: task for task in pending}
+        pending = []
+        for entry in result.value:
+            if entry.status == batchmodels.TaskAddStatus.success:
+                continue
+            if entry.status == batchmodels.TaskAddStatus.server_error:
+                pending.append(tasks_by_id[entry.task_id])
+            elif attempt > 0 and entry.error.code == 'TaskExists':
+                # an earlier attempt reported a server error but did add it
+                continue
+            else:
+                failed.append((entry.task_id, entry.error))
+        if not pending:
+            return failed
+        time.sleep(2 ** attempt)
+    return failed + [(task.id, None) for task in pending]
+
+
+def add_tasks(
+        batch_service_client, job_id, tasks,
+        max_workers=_ADD_COLLECTION_MAX_WORKERS,
+        max_attempts=_ADD_COLLECTION_MAX_ATTEMPTS):
+    """
+    Adds many tasks to a job with concurrent add_collection calls of up to
+    _ADD_COLLECTION_MAX_TASKS tasks each. Entries which fail with a server
+    error are retried on their own, the rest of the chunk is not resent.
+
+    :param batch_service_client: A Batch service client.
+    :type batch_service_client: `azure.batch.BatchServiceClient`
+    :param str job_id: The ID of the job to which to add the tasks.
+    :param list tasks: A list of `azure.batch.models.TaskAddParameter`, eg
+        built with build_task.
+    :param int max_workers: maximum number of concurrent add_collection calls
+    :param int max_attempts: attempts for each task failing with a server
+        error
+    :raises RuntimeError: if any task could not be added
+    """
+    tasks = list(tasks)
+    print('Adding {} tasks to job [{}]...'.format(len(tasks), job_id))
+    start_time = time.time()
+
+    chunks = [tasks[i:i + _ADD_COLLECTION_MAX_TASKS]
+              for i in range(0, len(tasks), _ADD_COLLECTION_MAX_TASKS)]
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        futures = [executor.submit(
+            _add_task_chunk, batch_service_client, job_id, chunk,
+            max_attempts) for chunk in chunks]
+        for future in concurrent.futures.as_completed(futures):
+            failed.extend(future.result())
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print('  Added {} tasks in {} chunk(s) in {:.1f}s ({:.1f} tasks/s)'.format(
+        len(tasks) - len(failed), len(chunks), elapsed,
+        (len(tasks) - len(failed)) / elapsed))
+
+    if failed:
+        for task_id, error in failed:
+            print('  Failed to add task {}: {}'.format(
+                task_id, error.message.value if error is not None and
+                error.message is not None else 'server error'))
+        raise RuntimeError('{} of {} task(s) could not be added to job {}'
+                           .format(len(failed), len(tasks), job_id))
+
+
 def wait_for_subtasks_to_complete(
         batch_service_client, job_id, task_id, timeout):
     """
@@ -146,25 +420,19 @@ def wait_for_subtasks_to_complete(
     tasks in the specified job do not reach Completed state within this time
     period, an exception will be raised.
     """
-    timeout_expiration = datetime.datetime.now() + timeout
-
     print("Monitoring all tasks for 'Completed' state, timeout in {}..."
           .format(timeout), end='')
 
-    while datetime.datetime.now() < timeout_expiration:
-        print('.', end='')
-        sys.stdout.flush()
-
-        subtasks = batch_service_client.task.list_subtasks(job_id, task_id)
-        incomplete_subtasks = [subtask for subtask in subtasks.value if
-                               subtask.state !=
-                               batchmodels.TaskState.completed]
-
-        if not incomplete_subtasks:
-            print("Subtask complete!")
-            return True
-        else:
-            time.sleep(10)
+    poller = common.polling.AdaptivePoller()
+    poller.watch(
+        task_id,
+        lambda: list_incomplete_subtask_ids(
+            batch_service_client, job_id, task_id),
+        lambda incomplete_subtask_ids: not incomplete_subtask_ids,
+        _print_progress)
+    if poller.run(timeout):
+        print("Subtask complete!")
+        return True
 
     print("Subtasks did not reach completed state within timeout period!")
     raise RuntimeError(
@@ -172,7 +440,8 @@ def wait_for_subtasks_to_complete(
         "timeout period of " + str(timeout))
 
 
-def wait_for_tasks_to_complete(batch_service_client, job_id, timeout):
+def wait_for_tasks_to_complete(batch_service_client, job_id, timeout,
+                               preemption_monitor=None):
     """
     Returns when all tasks in the specified job reach the Completed state.
 
@@ -182,32 +451,200 @@ def wait_for_tasks_to_complete(batch_service_client, job_id, timeout):
     :param timedelta timeout: The duration to wait for task completion. If all
     tasks in the specified job do not reach Completed state within this time
     period, an exception will be raised.
+    :param preemption_monitor: Polled along with the tasks, to report
+        preemptions and requeues and keep the pool at its target.
+    :type preemption_monitor: `common.preemption.PreemptionMonitor`
     """
-    timeout_expiration = datetime.datetime.now() + timeout
-
     print("Monitoring all tasks for 'Completed' state, timeout in {}..."
           .format(timeout), end='')
 
-    while datetime.datetime.now() < timeout_expiration:
-        print('.', end='')
-        sys.stdout.flush()
-        tasks = batch_service_client.task.list(job_id)
-
-        for task in tasks:
-            if task.state == batchmodels.TaskState.completed:
-                # Pause execution until subtasks reach Completed state.
-                wait_for_subtasks_to_complete(batch_service_client, job_id,
-                                              task.id,
-                                              datetime.timedelta(minutes=10))
-
-        incomplete_tasks = [task for task in tasks if
-                            task.state != batchmodels.TaskState.completed]
-        if not incomplete_tasks:
-            print("Taskss complete!")
-            return True
-        else:
-            time.sleep(10)
+    # tasks and the subtasks of multi-instance tasks are tracked together,
+    # so the job is done as soon as the last of them completes
+    monitor = TaskMonitor(batch_service_client, job_id)
+    poll = monitor.refresh
+    is_done = monitor.is_done
+    if preemption_monitor is not None:
+        # refreshed by the same watch, so the loop ends with the tasks
+        def poll():
+            return monitor.refresh(), preemption_monitor.refresh()
 
-        print("Tasks did not reach completed state within timeout period!")
+        def is_done(state):
+            return monitor.is_done(state[0])
+    poller = common.polling.AdaptivePoller()
+    poller.watch(job_id, poll, is_done, _print_progress)
+    if poller.run(timeout):
+        print("Tasks complete!")
+        return True
+
+    print("Tasks did not reach completed state within timeout period!")
     raise RuntimeError("ERROR: Tasks did not reach 'Completed' state within "
                        "timeout period of " + str(timeout))
+
+
+def wait_for_jobs_to_complete(batch_service_client, job_ids, timeout):
+    """
+    Returns when all tasks in all of the specified jobs reach the Completed
+    state. Every job is watched from a single polling loop.
+
+    :param batch_service_client: A Batch service client.
+    :type batch_service_client: `azure.batch.BatchServiceClient`
+    :param list job_ids: The ids of the jobs whose tasks should be monitored.
+    :param timedelta timeout: The duration to wait for task completion. If all
+    tasks in the specified jobs do not reach Completed state within this time
+    period, an exception will be raised.
+    """
+    print("Monitoring {} job(s) for 'Completed' state, timeout in {}..."
+          .format(len(job_ids), timeout), end='')
+
+    poller = common.polling.AdaptivePoller()
+    for job_id in job_ids:
+        monitor = TaskMonitor(batch_service_client, job_id)
+        poller.watch(job_id, monitor.refresh, monitor.is_done,
+                     _print_progress)
+    if poller.run(timeout):
+        print("Jobs complete!")
+        return True
+
+    print("Jobs did not reach completed state within timeout period!")
+    raise RuntimeError("ERROR: Jobs {} did not reach 'Completed' state within "
+                       "timeout period of {}".format(
+                           ', '.join(poller.pending()), timeout))
+
+
+def list_incomplete_subtask_ids(batch_service_client, job_id, task_id):
+    """
+    Lists the ids of the subtasks of a multi-instance task which are not
+    completed, only transferring the subtask ids and states.
+
+    :param batch_service_client: A Batch service client.
+    :type batch_service_client: `azure.batch.BatchServiceClient`
+    :param str job_id: The id of the job.
+    :param str task_id: The id of the multi-instance task.
+    :rtype: tuple
+    :return: The sorted ids of the incomplete subtasks.
+    """
+    subtasks = batch_service_client.task.list_subtasks(
+        job_id, task_id,
+        task_list_subtasks_options=batchmodels.TaskListSubtasksOptions(
+            select='id,state'))
+    return tuple(sorted(
+        subtask.id for subtask in subtasks.value
+        if subtask.state != batchmodels.TaskState.completed))
+
+
+class TaskMonitor(object):
+    """Tracks every task of a job, and the subtasks of its multi-instance
+    tasks, in one status table which is updated incrementally.
+
+    The first refresh lists all tasks. Later refreshes only list the tasks
+    which were not completed yet, and only query subtasks of multi-instance
+    tasks which have completed but still have unfinished subtasks, so the
+    cost of a refresh shrinks as the job progresses.
+    """
+    def __init__(self, batch_service_client, job_id,
+                 max_workers=_SUBTASK_QUERY_MAX_WORKERS):
+        self.batch_service_client = batch_service_client
+        self.job_id = job_id
+        self.max_workers = max_workers
+        # task id -> task state
+        self.task_states = {}
+        # task id -> {subtask id -> subtask state}, multi-instance tasks only
+        self.subtask_states = {}
+        # multi-instance tasks whose subtasks have all completed
+        self.settled_task_ids = set()
+        self._seeded = False
+
+    def _list_tasks(self, task_filter=None):
+        return self.batch_service_client.task.list(
+            self.job_id, task_list_options=batchmodels.TaskListOptions(
+                filter=task_filter, select='id,state,multiInstanceSettings'))
+
+    def _record_task(self, task):
+        self.task_states[task.id] = task.state
+        if (task.multi_instance_settings is not None and
+                task.id not in self.subtask_states):
+            self.subtask_states[task.id] = {}
+
+    def _list_subtask_states(self, task_id):
+        subtasks = self.batch_service_client.task.list_subtasks(
+            self.job_id, task_id,
+            task_list_subtasks_options=batchmodels.TaskListSubtasksOptions(
+                select='id,state'))
+        return task_id, {subtask.id: subtask.state
+                         for subtask in subtasks.value}
+
+    def refresh(self):
+        """Updates the status table from the Batch service.
+
+        :rtype: tuple
+        :return: A snapshot of the status table, see summary.
+        """
+        completed = batchmodels.TaskState.completed
+        if not self._seeded:
+            for task in self._list_tasks():
+                self._record_task(task)
+            self._seeded = True
+        else:
+            incomplete = list(
+                self._list_tasks(task_filter="state ne 'completed'"))
+            incomplete_ids = set(task.id for task in incomplete)
+            for task_id in self.task_states:
+                if task_id not in incomplete_ids:
+                    self.task_states[task_id] = completed
+            for task in incomplete:
+                self._record_task(task)
+
+        unsettled = [
+            task_id for task_id in self.subtask_states
+            if self.task_states[task_id] == completed and
+            task_id not in self.settled_task_ids]
+        if unsettled:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers) as executor:
+                for task_id, states in executor.map(
+                        self._list_subtask_states, unsettled):
+                    self.subtask_states[task_id] = states
+                    if all(state == completed for state in states.values()):
+                        self.settled_task_ids.add(task_id)
+
+        if self.is_done():
+            # pick up tasks which were added and completed between polls
+            # before declaring the job done
+            for task in self._list_tasks(task_filter="state eq 'completed'"):
+                if task.id not in self.task_states:
+                    self._record_task(task)
+
+        return self.summary()
+
+    def summary(self):
+        """Summarizes the status table.
+
+        :rtype: tuple
+        :return: (number of tasks, completed tasks, multi-instance tasks,
+            multi-instance tasks whose subtasks all completed)
+        """
+        completed = batchmodels.TaskState.completed
+        return (len(self.task_states),
+                sum(1 for state in self.task_states.values()
+                    if state == completed),
+                len(self.subtask_states),
+                len(self.settled_task_ids))
+
+    def is_done(self, summary=None):
+        """Returns True once every task and subtask has completed.
+
+        :param tuple summary: A summary to check, defaults to the current one.
+        :rtype: bool
+        """
+        if summary is None:
+            summary = self.summary()
+        task_count, completed_count, multi_instance_count, settled_count = \
+            summary
+        return (self._seeded and completed_count == task_count and
+                settled_count == multi_instance_count)
+
+
+def _print_progress(_, state):
+    """Prints a progress mark whenever a polled state changes."""
+    print('.', end='')
+    sys.stdout.flush()
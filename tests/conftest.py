@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import common.emulator  # noqa: E402
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    """Points the local state directory (~/.hpc-dfo) into tmp_path"""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    return tmp_path / '.hpc-dfo'
+
+
+@pytest.fixture
+def blob_client(tmp_path, state_dir):
+    """An emulated blob service, its Batch service is stopped afterwards"""
+    batch_service, blob_service = common.emulator.create_clients(
+        root=str(tmp_path / 'emulator'), seed=0)
+    yield blob_service
+    batch_service.close()
+
+
+@pytest.fixture
+def batch_client(tmp_path, state_dir):
+    """An emulated Batch service with fast nodes and autoscale evaluations"""
+    batch_service, _ = common.emulator.create_clients(
+        root=str(tmp_path / 'emulator'), seed=0, allocation_delay=0.1,
+        boot_delay=0.1, jitter=0.0, autoscale_interval=0.2)
+    yield batch_service
+    batch_service.close()
@@ -0,0 +1,82 @@
+import azure.batch.models as batchmodels
+import pytest
+
+import multi_task_helpers
+
+
+def _server_error(task_id):
+    return batchmodels.TaskAddResult(
+        status=batchmodels.TaskAddStatus.server_error, task_id=task_id,
+        error=batchmodels.BatchError(code='ServerBusy'))
+
+
+def _add_job(batch_client):
+    batch_client.pool.add(batchmodels.PoolAddParameter(
+        id='pool', vm_size='standard_a1', target_dedicated_nodes=0))
+    batch_client.job.add(batchmodels.JobAddParameter(
+        id='job', pool_info=batchmodels.PoolInformation(pool_id='pool')))
+
+
+def _tasks(count):
+    return [batchmodels.TaskAddParameter(
+        id='task-{:03d}'.format(index), command_line='/bin/true')
+        for index in range(count)]
+
+
+def _record_calls(batch_client, lost=(), dropped=()):
+    """Wraps add_collection, recording the task ids of every call. The
+    tasks in lost are added but reported as server errors, the ones in
+    dropped are not sent and reported as server errors, both only once."""
+    add_collection = batch_client.task.add_collection
+    lost, dropped = set(lost), set(dropped)
+    calls = []
+
+    def _add_collection(job_id, value, *args, **kwargs):
+        calls.append([task.id for task in value])
+        sent = [task for task in value if task.id not in dropped]
+        result = add_collection(job_id, sent, *args, **kwargs)
+        result.value = [
+            _server_error(entry.task_id) if entry.task_id in lost else entry
+            for entry in result.value] + [
+            _server_error(task.id) for task in value if task.id in dropped]
+        lost.clear()
+        dropped.clear()
+        return result
+    batch_client.task.add_collection = _add_collection
+    return calls
+
+
+def _task_ids(batch_client):
+    return sorted(task.id for task in batch_client.task.list('job'))
+
+
+def test_chunk_too_large_is_split(batch_client):
+    _add_job(batch_client)
+    calls = _record_calls(batch_client)
+    tasks = _tasks(150)
+    assert multi_task_helpers._add_task_chunk(
+        batch_client, 'job', tasks, 3) == []
+    assert [len(call) for call in calls] == [150, 75, 75]
+    assert _task_ids(batch_client) == [task.id for task in tasks]
+
+
+def test_only_server_errors_are_resent(batch_client):
+    _add_job(batch_client)
+    calls = _record_calls(
+        batch_client, lost=['task-001'], dropped=['task-003'])
+    assert multi_task_helpers._add_task_chunk(
+        batch_client, 'job', _tasks(5), 3) == []
+    # the lost task was added by the first call, its TaskExists is fine
+    assert calls[1] == ['task-001', 'task-003']
+    assert _task_ids(batch_client) == [task.id for task in _tasks(5)]
+
+
+def test_existing_tasks_fail_the_submission(batch_client):
+    _add_job(batch_client)
+    batch_client.task.add('job', _tasks(1)[0])
+    failed = multi_task_helpers._add_task_chunk(
+        batch_client, 'job', _tasks(3), 3)
+    assert [(task_id, error.code) for task_id, error in failed] == [
+        ('task-000', 'TaskExists')]
+    with pytest.raises(RuntimeError):
+        multi_task_helpers.add_tasks(batch_client, 'job', _tasks(3))
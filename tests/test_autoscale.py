@@ -0,0 +1,93 @@
+import pytest
+
+import common.autoscale
+
+
+def _samples(active, running, seconds=600, step=30):
+    times = range(0, seconds, step)
+    return {'ActiveTasks': [(t, float(active)) for t in times],
+            'RunningTasks': [(t, float(running)) for t in times]}
+
+
+def _target(formula, metrics, now=600, **nodes):
+    result = common.autoscale.evaluate_formula(formula, metrics, now, **nodes)
+    return (result['$TargetDedicatedNodes'],
+            result.get('$TargetLowPriorityNodes'))
+
+
+def test_evaluator_precedence_and_ternary():
+    result = common.autoscale.evaluate_formula(
+        '$a = 1 + 2 * 3; $b = $a > 6 && !0 ? max(1, 5) : -1;', {}, 0)
+    assert result['$a'] == 7
+    assert result['$b'] == 5
+
+
+def test_formula_sizes_for_current_demand():
+    formula = common.autoscale.build_autoscale_formula(0, 20, 2)
+    assert _target(formula, _samples(3, 2))[0] == 10
+
+
+def test_formula_clamps_to_range():
+    formula = common.autoscale.build_autoscale_formula(1, 4, 2)
+    assert _target(formula, _samples(10, 0))[0] == 4
+    assert _target(formula, _samples(0, 0))[0] == 1
+
+
+def test_formula_does_not_count_started_tasks_twice():
+    # the five tasks were queued for the whole window and just started
+    metrics = _samples(5, 0)
+    metrics['ActiveTasks'][-1] = (570, 0.0)
+    metrics['RunningTasks'][-1] = (570, 5.0)
+    formula = common.autoscale.build_autoscale_formula(0, 8)
+    assert _target(formula, metrics, target_dedicated_nodes=5)[0] == 5
+
+
+def test_formula_smooths_scale_down_only():
+    formula = common.autoscale.build_autoscale_formula(0, 8)
+    # the backlog drained in the last sample, the window still had 4 tasks
+    metrics = _samples(4, 0)
+    metrics['ActiveTasks'][-1] = (570, 0.0)
+    target = _target(formula, metrics, target_dedicated_nodes=4)[0]
+    assert 0 < target < 4
+    # but never holds more nodes than the current target
+    assert _target(formula, metrics, target_dedicated_nodes=2)[0] <= 2
+
+
+def test_invalid_range_is_rejected():
+    with pytest.raises(ValueError):
+        common.autoscale.build_autoscale_formula(5, 2)
+
+
+def test_idle_ttl_releases_nodes_and_brings_them_back():
+    formula = common.autoscale.add_idle_ttl(
+        common.autoscale.build_fixed_size_formula(3, 2), 10)
+    # too few samples yet, eg a pool which was just created
+    assert _target(formula, _samples(0, 0, seconds=60)) == (3, 2)
+    assert _target(formula, _samples(0, 0)) == (0, 0)
+    metrics = _samples(0, 0)
+    metrics['ActiveTasks'].append((600, 1.0))
+    assert _target(formula, metrics) == (3, 2)
+
+
+def test_idle_ttl_keeps_autoscale_targets_while_busy():
+    formula = common.autoscale.add_idle_ttl(
+        common.autoscale.build_autoscale_formula(0, 8, 2), 10)
+    assert _target(formula, _samples(1, 1))[0] == 4
+    assert _target(formula, _samples(0, 0))[0] == 0
+
+
+def test_simulation_does_not_overshoot():
+    formula = common.autoscale.build_autoscale_formula(0, 8)
+    result = common.autoscale.simulate(formula, [(0, 30, 1)] * 5)
+    assert result['unfinished'] == 0
+    assert max(target for _, target, _, _, _ in result['timeline']) == 5
+
+
+def test_simulation_runs_every_task_within_max_nodes():
+    formula = common.autoscale.build_autoscale_formula(0, 4, 2)
+    result = common.autoscale.simulate(formula, [(0, 20, 2)] * 6)
+    assert result['unfinished'] == 0
+    assert all(nodes <= 4 for _, _, nodes, _, _ in result['timeline'])
+    # three rounds of two tasks, after the first allocation
+    assert result['makespan_minutes'] >= 60
+    assert 'makespan' in common.autoscale.format_simulation(result)
@@ -0,0 +1,72 @@
+import io
+import os
+import subprocess
+import tarfile
+
+import common.checkpoint
+
+
+def _archive(files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as archive:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+def _restore(checkpoint, working_dir, member=None):
+    """Runs the restore commands like a task would, returns its output and
+    the value of HPC_DFO_RESTART"""
+    environment = dict(os.environ)
+    if member is not None:
+        environment['HPC_DFO_MEMBER'] = member
+    output = subprocess.check_output(
+        ['/bin/bash', '-c', '; '.join(
+            checkpoint.get_restore_commands() +
+            ['echo "restart=$HPC_DFO_RESTART"'])],
+        cwd=str(working_dir), env=environment).decode('utf-8')
+    lines = output.splitlines()
+    return lines[:-1], lines[-1].split('=', 1)[1]
+
+
+def test_nothing_to_restore(blob_client, tmp_path):
+    checkpoint = common.checkpoint.Checkpoint(
+        blob_client, 'checkpoints', 'run', ['restart.dat'])
+    output, restart = _restore(checkpoint, tmp_path)
+    assert output == ['No checkpoint to restore']
+    assert restart == '0'
+    assert not (tmp_path / 'restart.dat').exists()
+
+
+def test_latest_checkpoint_of_the_member_is_restored(blob_client, tmp_path):
+    checkpoint = common.checkpoint.Checkpoint(
+        blob_client, 'checkpoints', 'run', ['restart.dat'])
+    for member, content in (('task', b'step 10'), ('member-001', b'step 7')):
+        blob_client.create_blob_from_bytes(
+            'checkpoints', 'run/{}/checkpoint-2.tar.gz'.format(member),
+            _archive({'restart.dat': content}))
+        blob_client.create_blob_from_bytes(
+            'checkpoints', 'run/{}/latest'.format(member),
+            b'checkpoint-2.tar.gz\n')
+    # a superseded checkpoint is not picked up
+    blob_client.create_blob_from_bytes(
+        'checkpoints', 'run/task/checkpoint-1.tar.gz',
+        _archive({'restart.dat': b'step 5'}))
+
+    output, restart = _restore(checkpoint, tmp_path)
+    assert output == ['Restored checkpoint-2.tar.gz']
+    assert restart == '1'
+    assert (tmp_path / 'restart.dat').read_bytes() == b'step 10'
+    # the checkpoint loop deletes it once it uploaded a newer one
+    assert (tmp_path / '.hpc-dfo-checkpoint-latest').read_text() == (
+        'checkpoint-2.tar.gz\n')
+
+    member_dir = tmp_path / 'member'
+    member_dir.mkdir()
+    _restore(checkpoint, member_dir, member='member-001')
+    assert (member_dir / 'restart.dat').read_bytes() == b'step 7'
+
+    checkpoint.delete(blob_client)
+    assert checkpoint.list_checkpoints(blob_client) == []
@@ -0,0 +1,76 @@
+import datetime
+import time
+
+import azure.batch.models as batchmodels
+import pytest
+
+import common.autoscale
+import multi_task_helpers
+
+
+def _wait_for_pool(batch_client, pool_id, condition, timeout=20):
+    deadline = time.time() + timeout
+    while True:
+        pool = batch_client.pool.get(pool_id)
+        if condition(pool):
+            return pool
+        assert time.time() < deadline, 'pool {} never reached the state'.format(
+            pool_id)
+        time.sleep(0.1)
+
+
+def _add_pool(batch_client, pool_id, formula, start_task=None):
+    batch_client.pool.add(batchmodels.PoolAddParameter(
+        id=pool_id, vm_size='standard_a1', enable_auto_scale=True,
+        auto_scale_formula=formula,
+        auto_scale_evaluation_interval=datetime.timedelta(minutes=5),
+        start_task=start_task))
+
+
+def test_idle_warm_pool_releases_its_nodes(batch_client):
+    formula = common.autoscale.add_idle_ttl(
+        common.autoscale.build_fixed_size_formula(2), 1)
+    _add_pool(batch_client, 'warm', formula)
+    assert batch_client.pool.get('warm').target_dedicated_nodes == 2
+
+    _wait_for_pool(batch_client, 'warm', lambda pool: (
+        pool.target_dedicated_nodes == 0 and
+        pool.current_dedicated_nodes == 0))
+
+    # a queued task brings the pool back to its size
+    batch_client.job.add(batchmodels.JobAddParameter(
+        id='job', pool_info=batchmodels.PoolInformation(pool_id='warm')))
+    batch_client.task.add('job', batchmodels.TaskAddParameter(
+        id='task', command_line='/bin/bash -c true'))
+    _wait_for_pool(batch_client, 'warm', lambda pool: (
+        pool.target_dedicated_nodes == 2))
+
+
+def test_pool_start_task_can_be_replaced(batch_client):
+    _add_pool(batch_client, 'warm',
+              common.autoscale.build_fixed_size_formula(0),
+              multi_task_helpers.build_start_task('/bin/bash -c "echo old"'))
+    batch_client.pool.patch('warm', batchmodels.PoolPatchParameter(
+        start_task=multi_task_helpers.build_start_task(
+            '/bin/bash -c "echo new"')))
+    assert batch_client.pool.get('warm').start_task.command_line == (
+        '/bin/bash -c "echo new"')
+
+
+def test_autoscale_pool_cannot_be_resized_by_hand(batch_client):
+    _add_pool(batch_client, 'warm',
+              common.autoscale.build_fixed_size_formula(1))
+    _wait_for_pool(batch_client, 'warm', lambda pool: (
+        pool.allocation_state == batchmodels.AllocationState.steady and
+        pool.current_dedicated_nodes == 1))
+    with pytest.raises(batchmodels.BatchErrorException) as err:
+        batch_client.pool.resize('warm', batchmodels.PoolResizeParameter(
+            target_dedicated_nodes=2))
+    assert err.value.error.code == 'AutoScalingEnabled'
+
+    node, = batch_client.compute_node.list('warm')
+    with pytest.raises(batchmodels.BatchErrorException) as err:
+        batch_client.pool.remove_nodes('warm', batchmodels.NodeRemoveParameter(
+            node_list=[node.id]))
+    assert err.value.error.code == 'AutoScalingEnabled'
+    assert batch_client.pool.get('warm').target_dedicated_nodes == 1
@@ -0,0 +1,80 @@
+import common.imb
+
+
+_IMB_OUTPUT = """\
+#------------------------------------------------------------
+#    Intel (R) MPI Benchmarks 2018, MPI-1 part
+#------------------------------------------------------------
+# List of Benchmarks to run:
+# PingPong
+# Allreduce
+
+#---------------------------------------------------
+# Benchmarking PingPong
+# #processes = 2
+#---------------------------------------------------
+       #bytes #repetitions      t[usec]   Mbytes/sec
+            0         1000         1.50         0.00
+         1024         1000         2.00       512.00
+      1048576           40       300.00      3495.25
+
+#----------------------------------------------------------------
+# Benchmarking Allreduce
+# #processes = 4
+#----------------------------------------------------------------
+       #bytes #repetitions  t_min[usec]  t_max[usec]  t_avg[usec]
+            0         1000         0.05         0.06         0.05
+            4         1000         3.10         3.50         3.30
+
+# All processes entering MPI_Finalize
+"""
+
+
+def _record(run_id, scale=1.0):
+    record = common.imb.make_run_records(
+        run_id, 'Standard_H16r', 2, 'shm:dapl', _IMB_OUTPUT)[0]
+    for row in record['rows']:
+        row['t_usec'] *= scale
+        row['mbytes_per_sec'] /= scale
+    return record
+
+
+def test_parse_tables():
+    tables = common.imb.parse_imb_output(_IMB_OUTPUT)
+    assert [(table['benchmark'], table['processes']) for table in tables] == [
+        ('PingPong', 2), ('Allreduce', 4)]
+    assert tables[0]['rows'][1] == {
+        'bytes': 1024, 'repetitions': 1000, 't_usec': 2.0,
+        'mbytes_per_sec': 512.0}
+    assert tables[1]['rows'][1]['t_avg_usec'] == 3.3
+
+
+def test_parse_ignores_output_without_tables():
+    assert common.imb.parse_imb_output('mpirun: command not found\n') == []
+
+
+def test_history_round_trip(tmp_path):
+    history_path = str(tmp_path / 'history.jsonl')
+    common.imb.append_history([_record('a'), _record('b')], history_path)
+    assert [record['run_id']
+            for record in common.imb.load_history(history_path)] == ['a', 'b']
+
+
+def test_find_regressions_against_the_baseline():
+    history = [_record('a'), _record('b'), _record('c', scale=1.05)]
+    assert common.imb.find_regressions(_record('d', scale=1.05), history) == []
+
+    regressions = common.imb.find_regressions(_record('d', scale=1.5), history)
+    metrics = set((regression['bytes'], regression['metric'])
+                  for regression in regressions)
+    assert (1024, 'latency_usec') in metrics
+    assert (1024, 'bandwidth_mbytes_per_sec') in metrics
+    # a zero baseline bandwidth is never flagged
+    assert (0, 'bandwidth_mbytes_per_sec') not in metrics
+
+
+def test_find_regressions_needs_a_matching_baseline():
+    other_size = _record('a')
+    other_size['node_count'] = 4
+    assert common.imb.find_regressions(
+        _record('b', scale=2.0), [other_size]) == []
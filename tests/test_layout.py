@@ -0,0 +1,66 @@
+import pytest
+
+import common.layout
+
+
+def test_mpi_policy_runs_a_rank_per_core():
+    layout = common.layout.plan_layout('Standard_H16r', 2)
+    assert (layout['ranks'], layout['ranks_per_node'],
+            layout['threads_per_rank']) == (32, 16, 1)
+    assert ('I_MPI_PIN_DOMAIN', 'core') in layout['environment']
+    assert ('OMP_NUM_THREADS', '1') in layout['environment']
+
+
+def test_hybrid_policy_runs_a_rank_per_numa_domain():
+    layout = common.layout.plan_layout('Standard_HB60rs', 1, policy='hybrid')
+    assert (layout['ranks_per_node'], layout['threads_per_rank']) == (15, 4)
+    assert ('I_MPI_PIN_DOMAIN', 'numa') in layout['environment']
+
+
+def test_one_count_derives_the_other():
+    layout = common.layout.plan_layout(
+        'Standard_H16r', 1, threads_per_rank=4)
+    assert layout['ranks_per_node'] == 4
+    layout = common.layout.plan_layout(
+        'Standard_H16r', 1, policy='hybrid', ranks_per_node=8)
+    assert layout['threads_per_rank'] == 2
+    assert ('I_MPI_PIN_DOMAIN', 'omp') in layout['environment']
+
+
+def test_hyperthreads_count_as_slots():
+    layout = common.layout.plan_layout(
+        'Standard_F16s_v2', 1, use_hyperthreads=True)
+    assert layout['ranks_per_node'] == 16
+    assert ('OMP_PLACES', 'threads') in layout['environment']
+    assert common.layout.plan_layout(
+        'Standard_F16s_v2', 1)['ranks_per_node'] == 8
+
+
+def test_topology_overrides_unknown_vm_size():
+    with pytest.raises(ValueError):
+        common.layout.plan_layout('Standard_Unknown', 1)
+    layout = common.layout.plan_layout(
+        'Standard_Unknown', 3, topology=(12, 1, 1))
+    assert layout['ranks'] == 36
+
+
+def test_oversubscription_is_rejected():
+    with pytest.raises(ValueError):
+        common.layout.plan_layout(
+            'Standard_H16r', 1, ranks_per_node=8, threads_per_rank=4)
+    with pytest.raises(ValueError):
+        common.layout.plan_layout('Standard_H16r', 1, policy='threads')
+
+
+def test_layout_commands_and_summary():
+    layout = common.layout.plan_layout(
+        'Standard_H16r', 2, ranks_per_node=12)
+    commands = common.layout.get_layout_commands(layout)
+    assert 'export OMP_NUM_THREADS=1' in commands
+    assert any('HPC_DFO_RANKS=24 HPC_DFO_RANKS_PER_NODE=12' in command
+               for command in commands)
+    # commands are joined inside single quotes on the node
+    assert not any("'" in command for command in commands)
+    assert common.layout.format_layout(layout) == (
+        '24 rank(s) on 2 x Standard_H16r: 12 per node x 1 thread(s), '
+        '4 idle slot(s) per node')
@@ -0,0 +1,43 @@
+import time
+
+import azure.batch.models as batchmodels
+
+import common.node_health
+
+
+def _add_pool(batch_client, marker_dir):
+    # the start task fails on the first node to boot, and only the first time
+    batch_client.pool.add(batchmodels.PoolAddParameter(
+        id='pool', vm_size='standard_a1', target_dedicated_nodes=1,
+        start_task=batchmodels.StartTask(
+            command_line='/bin/bash -c "mkdir {} 2>/dev/null && exit 1; '
+                         'exit 0"'.format(marker_dir / 'failed'),
+            wait_for_success=True)))
+
+
+def _refresh_until_done(manager, timeout=20):
+    deadline = time.time() + timeout
+    while not manager.is_done(manager.refresh()):
+        assert time.time() < deadline, 'nodes never became healthy'
+        time.sleep(0.1)
+    return manager.healthy_nodes()
+
+
+def test_bad_node_is_rebooted(batch_client, tmp_path):
+    _add_pool(batch_client, tmp_path)
+    manager = common.node_health.NodeHealthManager(batch_client, 'pool', 1)
+    node, = _refresh_until_done(manager)
+    assert manager.repairs == {node.id: 1}
+    assert manager.replacements == 0
+
+
+def test_bad_node_is_replaced_once_repairs_run_out(batch_client, tmp_path):
+    _add_pool(batch_client, tmp_path)
+    manager = common.node_health.NodeHealthManager(
+        batch_client, 'pool', 1, max_repairs=0, max_replacements=1)
+    _refresh_until_done(manager)
+    assert manager.repairs == {}
+    assert manager.replacements == 1
+    # the pool was resized back to its target, onto a new node
+    assert not manager.resize_pending
+    assert batch_client.pool.get('pool').target_dedicated_nodes == 1
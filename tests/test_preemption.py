@@ -0,0 +1,76 @@
+import datetime
+import time
+
+import azure.batch.models as batchmodels
+
+import common.preemption
+import multi_task_helpers
+
+
+def _wait_for(condition, timeout=20):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'condition never held'
+        time.sleep(0.1)
+
+
+def _add_pool_and_job(batch_client, dedicated=0, low_priority=0):
+    batch_client.pool.add(batchmodels.PoolAddParameter(
+        id='pool', vm_size='standard_a1', target_dedicated_nodes=dedicated,
+        target_low_priority_nodes=low_priority))
+    batch_client.job.add(batchmodels.JobAddParameter(
+        id='job', pool_info=batchmodels.PoolInformation(pool_id='pool')))
+
+
+def _task_state(batch_client, task_id):
+    return batch_client.task.get('job', task_id).state
+
+
+def test_preemption_requeue_and_fallback(batch_client):
+    _add_pool_and_job(batch_client, low_priority=1)
+    batch_client.task.add('job', batchmodels.TaskAddParameter(
+        id='long', command_line='/bin/bash -c "sleep 30"'))
+    _wait_for(lambda: _task_state(batch_client, 'long') ==
+              batchmodels.TaskState.running)
+
+    monitor = common.preemption.PreemptionMonitor(
+        batch_client, 'pool', 'job', 2, max_fallback_nodes=1,
+        fallback_delay=datetime.timedelta(0))
+    assert monitor.refresh() == (0, 0, 0)
+    time.sleep(0.5)
+    with batch_client.lock:
+        node, = batch_client.get_pool('pool').nodes.values()
+        batch_client.preempt_node(node)
+    assert monitor.refresh() == (1, 1, 1)
+
+    assert monitor.lost_node_seconds >= 0.5
+    assert monitor.node_seconds[False] >= 0.5
+    assert monitor.node_seconds[True] == 0.0
+    # a dedicated node replaces the preempted one
+    assert monitor.fallback_nodes == 1
+    assert batch_client.pool.get('pool').target_dedicated_nodes == 1
+
+
+def test_accounting_of_a_warm_pool(batch_client):
+    _add_pool_and_job(batch_client, dedicated=1)
+    _wait_for(lambda: [node.state for node in batch_client.compute_node.list(
+        'pool')] == [batchmodels.ComputeNodeState.idle])
+    # the node was allocated before the run, for an earlier one
+    time.sleep(1)
+
+    started = time.time()
+    monitor = common.preemption.PreemptionMonitor(
+        batch_client, 'pool', 'job', 2, started=started)
+    batch_client.task.add('job', batchmodels.TaskAddParameter(
+        id='good', command_line='/bin/bash -c true'))
+    batch_client.task.add('job', batchmodels.TaskAddParameter(
+        id='bad', command_line='/bin/bash -c "exit 1"'))
+    multi_task_helpers.wait_for_tasks_to_complete(
+        batch_client, 'job', datetime.timedelta(seconds=30),
+        preemption_monitor=monitor)
+
+    assert 0 < monitor.node_seconds[True] <= time.time() - started
+    accounting = monitor.get_accounting(
+        dedicated_price=1.0, failed_task_ids=['bad'])
+    assert accounting['succeeded_tasks'] == 1
+    assert accounting['cost_per_task'] == accounting['cost']
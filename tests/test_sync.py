@@ -0,0 +1,53 @@
+import common.sync
+
+
+def _blob_names(blob_client, container_name):
+    return sorted(blob.name for blob in blob_client.list_blobs(container_name))
+
+
+def test_sync_uploads_only_changed_files(blob_client, tmp_path):
+    first = tmp_path / 'first.sh'
+    second = tmp_path / 'second.sh'
+    first.write_text('echo first\n')
+    second.write_text('echo second\n')
+    paths = [str(first), str(second)]
+
+    files = common.sync.sync_files_to_container(
+        blob_client, 'sync-job', paths, 10, path_prefix='shared/')
+    assert [resource_file.file_path for resource_file in files] == [
+        'first.sh', 'second.sh']
+
+    uploaded = []
+    upload = blob_client.create_blob_from_path
+
+    def _record_upload(container_name, blob_name, *args, **kwargs):
+        uploaded.append(blob_name)
+        return upload(container_name, blob_name, *args, **kwargs)
+    blob_client.create_blob_from_path = _record_upload
+    common.sync.sync_files_to_container(
+        blob_client, 'sync-job', paths, 10, path_prefix='shared/')
+    assert uploaded == []
+
+    second.write_text('echo changed\n')
+    common.sync.sync_files_to_container(
+        blob_client, 'sync-job', paths, 10, path_prefix='shared/')
+    assert uploaded == ['shared/second.sh']
+
+
+def test_sync_deletes_only_blobs_it_uploaded(blob_client, tmp_path):
+    first = tmp_path / 'first.sh'
+    second = tmp_path / 'second.sh'
+    first.write_text('echo first\n')
+    second.write_text('echo second\n')
+    common.sync.sync_files_to_container(
+        blob_client, 'sync-job', [str(first), str(second)], 10,
+        path_prefix='shared/')
+    # uploaded by another run, and an overlay under a nested prefix
+    blob_client.create_blob_from_bytes('sync-job', 'shared/other.sh', b'')
+    blob_client.create_blob_from_bytes(
+        'sync-job', 'shared/member-000/params.nml', b'')
+
+    common.sync.sync_files_to_container(
+        blob_client, 'sync-job', [str(first)], 10, path_prefix='shared/')
+    assert _blob_names(blob_client, 'sync-job') == [
+        'shared/first.sh', 'shared/member-000/params.nml', 'shared/other.sh']
@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+import common.transfer
+
+
+_BLOCK_SIZE = 1024
+
+
+class _Interrupted(Exception):
+    pass
+
+
+def _count_calls(blob_client, name, fail_after=None):
+    """Wraps a blob client method, counting its calls and raising once
+    fail_after calls went through"""
+    original = getattr(blob_client, name)
+    calls = []
+
+    def _wrapper(*args, **kwargs):
+        if fail_after is not None and len(calls) >= fail_after:
+            raise _Interrupted()
+        calls.append(args)
+        return original(*args, **kwargs)
+    setattr(blob_client, name, _wrapper)
+    return calls
+
+
+@pytest.fixture
+def local_file(tmp_path):
+    path = tmp_path / 'input.bin'
+    path.write_bytes(os.urandom(10 * _BLOCK_SIZE + 100))
+    return str(path)
+
+
+def test_upload_resumes_with_missing_blocks(blob_client, local_file):
+    blob_client.create_container('inputs')
+    _count_calls(blob_client, 'put_block', fail_after=4)
+    with pytest.raises(_Interrupted):
+        common.transfer.upload_file_in_blocks(
+            blob_client, 'inputs', 'input.bin', local_file,
+            block_size=_BLOCK_SIZE, max_workers=1)
+    journal_path = common.transfer.get_journal_path('inputs', 'input.bin')
+    assert os.path.isfile(journal_path)
+
+    del blob_client.put_block
+    calls = _count_calls(blob_client, 'put_block')
+    common.transfer.upload_file_in_blocks(
+        blob_client, 'inputs', 'input.bin', local_file,
+        block_size=_BLOCK_SIZE, max_workers=1)
+    assert len(calls) == 11 - 4
+    assert not os.path.isfile(journal_path)
+    with open(local_file, 'rb') as f:
+        assert blob_client.get_blob_to_bytes(
+            'inputs', 'input.bin').content == f.read()
+
+
+def test_upload_restarts_for_a_changed_file(blob_client, local_file):
+    blob_client.create_container('inputs')
+    _count_calls(blob_client, 'put_block', fail_after=4)
+    with pytest.raises(_Interrupted):
+        common.transfer.upload_file_in_blocks(
+            blob_client, 'inputs', 'input.bin', local_file,
+            block_size=_BLOCK_SIZE, max_workers=1)
+    with open(local_file, 'ab') as f:
+        f.write(b'more')
+
+    del blob_client.put_block
+    calls = _count_calls(blob_client, 'put_block')
+    common.transfer.upload_file_in_blocks(
+        blob_client, 'inputs', 'input.bin', local_file,
+        block_size=_BLOCK_SIZE, max_workers=1)
+    assert len(calls) == 11
+
+
+def test_download_resumes_and_skips(blob_client, local_file, tmp_path):
+    blob_client.create_container('outputs')
+    common.transfer.upload_file_in_blocks(
+        blob_client, 'outputs', 'run/result.bin', local_file,
+        block_size=_BLOCK_SIZE)
+    directory = str(tmp_path / 'results')
+    destination = os.path.join(directory, 'run', 'result.bin')
+
+    _count_calls(blob_client, 'get_blob_to_bytes', fail_after=3)
+    with pytest.raises(_Interrupted):
+        common.transfer.download_container(
+            blob_client, 'outputs', directory, max_workers=1,
+            range_size=_BLOCK_SIZE)
+    assert os.path.isfile(destination + '.partial')
+
+    del blob_client.get_blob_to_bytes
+    calls = _count_calls(blob_client, 'get_blob_to_bytes')
+    assert common.transfer.download_container(
+        blob_client, 'outputs', directory, max_workers=1,
+        range_size=_BLOCK_SIZE) == [destination]
+    assert len(calls) == 11 - 3
+    with open(local_file, 'rb') as f, open(destination, 'rb') as g:
+        assert f.read() == g.read()
+
+    # the recorded etag matches, so nothing is fetched again
+    del calls[:]
+    common.transfer.download_container(
+        blob_client, 'outputs', directory, range_size=_BLOCK_SIZE)
+    assert not calls
+
+
+def test_download_replaces_files_it_did_not_fetch(blob_client, tmp_path):
+    blob_client.create_container('outputs')
+    blob_client.create_blob_from_bytes('outputs', 'result.txt', b'fresh')
+    directory = tmp_path / 'results'
+    directory.mkdir()
+    # same size, but never downloaded from this blob
+    (directory / 'result.txt').write_bytes(b'stale')
+
+    common.transfer.download_container(blob_client, 'outputs', str(directory))
+    assert (directory / 'result.txt').read_bytes() == b'fresh'
+
+
+def test_wait_for_blobs(blob_client):
+    blob_client.create_container('outputs')
+    blob_client.create_blob_from_bytes('outputs', 'a/stdout.txt', b'')
+    assert common.transfer.wait_for_blobs(
+        blob_client, 'outputs', ['a/*stdout.txt'], timeout=None)